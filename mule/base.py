@@ -7,12 +7,16 @@ import time
 import unittest
 import uuid
 
-from celery.task.control import inspect, broadcast
+from celery.task.control import inspect, broadcast, revoke
 from celery.task.sets import TaskSet
 from fnmatch import fnmatch
 from mule import conf
-from mule.tasks import run_test
-from mule.utils.multithreading import ThreadPool
+from mule.tasks import run_test, close_warm_processes, decompress_result, LocalJob, WarmJob, \
+                       WarmPool
+from mule.utils.processes import kill_build, mark_build_finished, remove_build_files
+from mule.utils.resources import get_slot_cpus
+from mule.utils.supervisor import Supervisor
+from mule.utils.timings import TimingStore
 
 class FailFastInterrupt(KeyboardInterrupt):
     pass
@@ -35,10 +39,20 @@ def load_script(workspace, name):
     
     return script
 
+def get_job_name(job):
+    """
+    Jobs may either be TestCase classes or the string which should be passed
+    to the runner as $TEST.
+    """
+    if isinstance(job, basestring):
+        return job
+    return '%s.%s' % (job.__module__, job.__name__)
+
 class Mule(object):
     loglevel = logging.INFO
     
-    def __init__(self, workspace=None, build_id=None, max_workers=None):
+    def __init__(self, workspace=None, build_id=None, max_workers=None, timings=None,
+                 speculative=False, compress=False, timeout=None):
         if not build_id:
             build_id = uuid.uuid4().hex
         
@@ -46,7 +60,36 @@ class Mule(object):
         self.max_workers = max_workers or multiprocessing.cpu_count()
         self.logger = logging.getLogger('mule')
         self.workspace = workspace
+        if timings is None:
+            timings = TimingStore(conf.TIMINGS_FILE)
+        self.timings = timings
+        # Re-run stragglers on idle workers at the end of a build
+        self.speculative = speculative
+        # Have workers compress their results before sending them back
+        self.compress = compress
+        # Seconds before a job is killed (None leaves it to the worker's configuration)
+        self.timeout = timeout
     
+    def order_jobs(self, jobs):
+        """
+        Returns job names in the order they should be dispatched, longest
+        first, so that the build isn't held up by a slow job started last.
+        """
+        return self.timings.sort_jobs([get_job_name(j) for j in jobs])
+
+    def make_callback(self, callback=None):
+        """
+        Wraps ``callback`` so that each result is also recorded in our timing store.
+        """
+        def wrapped(result):
+            try:
+                if callback:
+                    callback(result)
+            finally:
+                # Recorded afterwards as ``callback`` may annotate the result with ``timings``
+                self.timings.record_result(result)
+        return wrapped
+
     def process(self, jobs, runner='unit2 $TEST', callback=None):
         """
         ``jobs`` is a list of path.to.TestCase strings to process.
@@ -54,72 +97,38 @@ class Mule(object):
         ``runner`` should be defined as command exectuable in bash, where $TEST is
         the current job.
         
-        ``callback`` will execute a callback after each result is returned, in
-        addition to return the aggregate of all results after completion.
+        ``callback`` will execute a callback after each result is returned. If no
+        ``callback`` is given, all results are returned after completion. Otherwise
+        they're discarded once the callback has been executed (so they aren't held in
+        memory for the whole build), and an empty list is returned.
         """
         self.logger.info("Processing build %s", self.build_id)
 
         self.logger.info("Provisioning (up to) %d worker(s)", self.max_workers)
         
-        actual = None
-        
+        # We start running tests as soon as we have a single worker, and add
+        # more as they become available while the build is running
+        actual = []
+        delay = conf.PROVISION_MIN_DELAY
         while not actual:
-            # We need to determine which queues are available to use
-            i = inspect()
-            active_queues = i.active_queues() or {}
-        
-            if not active_queues:
-                self.logger.error('No queue workers available, retrying in 1s')
-                time.sleep(1)
-                continue
-            
-            available = [host for host, queues in active_queues.iteritems() if conf.DEFAULT_QUEUE in [q['name'] for q in queues]]
-        
-            if not available:
-                # TODO: we should probably sleep/retry (assuming there were *any* workers)
-                self.logger.info('All workers are busy, retrying in 1s')
-                time.sleep(1)
-                continue
-        
-            # Attempt to provision workers which reported as available
-            actual = []
-            for su_response in broadcast('mule_setup',
-                             arguments={'build_id': self.build_id,
-                                        'workspace': self.workspace,
-                                        'script': load_script(self.workspace, 'setup')},
-                             destination=available[:self.max_workers],
-                             reply=True,
-                             timeout=0):
-                for host, message in su_response.iteritems():
-                    if message.get('error'):
-                        self.logger.error('%s failed to setup: %s', host, message['error'])
-                    elif message.get('status') == 'ok':
-                        actual.append(host)
-                    if message.get('stdout'):
-                        self.logger.info('stdout from %s: %s', host, message['stdout'])
-                    if message.get('stderr'):
-                        self.logger.info('stderr from %s: %s', host, message['stderr'])
-        
+            actual = self.provision_workers(self.max_workers)
             if not actual:
-                # TODO: we should probably sleep/retry (assuming there were *any* workers)
-                self.logger.info('Failed to provision workers (busy), retrying in 1s')
-                time.sleep(1)
-                continue
-        
-        if len(actual) != len(available):
-            # We should begin running tests and possibly add more, but its not a big deal
-            pass
+                self.logger.info('Failed to provision workers, retrying in %.1fs', delay)
+                time.sleep(delay)
+                delay = min(delay * 2, conf.PROVISION_MAX_DELAY)
 
         self.logger.info('%d worker(s) were provisioned', len(actual))
             
+        jobs = self.order_jobs(jobs)
+
         self.logger.info("Building queue of %d test job(s)", len(jobs))
         
+        keep_results = callback is None
+        callback = self.make_callback(callback)
+
         try:
             taskset = TaskSet(run_test.subtask(
-                build_id=self.build_id,
-                runner=runner,
-                workspace=self.workspace,
-                job='%s.%s' % (job.__module__, job.__name__),
+                kwargs=self.get_task_kwargs(job, runner),
                 options={
                     # 'routing_key': 'mule-%s' % self.build_id,
                     'queue': 'mule-%s' % self.build_id,
@@ -133,14 +142,16 @@ class Mule(object):
             # propagate=False ensures we get *all* responses        
             response = []
             try:
-                for task_response in result.iterate():
-                    response.append(task_response)
-                    if callback:
-                        callback(task_response)
+                for task_response in self.iter_results(result, actual, jobs, runner):
+                    if keep_results:
+                        response.append(task_response)
+                    callback(task_response)
             except KeyboardInterrupt, e:
                 print '\nReceived keyboard interrupt, closing workers.\n'
         
         finally:
+            self.timings.save()
+
             self.logger.info("Tearing down %d worker(s)", len(actual))
 
             # Send off teardown task to all workers in pool
@@ -163,6 +174,152 @@ class Mule(object):
         
         return response
 
+    def provision_workers(self, limit, exclude=()):
+        """
+        Attempts to provision up to ``limit`` idle workers (those consuming from the
+        default queue) for this build, and returns the hosts which were provisioned.
+        """
+        # We need to determine which queues are available to use
+        i = inspect()
+        active_queues = i.active_queues() or {}
+    
+        if not active_queues:
+            self.logger.error('No queue workers available')
+            return []
+        
+        available = [host for host, queues in active_queues.iteritems()
+                     if host not in exclude and conf.DEFAULT_QUEUE in [q['name'] for q in queues]]
+    
+        if not available:
+            self.logger.info('All workers are busy')
+            return []
+    
+        # Attempt to provision workers which reported as available
+        actual = []
+        for su_response in broadcast('mule_setup',
+                         arguments={'build_id': self.build_id,
+                                    'workspace': self.workspace,
+                                    'script': load_script(self.workspace, 'setup')},
+                         destination=available[:limit],
+                         reply=True,
+                         timeout=0):
+            for host, message in su_response.iteritems():
+                if message.get('error'):
+                    self.logger.error('%s failed to setup: %s', host, message['error'])
+                elif message.get('status') == 'ok':
+                    actual.append(host)
+                if message.get('stdout'):
+                    self.logger.info('stdout from %s: %s', host, message['stdout'])
+                if message.get('stderr'):
+                    self.logger.info('stderr from %s: %s', host, message['stderr'])
+
+        return actual
+
+    def get_task_kwargs(self, job, runner):
+        kwargs = {
+            'build_id': self.build_id,
+            'runner': runner,
+            'workspace': self.workspace,
+            'job': job,
+        }
+        if self.compress:
+            kwargs['compress'] = True
+        if self.timeout is not None:
+            kwargs['timeout'] = self.timeout
+        return kwargs
+
+    def dispatch(self, job, runner):
+        """
+        Queues a single job for this build, returning its ``AsyncResult``.
+        """
+        return run_test.apply_async(kwargs=self.get_task_kwargs(job, runner),
+                                    queue='mule-%s' % self.build_id)
+
+    def iter_results(self, result, workers, jobs=(), runner=None):
+        """
+        Yields the result of each task in the ``TaskSetResult`` as soon as it is ready.
+
+        While waiting, idle workers are periodically provisioned into the build (and
+        appended to ``workers``) until we have ``max_workers``, or more workers than
+        there are remaining tasks.
+
+        If ``speculative`` is enabled, ``jobs`` (in the same order as the tasks) which
+        run well past their expected duration once nothing is left in the queue are
+        also dispatched to an idle worker. Whichever copy finishes first is used, and
+        the other is revoked and its runner killed.
+        """
+        jobs = list(jobs) or [None] * len(result.results)
+        # Each entry is [job, [task results], time we know it was running by]
+        pending = [[job, [r], None] for job, r in zip(jobs, result.results)]
+        last_provision = time.time()
+
+        while pending:
+            ready = []
+            for entry in pending:
+                for task_result in entry[1]:
+                    if task_result.ready():
+                        ready.append((entry, task_result))
+                        break
+
+            for entry, task_result in ready:
+                pending.remove(entry)
+                for other in entry[1]:
+                    if other is not task_result:
+                        self.logger.info('Revoking duplicate of %s', entry[0])
+                        revoke(other.task_id, terminate=True)
+                        # The runner it started is in a session of its own
+                        broadcast('mule_kill_job',
+                                  arguments={'build_id': self.build_id, 'task_id': other.task_id},
+                                  destination=workers)
+                # Failed tasks give us their exception, which is reported as an error
+                yield decompress_result(task_result.result)
+
+            if ready:
+                continue
+
+            if len(workers) < min(self.max_workers, len(pending)) and \
+               time.time() - last_provision >= conf.PROVISION_INTERVAL:
+                added = self.provision_workers(self.max_workers - len(workers), exclude=workers)
+                if added:
+                    self.logger.info('%d additional worker(s) were provisioned', len(added))
+                    workers.extend(added)
+                last_provision = time.time()
+
+            if self.speculative and runner:
+                self.speculate(pending, workers, runner)
+
+            time.sleep(conf.RESULT_POLL_INTERVAL)
+
+    def speculate(self, pending, workers, runner):
+        """
+        Dispatches a second copy of straggling jobs to idle workers.
+        """
+        running = sum(len(entry[1]) for entry in pending)
+        if running > len(workers):
+            # The queue isn't empty yet, so nothing is idle
+            return
+
+        now = time.time()
+        idle = len(workers) - running
+        for entry in pending:
+            job, task_results, started = entry
+            if started is None:
+                # With an empty queue everything pending is running, we just can't tell since when
+                entry[2] = now
+                continue
+
+            if not idle or job is None or len(task_results) > 1:
+                continue
+
+            expected = self.timings.estimate(job, 0.0)
+            if now - started < max(conf.SPECULATIVE_MIN_TIME, expected * conf.SPECULATIVE_FACTOR):
+                continue
+
+            self.logger.info('%s has been running for %.3fs (expected %.3fs), dispatching a duplicate',
+                             job, now - started, expected)
+            task_results.append(self.dispatch(job, runner))
+            idle -= 1
+
     def _match_path(self, path, full_path, pattern):
         # override this method to use alternative matching strategy
         return fnmatch(path, pattern)
@@ -257,32 +414,93 @@ class Mule(object):
                     yield test
 
 class MultiProcessMule(Mule):
-    def process(self, jobs, runner='unit2 $TEST', callback=None):
+    def __init__(self, *args, **kwargs):
+        # Pin each worker slot to its own CPUs, so jobs don't migrate between (or
+        # thrash the caches of) each other's CPUs
+        self.pin = kwargs.pop('pin', False)
+        super(MultiProcessMule, self).__init__(*args, **kwargs)
+
+    def process(self, jobs, runner='unit2 $TEST', callback=None, warm=False, spawn=None):
+        """
+        Runs ``jobs`` on this machine, up to ``max_workers`` at once, all supervised
+        from this thread.
+
+        If ``warm`` is set, ``runner`` starts a long running worker for each process
+        which is sent jobs over its stdin (e.g. ``mule --worker --serve``), rather than
+        starting a new runner for every job.
+
+        Warm workers can instead be started by ``spawn`` (e.g. a ``ForkServer``).
+
+        As with ``Mule.process``, results are only returned if no ``callback`` is
+        given. Otherwise each is discarded once the callback has been executed, and
+        an empty list is returned.
+        """
         self.logger.info("Processing build %s", self.build_id)
 
-        self.logger.info("Provisioning %d worker(s)", self.max_workers)
-        
-        pool = ThreadPool(self.max_workers)
+        jobs = self.order_jobs(jobs)
 
         self.logger.info("Building queue of %d test job(s)", len(jobs))
 
-        for job in jobs:
-            pool.add(run_test,
-                build_id=self.build_id,
-                runner=runner,
-                job='%s.%s' % (job.__module__, job.__name__),
-                workspace=self.workspace,
-                callback=callback,
-            )
+        keep_results = callback is None
+        callback = self.make_callback(callback)
+
+        slot_cpus = None
+        if self.pin:
+            slot_cpus = get_slot_cpus(self.max_workers)
+
+        if warm:
+            pool = WarmPool(self.build_id, runner, workspace=self.workspace, spawn=spawn,
+                            slot_cpus=slot_cpus)
+            make_job = lambda job: WarmJob(self.build_id, job, pool, workspace=self.workspace,
+                                           timeout=self.timeout)
+        else:
+            make_job = lambda job: LocalJob(self.build_id, runner, job, workspace=self.workspace,
+                                            timeout=self.timeout, logger=self.logger,
+                                            slot_cpus=slot_cpus)
+
+        self.supervisor = Supervisor(self.max_workers)
 
         self.logger.info("Waiting for response...")
 
-        response = [r['result'] for r in pool.join()]
+        response = []
+        try:
+            for result in self.supervisor.run(make_job(job) for job in jobs):
+                if keep_results:
+                    response.append(result)
+                callback(result)
+        except KeyboardInterrupt, e:
+            if not isinstance(e, FailFastInterrupt):
+                print '\nReceived keyboard interrupt, closing workers.\n'
+            # Stop whatever else is running, the remaining jobs are skipped
+            for result in self.cancel():
+                if keep_results:
+                    response.append(result)
+                try:
+                    callback(result)
+                except KeyboardInterrupt:
+                    pass
+        finally:
+            self.timings.save()
 
-        self.logger.info("Tearing down %d worker(s)", self.max_workers)
+            self.logger.info("Tearing down %d worker(s)", self.max_workers)
 
-        # TODO
+            close_warm_processes(self.build_id)
+            remove_build_files(self.build_id)
         
         self.logger.info('Finished')
         
-        return response
\ No newline at end of file
+        return response
+
+    def cancel(self):
+        """
+        Kills all running jobs (e.g. when failing fast), and returns their results.
+        The remaining jobs are never started.
+        """
+        self.logger.info('Cancelling build %s', self.build_id)
+
+        # Jobs starting from now on are skipped (or kill themselves)
+        mark_build_finished(self.build_id)
+        results = self.supervisor.cancel()
+        kill_build(self.build_id)
+        close_warm_processes(self.build_id, kill=True)
+        return results
@@ -6,6 +6,7 @@ These can be overrriden (in bulk) using:
 >>> mule.utils.conf.configure(**settings)
 """
 
+import os.path
 
 DEFAULT_QUEUE = 'default'
 BUILD_QUEUE_PREFIX = 'mule'
@@ -13,6 +14,66 @@ BUILD_QUEUE_PREFIX = 'mule'
 # TODO: this should be some kind of absolute system path, and a sane default
 ROOT = 'mule'
 
+# Delay (in seconds) between attempts to provision workers when none are available. This
+# starts at the minimum and backs off up to the maximum.
+PROVISION_MIN_DELAY = 0.5
+PROVISION_MAX_DELAY = 10
+
+# How often (in seconds) to try and add idle workers to a running build
+PROVISION_INTERVAL = 5
+
+# How often (in seconds) to check for finished jobs
+RESULT_POLL_INTERVAL = 0.25
+
+# With speculative execution, a job is duplicated onto an idle worker at the end of a build if
+# it has been running for this many times its expected duration (and at least the minimum seconds)
+SPECULATIVE_FACTOR = 2
+SPECULATIVE_MIN_TIME = 30
+
+# Seconds a cancelled job is given to exit after SIGTERM, before it is sent SIGKILL
+KILL_GRACE = 2
+
+# Seconds a job may run for before its process group is killed and it is reported as an
+# error, None to let jobs run forever. Can be overridden per workspace (with 'timeout').
+JOB_TIMEOUT = None
+
+# Seconds a timed out job is given to dump the stacks of its threads before it is killed
+TIMEOUT_DUMP_WAIT = 1
+
+# Output a job writes beyond these many bytes is dropped, keeping its head and tail. Output
+# is spooled to disk, so only what is kept is ever held in memory. None to keep everything.
+STDOUT_LIMIT = 16 * 1024 * 1024
+STDERR_LIMIT = 1024 * 1024
+# A report (see ``mule.tasks.is_report``) on stdout is kept whole up to this many bytes, as
+# truncating it would leave it unparseable. Larger ones are truncated like any other output.
+REPORT_LIMIT = 64 * 1024 * 1024
+
+# Fraction of the limit kept from the start of truncated output (the rest is from its end)
+OUTPUT_HEAD_RATIO = 0.5
+
+# Memory set aside for each local worker when sizing the pool with --auto-workers
+WORKER_MEMORY = 512 * 1024 * 1024
+
+# Number of jobs listed for each resource (CPU, memory, I/O, context switches) in the
+# report at the end of a build, 0 to disable the report
+RUSAGE_REPORT_SIZE = 5
+
+# With compression enabled, result values (stdout, stderr, report) larger than this many
+# bytes are zlib compressed before being sent through the result backend
+COMPRESS_THRESHOLD = 4096
+COMPRESS_LEVEL = 6
+
+# Historical job durations are persisted here so the longest jobs can be dispatched first.
+# Set to None to disable.
+TIMINGS_FILE = os.path.expanduser('~/.mule/timings.json')
+
+# With batching enabled, small TestCases are packed into jobs until the measured per-job
+# overhead is at most this fraction of a job's run time.
+BATCH_OVERHEAD_RATIO = 0.2
+
+# ... but jobs are never made so large that there are fewer than this many per worker.
+BATCH_JOBS_PER_WORKER = 4
+
 WORKSPACES = {
     'default': {
         # setup/teardown should either be an absolute path to a bash script (/foo/bar.sh)
@@ -23,5 +84,7 @@ WORKSPACES = {
         # - $WORKSPACE (full path to workspace directory)
         'setup': None,
         'teardown': None,
+        # seconds before a job is killed (defaults to JOB_TIMEOUT)
+        'timeout': None,
     }
 }
\ No newline at end of file
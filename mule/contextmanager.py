@@ -18,4 +18,8 @@ class BaseTestContextManager(object):
         pass
 
     def __exit__(self, type, value, traceback):
+        pass
+
+    def reset(self):
+        # Called between jobs when a worker runs more than one (e.g. with --serve)
         pass
\ No newline at end of file
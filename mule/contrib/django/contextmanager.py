@@ -7,9 +7,32 @@ from django.db.backends import DatabaseProxy
 from django.db.models import get_apps, get_models, signals
 
 from mule.contextmanager import BaseTestContextManager
-from mule.contrib.django.loader import get_test_module
-from mule.utils import import_string
-from mule.utils.locking import get_setting_lock, release_setting_lock
+from mule.contrib.django.database import can_clone, clone_database, database_exists, \
+                                         drop_database, get_engine, get_template_prefix, \
+                                         lock_database, read_fingerprint, rename_database, \
+                                         write_fingerprint
+from mule.contrib.django.schema import get_database_aliases, get_schema_fingerprint
+from mule.contrib.django.loader import import_setup_modules
+from mule.contrib.django.registry import get_registry_path
+from mule.contrib.django.fixtures import FixtureCache, patch_fixture_setup
+from mule.contrib.django.reset import DatabaseResetter
+from mule.utils.locking import acquire_lock, get_setting_lock, lock_for_setting, \
+                               release_lock, release_setting_lock
+from mule.utils.slotpool import get_pool_path, lease_slot
+
+import os
+
+def drop_templates(prefix):
+    """
+    Drops the template databases named with ``prefix`` (see ``get_template_prefix``),
+    once their build is over.
+    """
+    for alias in get_database_aliases():
+        connection = connections[alias]
+        if get_engine(connection) is None:
+            continue
+        drop_database(connection, prefix + settings.DATABASES[alias]['NAME'])
+        connection.close()
 
 class EnvContextManager(BaseTestContextManager):
     def __enter__(self):
@@ -19,62 +42,86 @@ class EnvContextManager(BaseTestContextManager):
         self.suite.teardown_test_environment()
 
 class DatabaseContextManager(BaseTestContextManager):
+    # Fast resets of each database between jobs, by alias (see ``reset``)
+    resetters = {}
+    unpatch_fixture_setup = None
+    # The slot we were given by the build's slot pool, if any (see ``mule.utils.slotpool``)
+    lease = None
+    locked = False
+
     def __enter__(self):
         suite = self.suite
 
-        self.db_num = get_setting_lock('db', self.build_id)
+        # Kept databases are shared by every build, and so are their slots
+        self.lock_id = suite.keep_db and 'keepdb' or self.build_id
+
+        if suite.prepare_slot is not None:
+            # The slot pool is preparing this slot, and has made sure nobody is using it
+            self.db_num = suite.prepare_slot
+        else:
+            if suite.db_pool:
+                self.lease = lease_slot(get_pool_path(self.build_id))
+            if self.lease is not None:
+                self.db_num = self.lease.slot
+            else:
+                # A pool holds the locks of its own slots, so we're numbered after them
+                self.db_num = get_setting_lock('db', self.lock_id)
+                self.locked = True
 
-        db_prefix = '%s_%s_%s_' % (suite.db_prefix, self.build_id, self.db_num)
+        if suite.keep_db:
+            db_prefix = '%s_%s_' % (suite.db_prefix, self.db_num)
+        else:
+            db_prefix = '%s_%s_%s_' % (suite.db_prefix, self.build_id, self.db_num)
+        # Databases which are cloned for each slot (see ``clone_databases``)
+        self.template_prefix = get_template_prefix(suite.db_prefix, self.build_id)
 
         for k, v in settings.DATABASES.iteritems():
             # If TEST_NAME wasnt set, or we've set a non-default prefix
-            if not v.get('TEST_NAME') or self.auto_bootstrap:
+            if not v.get('TEST_NAME') or suite.auto_bootstrap or suite.keep_db:
                 settings.DATABASES[k]['TEST_NAME'] = db_prefix + settings.DATABASES[k]['NAME']
 
         suite.db_prefix = db_prefix
-        
-        # We only need to setup databases if we need to bootstrap
-        if suite.auto_bootstrap:
-            bootstrap = False
-            for alias in connections:
-                connection = connections[alias]
 
-                if connection.settings_dict['TEST_MIRROR']:
-                    continue
+        # Nobody else may set up (or decide to reuse) our databases until we're done
+        unlocks = [lock_database(connections[alias], settings.DATABASES[alias]['TEST_NAME'],
+                                 self.lock_id)
+                   for alias in get_database_aliases()]
+        try:
+            self.setup_databases()
+        finally:
+            for unlock in reversed(unlocks):
+                unlock()
 
-                qn = connection.ops.quote_name
-                test_database_name = connection.settings_dict['TEST_NAME']
-                cursor = connection.cursor()
-                suffix = connection.creation.sql_table_creation_suffix()
-                connection.creation.set_autocommit()
-
-                # HACK: this isnt an accurate check
-                try:
-                    cursor.execute("CREATE DATABASE %s %s" % (qn(test_database_name), suffix))
-                except Exception, e:
-                    pass
-                else:
-                    cursor.execute("DROP DATABASE %s" % (qn(test_database_name),))
-                    bootstrap = True
-                    break
-                finally:
-                    cursor.close()
+    def setup_databases(self):
+        suite = self.suite
 
-                connection.close()
+        # Ensure we import everything which creates tables or registers post_syncdb receivers
+        # (but not every test in the project, the job's own tests are imported with its suite)
+        import_setup_modules(get_registry_path(self.build_id))
+
+        # Databases which are reused are marked with the schema they were built with
+        if suite.keep_db or suite.auto_bootstrap:
+            self.fingerprints = dict((alias, get_schema_fingerprint(alias))
+                                     for alias in get_database_aliases())
+
+        # We only need to setup databases if we need to bootstrap
+        if suite.keep_db:
+            if all(get_engine(connections[alias]) for alias in get_database_aliases()):
+                # Reuse the databases kept by a previous build, unless the schema has changed
+                bootstrap = not self.databases_ready(check_fingerprint=True)
+            else:
+                # We can't tell whether other backends' databases exist, so they're always rebuilt
+                bootstrap = True
+        elif suite.auto_bootstrap:
+            if all(get_engine(connections[alias]) for alias in get_database_aliases()):
+                bootstrap = not self.databases_ready()
+            else:
+                bootstrap = self.probe_databases()
         else:
             bootstrap = True
 
-        # Ensure we import all tests that could possibly be executed so that tables get created
-        # and all signals get registered
-        for app in get_apps():
-            get_test_module(app)
-
-            # Import the 'management' module within each installed app, to register
-            # dispatcher events.
-            try:
-                import_string('%s.management' % app.__name__.rsplit('.', 1)[0])
-            except (ImportError, AttributeError):
-                pass
+        cloning = bootstrap and suite.db_template and \
+                  all(can_clone(connections[alias]) for alias in get_database_aliases())
 
         # HACK: We need to kill post_syncdb receivers to stop them from sending when the databases
         #       arent fully ready.
@@ -105,8 +152,10 @@ class DatabaseContextManager(BaseTestContextManager):
                     # the side effect of initializing the test database.
                     cursor = connection.cursor()
 
-                    # Ensure our database is clean
-                    call_command('flush', verbosity=0, interactive=False, database=alias)
+                    # Ensure our database is clean (slots from the pool were cleaned when
+                    # they were prepared)
+                    if self.lease is None:
+                        call_command('flush', verbosity=0, interactive=False, database=alias)
 
                 # XXX: do we need to flush the cache db?
 
@@ -114,11 +163,35 @@ class DatabaseContextManager(BaseTestContextManager):
                 #     from django.core.cache import parse_backend_uri
                 #     _, cache_name, _ = parse_backend_uri(settings.CACHE_BACKEND)
                 #     call_command('createcachetable', cache_name)
-        else:
+        elif not cloning:
             old_names, mirrors = suite.setup_databases()
 
         signals.post_syncdb.receivers = post_syncdb_receivers
 
+        if cloning:
+            # The templates already include everything post_syncdb would have created
+            old_names, mirrors = self.clone_databases()
+        elif bootstrap or self.lease is None:
+            self.send_post_syncdb()
+
+        if bootstrap and (suite.keep_db or suite.auto_bootstrap):
+            # Marks the databases as ready to be reused
+            for alias in get_database_aliases():
+                write_fingerprint(connections[alias], self.fingerprints[alias])
+
+        if suite.fast_reset:
+            # Snapshots the data each database starts with, which resets restore
+            self.resetters = dict((alias, DatabaseResetter(alias)) for alias in get_database_aliases())
+
+        if suite.fast_reset or suite.fixture_cache:
+            # TransactionTestCase's only reset the tables which were written to before each
+            # test, and fixtures are only deserialized once per worker
+            self.unpatch_fixture_setup = patch_fixture_setup(
+                self.resetters, suite.fixture_cache and FixtureCache() or None)
+
+        self.old_config = old_names, mirrors
+
+    def send_post_syncdb(self):
         # XXX: we could truncate all tables in the teardown phase and
         #      run the syncdb steps on each iteration (to ensure compatibility w/ transactions)
         for app in get_apps():
@@ -133,18 +206,191 @@ class DatabaseContextManager(BaseTestContextManager):
                 all_models = [m for m in app_models if router.allow_syncdb(alias, m)]
                 if not all_models:
                     continue
-                signals.post_syncdb.send(app=app, created_models=all_models, verbosity=suite.verbosity,
+                signals.post_syncdb.send(app=app, created_models=all_models, verbosity=self.suite.verbosity,
                                          db=alias, sender=app, interactive=False)
 
-        self.old_config = old_names, mirrors
+    def probe_databases(self):
+        """
+        Returns whether the databases need bootstrapping, for backends which we can't
+        check for databases (see ``databases_ready``).
+        """
+        for alias in connections:
+            connection = connections[alias]
+
+            if connection.settings_dict['TEST_MIRROR']:
+                continue
+
+            qn = connection.ops.quote_name
+            test_database_name = connection.settings_dict['TEST_NAME']
+            cursor = connection.cursor()
+            suffix = connection.creation.sql_table_creation_suffix()
+            connection.creation.set_autocommit()
+
+            # HACK: this isnt an accurate check
+            try:
+                cursor.execute("CREATE DATABASE %s %s" % (qn(test_database_name), suffix))
+            except Exception, e:
+                pass
+            else:
+                cursor.execute("DROP DATABASE %s" % (qn(test_database_name),))
+                return True
+            finally:
+                cursor.close()
+
+            connection.close()
+        return False
+
+    def databases_ready(self, check_fingerprint=False):
+        """
+        Returns whether all of this slot's databases exist, and were completely set up
+        (they're only marked once they are). If ``check_fingerprint`` is set, they also
+        need to have been built with the current schema.
+        """
+        for alias in get_database_aliases():
+            connection = connections[alias]
+            test_database_name = settings.DATABASES[alias]['TEST_NAME']
+            if not database_exists(connection, test_database_name):
+                return False
+
+            old_name = connection.settings_dict['NAME']
+            connection.close()
+            connection.settings_dict['NAME'] = test_database_name
+            try:
+                fingerprint = read_fingerprint(connection)
+            finally:
+                connection.close()
+                connection.settings_dict['NAME'] = old_name
+
+            if fingerprint is None:
+                return False
+            if check_fingerprint and fingerprint != self.fingerprints[alias]:
+                return False
+        return True
+
+    def get_template_names(self):
+        return dict((alias, self.template_prefix + settings.DATABASES[alias]['NAME'])
+                    for alias in get_database_aliases())
+
+    def build_templates(self, templates):
+        """
+        Builds the ``templates`` databases exactly as a slot's databases would be built.
+        They're built under temporary names and renamed once complete, so a template
+        which exists is always ready to be cloned.
+        """
+        suite = self.suite
+
+        test_names = {}
+        building = {}
+        for alias, name in templates.iteritems():
+            building[alias] = '%s_%d' % (name, os.getpid())
+            test_names[alias] = settings.DATABASES[alias]['TEST_NAME']
+            settings.DATABASES[alias]['TEST_NAME'] = building[alias]
+
+        post_syncdb_receivers = signals.post_syncdb.receivers
+        signals.post_syncdb.receivers = []
+        try:
+            old_names, mirrors = suite.setup_databases()
+        finally:
+            signals.post_syncdb.receivers = post_syncdb_receivers
+            for alias, name in test_names.iteritems():
+                settings.DATABASES[alias]['TEST_NAME'] = name
+
+        self.send_post_syncdb()
+
+        for connection, old_name in old_names:
+            connection.close()
+            connection.settings_dict['NAME'] = old_name
+        for alias, connection in mirrors:
+            connections._connections[alias] = connection
+
+        for alias, name in templates.iteritems():
+            # Another machine may have built the same template in the meantime
+            rename_database(connections[alias], building[alias], name)
+            connections[alias].close()
+
+    def clone_databases(self):
+        """
+        Creates this slot's databases as clones of the build's templates, which are
+        built by whichever slot gets here first.
+        """
+        templates = self.get_template_names()
+
+        lock = lock_for_setting('db_template', self.build_id)
+        acquire_lock(lock, blocking=True)
+        try:
+            missing = dict((alias, name) for alias, name in templates.iteritems()
+                           if not database_exists(connections[alias], name))
+            if missing:
+                self.build_templates(missing)
+        finally:
+            release_lock(lock, remove=False)
+
+        old_names = []
+        mirrors = []
+        for alias in connections:
+            connection = connections[alias]
+
+            if connection.settings_dict['TEST_MIRROR']:
+                mirrors.append((alias, connection))
+                mirror_alias = connection.settings_dict['TEST_MIRROR']
+                connections._connections[alias] = DatabaseProxy(connections[mirror_alias], alias)
+                continue
+
+            test_database_name = settings.DATABASES[alias]['TEST_NAME']
+            clone_database(connection, templates[alias], test_database_name)
+
+            old_names.append((connection, connection.settings_dict['NAME']))
+            connection.close()
+            connection.settings_dict['NAME'] = test_database_name
+
+            # Ensure we setup ``SUPPORTS_TRANSACTIONS``
+            connection.settings_dict['SUPPORTS_TRANSACTIONS'] = connection.creation._rollback_works()
+
+        return old_names, mirrors
+
+    def reset(self):
+        # Ensure the next job starts with clean databases
+        for alias in connections:
+            connection = connections[alias]
+
+            if connection.settings_dict['TEST_MIRROR']:
+                continue
+
+            resetter = self.resetters.get(alias)
+            if resetter is not None and resetter.reset():
+                continue
+
+            call_command('flush', verbosity=0, interactive=False, database=alias)
 
     def __exit__(self, type, value, traceback):
         suite = self.suite
-        
+
+        if self.unpatch_fixture_setup is not None:
+            self.unpatch_fixture_setup()
+
+        # Slots belong to the pool, which prepares them again for the next worker
+        if self.lease is not None:
+            self.lease.release()
+            return
+        if suite.prepare_slot is not None:
+            return
+
+        if suite.db_template and not suite.worker:
+            # We ran the whole build ourselves, so nobody else needs its templates (the
+            # runner drops them for workers' builds)
+            drop_templates(self.template_prefix)
+
+        # Kept databases are left for the next build
+        if suite.keep_db:
+            if self.locked:
+                release_setting_lock('db', self.lock_id, self.db_num)
+            return
+
         # If we were bootstrapping we dont tear down databases
         if suite.auto_bootstrap:
             return
 
         suite.teardown_databases(self.old_config)
         
-        release_setting_lock('db', self.build_id, self.db_num)
\ No newline at end of file
+        if self.locked:
+            release_setting_lock('db', self.lock_id, self.db_num)
\ No newline at end of file
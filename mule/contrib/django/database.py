@@ -0,0 +1,187 @@
+"""
+Provisioning of the test databases used by each worker slot.
+
+Rather than every slot running syncdb (and the ``post_syncdb`` handlers) itself, the
+first slot of a build builds template databases, which every slot then clones
+(``CREATE DATABASE ... TEMPLATE`` on Postgres, a file copy on SQLite).
+
+Databases can also be kept between builds, and are reused for as long as the
+fingerprint of their schema (see ``mule.contrib.django.schema``) is unchanged.
+
+Everything here works on the connection it's given, so nothing imports Django.
+"""
+from __future__ import absolute_import
+
+from mule.utils.locking import acquire_lock, lock_for_setting, release_lock
+
+import hashlib
+import os, os.path
+import shutil
+import time
+import zlib
+
+POSTGRES_ENGINES = ('postgresql', 'postgresql_psycopg2', 'postgis')
+SQLITE_ENGINES = ('sqlite3', 'spatialite')
+
+# Table in each kept database which holds the fingerprint of the schema it was built with
+MARKER_TABLE = 'mule_schema'
+
+# Postgres refuses to clone a template while it has other connections (e.g. a slot
+# which is still closing the connection it built the template with)
+CLONE_RETRIES = 5
+CLONE_RETRY_DELAY = 0.5
+
+def get_engine(connection):
+    """
+    Returns ``postgresql`` or ``sqlite`` for the backends we can provision databases
+    for, or None.
+    """
+    engine = connection.settings_dict['ENGINE'].rsplit('.', 1)[-1]
+    if engine in POSTGRES_ENGINES:
+        return 'postgresql'
+    if engine in SQLITE_ENGINES:
+        return 'sqlite'
+    return None
+
+def can_clone(connection):
+    engine = get_engine(connection)
+    if engine == 'sqlite':
+        # In-memory databases only exist within the process which created them
+        test_name = connection.settings_dict['TEST_NAME']
+        return bool(test_name) and test_name != ':memory:'
+    return engine is not None
+
+def _get_cursor(connection):
+    # CREATE/DROP/ALTER DATABASE can't be run inside a transaction
+    cursor = connection.cursor()
+    connection.creation.set_autocommit()
+    return cursor
+
+def database_exists(connection, name):
+    if get_engine(connection) == 'sqlite':
+        return os.path.exists(name)
+
+    cursor = _get_cursor(connection)
+    try:
+        cursor.execute("SELECT 1 FROM pg_catalog.pg_database WHERE datname = %s", [name])
+        return cursor.fetchone() is not None
+    finally:
+        cursor.close()
+
+def drop_database(connection, name):
+    if get_engine(connection) == 'sqlite':
+        if os.path.exists(name):
+            os.remove(name)
+        return
+
+    qn = connection.ops.quote_name
+    cursor = _get_cursor(connection)
+    try:
+        cursor.execute("DROP DATABASE IF EXISTS %s" % (qn(name),))
+    finally:
+        cursor.close()
+
+def rename_database(connection, old_name, new_name):
+    """
+    Renames ``old_name`` to ``new_name``, unless ``new_name`` already exists in which
+    case ``old_name`` is dropped. Returns whether it was renamed.
+    """
+    if database_exists(connection, new_name):
+        drop_database(connection, old_name)
+        return False
+
+    if get_engine(connection) == 'sqlite':
+        os.rename(old_name, new_name)
+        return True
+
+    qn = connection.ops.quote_name
+    cursor = _get_cursor(connection)
+    try:
+        cursor.execute("ALTER DATABASE %s RENAME TO %s" % (qn(old_name), qn(new_name)))
+    finally:
+        cursor.close()
+    return True
+
+def clone_database(connection, template_name, name):
+    """
+    Creates ``name`` as a copy of ``template_name``, replacing it if it already exists.
+    """
+    drop_database(connection, name)
+
+    if get_engine(connection) == 'sqlite':
+        # Copied under a temporary name, so a half written copy is never opened
+        tmp_name = '%s.%d' % (name, os.getpid())
+        shutil.copyfile(template_name, tmp_name)
+        os.rename(tmp_name, name)
+        return
+
+    # The clone inherits the template's encoding, so there is no creation suffix
+    qn = connection.ops.quote_name
+    for attempt in xrange(CLONE_RETRIES):
+        cursor = _get_cursor(connection)
+        try:
+            cursor.execute("CREATE DATABASE %s TEMPLATE %s" % (qn(name), qn(template_name)))
+        except Exception:
+            if attempt == CLONE_RETRIES - 1:
+                raise
+            time.sleep(CLONE_RETRY_DELAY)
+        else:
+            return
+        finally:
+            cursor.close()
+
+def lock_database(connection, name, build_id):
+    """
+    Blocks until nobody else is setting up the database ``name``, and returns a function
+    which releases it again.
+
+    Postgres databases are locked with an advisory lock (held by a connection of its own),
+    so slots on other machines which share the server are kept out too. Other databases
+    are locked with a lock file, which is removed with ``build_id``'s other files.
+    """
+    if get_engine(connection) == 'postgresql':
+        lock_connection = connection.__class__(dict(connection.settings_dict), connection.alias)
+        cursor = lock_connection.cursor()
+        cursor.execute("SELECT pg_advisory_lock(%s)", [zlib.crc32(name)])
+        # Advisory locks are released along with the session
+        return lock_connection.close
+
+    lock = lock_for_setting('db_setup', build_id, hashlib.md5(name).hexdigest())
+    acquire_lock(lock, blocking=True)
+    return lambda: release_lock(lock, remove=False)
+
+def get_template_prefix(db_prefix, build_id):
+    """
+    Returns the prefix of the names of the template databases built for ``build_id``.
+    """
+    return '%s_%s_template_' % (db_prefix, build_id)
+
+def read_fingerprint(connection):
+    """
+    Returns the fingerprint recorded in the database ``connection`` is using, or None.
+    """
+    if MARKER_TABLE not in connection.introspection.table_names():
+        return None
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT fingerprint FROM %s" % (connection.ops.quote_name(MARKER_TABLE),))
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    return row[0] if row else None
+
+def write_fingerprint(connection, fingerprint):
+    """
+    Records ``fingerprint`` in the database ``connection`` is using. The marker table
+    isn't a model, so it survives flushes.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    try:
+        if MARKER_TABLE not in connection.introspection.table_names():
+            cursor.execute("CREATE TABLE %s (fingerprint varchar(40) NOT NULL)" % (qn(MARKER_TABLE),))
+        cursor.execute("DELETE FROM %s" % (qn(MARKER_TABLE),))
+        cursor.execute("INSERT INTO %s (fingerprint) VALUES (%%s)" % (qn(MARKER_TABLE),), [fingerprint])
+    finally:
+        cursor.close()
+    connection._commit()
@@ -0,0 +1,146 @@
+"""
+Loading of TestCase fixtures, shared across the jobs a worker runs.
+
+Rather than deserializing (and saving object by object) the same fixtures for every
+TestCase, the statements ``loaddata`` runs for a set of fixtures are recorded the first
+time it's loaded, and replayed in batches (one ``executemany`` per statement) after that.
+Recordings are keyed by the path and modification time of each fixture file, so an
+edited fixture is loaded afresh.
+
+Only the statements are replayed, so ``pre_save``/``post_save`` handlers (which are sent
+with ``raw=True`` by ``loaddata``) only run for the first load, along with any writes
+they make.
+"""
+from __future__ import absolute_import
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.color import no_style
+from django.db import connections, router, transaction, DEFAULT_DB_ALIAS
+from django.db.models import get_apps, get_models
+from django.test import TestCase, TransactionTestCase
+from django.test.testcases import connections_support_transactions, disable_transaction_methods
+from mule.contrib.django.writes import RecordingCursor, get_fixture_files, replay_writes
+
+import os, os.path
+
+def get_fixture_dirs():
+    """
+    Returns the directories ``loaddata`` searches for fixtures, in the same order.
+    """
+    dirs = [os.path.join(os.path.dirname(app.__file__), 'fixtures') for app in get_apps()]
+    dirs.extend(getattr(settings, 'FIXTURE_DIRS', ()))
+    dirs.append('')
+    return [d for d in dirs if not d or os.path.isdir(d)]
+
+class FixtureCache(object):
+    def __init__(self):
+        self.fixture_dirs = None
+        self.recordings = {}
+
+    def get_fixture_files(self, fixtures):
+        """
+        Returns the (path, mtime) of every file which ``loaddata`` could load for
+        the ``fixtures`` labels.
+        """
+        if self.fixture_dirs is None:
+            self.fixture_dirs = get_fixture_dirs()
+        return get_fixture_files(fixtures, self.fixture_dirs)
+
+    def load(self, fixtures, database=DEFAULT_DB_ALIAS, commit=True):
+        """
+        Loads ``fixtures`` into ``database`` as ``call_command('loaddata')`` would.
+        """
+        key = (database, tuple(fixtures), self.get_fixture_files(fixtures))
+        writes = self.recordings.get(key)
+        if writes is None:
+            self.recordings[key] = self.record(fixtures, database, commit)
+        else:
+            self.replay(writes, database, commit)
+
+    def record(self, fixtures, database, commit):
+        connection = connections[database]
+        writes = []
+        get_cursor = connection.cursor
+        connection.cursor = lambda: RecordingCursor(get_cursor(), writes)
+        try:
+            call_command('loaddata', *fixtures, **{'verbosity': 0, 'commit': commit, 'database': database})
+        finally:
+            connection.cursor = get_cursor
+        return writes
+
+    def replay(self, writes, database, commit):
+        if not writes:
+            return
+
+        connection = connections[database]
+        cursor = connection.cursor()
+        try:
+            tables = replay_writes(cursor, writes)
+
+            # As loaddata does, move sequences past the loaded rows
+            models = [m for m in get_models(include_auto_created=True)
+                      if m._meta.db_table in tables and router.allow_syncdb(database, m)]
+            for sql in connection.ops.sequence_reset_sql(no_style(), models):
+                cursor.execute(sql)
+        finally:
+            cursor.close()
+
+        if commit:
+            transaction.commit_unless_managed(using=database)
+
+def patch_fixture_setup(resetters=None, fixture_cache=None):
+    """
+    Replaces the fixture setup of ``TransactionTestCase`` and ``TestCase``, so that
+    databases are reset with ``resetters`` (by alias, see ``DatabaseResetter``) rather
+    than flushed before each test, and fixtures are loaded through ``fixture_cache``.
+    Returns a function which undoes the patch.
+    """
+    resetters = resetters or {}
+
+    def load_fixtures(test, db, commit=True):
+        if not hasattr(test, 'fixtures'):
+            return
+        if fixture_cache is not None:
+            fixture_cache.load(test.fixtures, db, commit=commit)
+        else:
+            call_command('loaddata', *test.fixtures, **{'verbosity': 0, 'commit': commit, 'database': db})
+
+    def get_databases(test):
+        # If the test case has a multi_db=True flag, setup all databases
+        if getattr(test, 'multi_db', False):
+            return connections
+        return [DEFAULT_DB_ALIAS]
+
+    # Mirrors TransactionTestCase._fixture_setup
+    def transaction_fixture_setup(self):
+        for db in get_databases(self):
+            resetter = resetters.get(db)
+            if resetter is None or not resetter.reset():
+                call_command('flush', verbosity=0, interactive=False, database=db)
+            load_fixtures(self, db)
+
+    # Mirrors TestCase._fixture_setup
+    def fixture_setup(self):
+        if not connections_support_transactions():
+            return transaction_fixture_setup(self)
+
+        databases = get_databases(self)
+        for db in databases:
+            transaction.enter_transaction_management(using=db)
+            transaction.managed(True, using=db)
+        disable_transaction_methods()
+
+        from django.contrib.sites.models import Site
+        Site.objects.clear_cache()
+
+        for db in databases:
+            load_fixtures(self, db, commit=False)
+
+    originals = (TransactionTestCase.__dict__['_fixture_setup'], TestCase.__dict__['_fixture_setup'])
+    TransactionTestCase._fixture_setup = transaction_fixture_setup
+    TestCase._fixture_setup = fixture_setup
+
+    def unpatch():
+        (TransactionTestCase._fixture_setup, TestCase._fixture_setup) = originals
+    return unpatch
@@ -1,13 +1,18 @@
 from __future__ import absolute_import
 
+from django.db.models import get_apps, get_models, signals
+from django.dispatch import saferef
 from django.test.simple import TEST_MODULE
 from imp import find_module
+from mule.contrib.django.registry import import_registered
 from mule.utils import import_string
 from mule.suite import defaultTestLoader
 
 import os, os.path
+import sys
 import types
 import unittest
+import weakref
 
 def get_test_module(module):
     try:
@@ -31,6 +36,56 @@ def get_test_module(module):
             raise
     return test_module
 
+def import_app_modules():
+    """
+    Imports the tests and management modules of every app.
+    """
+    for app in get_apps():
+        get_test_module(app)
+
+        # Import the 'management' module within each installed app, to register
+        # dispatcher events.
+        try:
+            import_string('%s.management' % app.__name__.rsplit('.', 1)[0])
+        except (ImportError, AttributeError):
+            pass
+
+def get_setup_modules():
+    """
+    Returns the names of the (already imported) modules which databases can't be set up
+    without: those defining models (e.g. tests modules with models of their own) or
+    ``post_syncdb`` receivers, and each app's management module.
+    """
+    modules = set()
+
+    for app in get_apps():
+        name = '%s.management' % app.__name__.rsplit('.', 1)[0]
+        if sys.modules.get(name) is not None:
+            modules.add(name)
+
+    for model in get_models(include_auto_created=True):
+        modules.add(model.__module__)
+
+    for key, receiver in signals.post_syncdb.receivers:
+        # Receivers are weakly referenced unless they were connected with weak=False
+        if isinstance(receiver, (weakref.ReferenceType, saferef.BoundMethodWeakref)):
+            receiver = receiver()
+        module = getattr(receiver, '__module__', None)
+        if module:
+            modules.add(module)
+
+    return sorted(modules)
+
+def import_setup_modules(path):
+    """
+    Imports the modules needed to set up databases (see ``get_setup_modules``).
+
+    They're found by importing every app's tests and management modules the first time,
+    and recorded at ``path`` so that later workers (e.g. the other slots of a build) only
+    import what they need, rather than every test in the project.
+    """
+    import_registered(path, import_app_modules, get_setup_modules)
+
 def get_test_by_name(label, loader=defaultTestLoader):
     """Construct a test case with the specified label. Label should be of the
     form model.TestClass or model.TestClass.test_method. Returns an
@@ -48,8 +103,11 @@ def get_test_by_name(label, loader=defaultTestLoader):
     
     if isinstance(imp, types.ModuleType):
         return loader.loadTestsFromModule(imp)
-    elif issubclass(imp, unittest.TestCase):
+    elif isinstance(imp, type) and issubclass(imp, unittest.TestCase):
         return loader.loadTestsFromTestCase(imp)
+    elif isinstance(imp, types.MethodType) and issubclass(imp.im_class, unittest.TestCase):
+        # path.to.TestCase.test_method (e.g. a TestCase which was split across jobs)
+        return imp.im_class(imp.__name__)
     elif issubclass(imp.__class__, unittest.TestCase):
         return imp.__class__(imp.__name__)
 
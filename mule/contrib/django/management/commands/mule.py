@@ -21,6 +21,18 @@ class Command(TestCommand):
                     default='default'),
         make_option('--db-prefix', type='string', dest='db_prefix', default='test',
                     help='Prefix to use for test databases. Default is ``test``.'),
+        make_option('--db-template', dest='db_template', action='store_true',
+                    help='Build the test databases once per build, and clone them for each worker (Postgres and SQLite only).'),
+        make_option('--keep-db', dest='keep_db', action='store_true',
+                    help='Keep test databases between builds, and reuse them for as long as the schema (models, migrations and initial data) is unchanged (Postgres and SQLite only, other databases are rebuilt for every build).'),
+        make_option('--fast-reset', dest='fast_reset', action='store_true',
+                    help='Reset databases between jobs (with warm workers) and TransactionTestCase tests by only emptying and restoring the tables which were written to.'),
+        make_option('--fixture-cache', dest='fixture_cache', action='store_true',
+                    help='Load each set of TestCase fixtures once per worker, and replay the statements it ran after that.'),
+        make_option('--db-pool', dest='db_pool', action='store_true',
+                    help='With multi-process, prepare each worker\'s databases ahead of time and lease them to workers as they start (not with --keep-db).'),
+        make_option('--prepare-slot', dest='prepare_slot', type='int', metavar="NUM",
+                    help='Identifies this runner as preparing the databases of slot NUM for a database pool.'),
         make_option('--distributed', dest='distributed', action='store_true',
                     help='Fire test jobs off to Celery queue and collect results.'),
         make_option('--multiprocess', dest='multiprocess', action='store_true',
@@ -41,6 +53,28 @@ class Command(TestCommand):
                     help='Specifies the workspace for this build.'),
         make_option('--runner', dest='runner', metavar="RUNNER",
                     help='Specify the test suite runner (use $TEST for path.to.TestCase substitution).'),
+        make_option('--split-methods', dest='split_methods', type='int', metavar="NUM",
+                    help='Split TestCases with more than NUM test methods into multiple jobs.'),
+        make_option('--batch', dest='batch', action='store_true',
+                    help='Pack small TestCases into a single job to amortize the cost of starting each job.'),
+        make_option('--speculative', dest='speculative', action='store_true',
+                    help='With distributed, re-run jobs which are taking much longer than expected on idle workers.'),
+        make_option('--compress', dest='compress', action='store_true',
+                    help='With distributed, compress large results sent through the result backend.'),
+        make_option('--timeout', dest='timeout', type='float', metavar="SECONDS",
+                    help='Kill jobs which run for longer than SECONDS and report them as errors.'),
+        make_option('--warm', dest='warm', action='store_true',
+                    help='With multi-process, keep a warm worker per process which runs many jobs.'),
+        make_option('--fork', dest='fork', action='store_true',
+                    help='With multi-process, fork workers from this process so tests are only imported once.'),
+        make_option('--auto-workers', dest='auto_workers', action='store_true',
+                    help='With multi-process and no --max-workers, run as many workers as there are idle CPUs and memory for.'),
+        make_option('--pin', dest='pin', action='store_true',
+                    help='With multi-process, pin each worker to its own CPUs.'),
+        make_option('--serve', dest='serve', action='store_true',
+                    help='Identifies this worker as a warm worker which reads jobs from stdin.'),
+        make_option('--warm-runner', dest='warm_runner', metavar="RUNNER",
+                    help='Specify the runner used to start warm workers.'),
     )
     
     def handle(self, *test_labels, **options):
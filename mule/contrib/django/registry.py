@@ -0,0 +1,49 @@
+"""
+The registry of the modules which databases can't be set up without, shared by the
+workers of a build so that only the first one has to import every app's tests (see
+``mule.contrib.django.loader.import_setup_modules``).
+
+Nothing here depends on Django.
+"""
+from __future__ import absolute_import
+
+from mule.utils.locking import LOCK_DIR
+
+import json
+import os, os.path
+import tempfile
+
+def get_registry_path(build_id):
+    # Removed with the build's other files (see ``mule.utils.processes.BUILD_FILES``)
+    return os.path.join(LOCK_DIR, 'mule:setup_modules_%s.json' % (build_id,))
+
+def import_registered(path, import_all, get_modules):
+    """
+    Imports the modules recorded at ``path``. If there's no (readable) registry, or one
+    of its modules can't be imported, ``import_all()`` is called instead and the names
+    returned by ``get_modules()`` afterwards are recorded for later workers.
+    """
+    modules = None
+    try:
+        with open(path, 'r') as fp:
+            modules = json.load(fp)
+    except (IOError, ValueError):
+        pass
+
+    if modules is not None:
+        try:
+            for name in modules:
+                __import__(name)
+        except ImportError:
+            pass
+        else:
+            return
+
+    import_all()
+
+    # Written to a temporary file first so other workers never see a partial registry
+    dirname = os.path.dirname(os.path.abspath(path))
+    (h, tmp_path) = tempfile.mkstemp(prefix='setup_modules', dir=dirname)
+    with os.fdopen(h, 'w') as fp:
+        json.dump(get_modules(), fp)
+    os.rename(tmp_path, path)
@@ -0,0 +1,128 @@
+"""
+Fast resets of test databases between jobs.
+
+Rather than flushing every table and reloading initial data (``call_command('flush')``),
+the tables each job writes to are tracked, and only those are emptied (in a single
+batch per database) and refilled from a snapshot of the data they started with. The
+same goes for the flush ``TransactionTestCase`` does before each test (see
+``mule.contrib.django.fixtures.patch_fixture_setup``).
+"""
+from __future__ import absolute_import
+
+from django.core.management.color import no_style
+from django.db import connections, router, transaction
+from django.db.models import get_models
+from mule.contrib.django.database import get_engine
+from mule.contrib.django.writes import SCHEMA_RE, TRUNCATE_RE, WRITE_RE, TrackingCursor, \
+                                       get_restore_order, get_tables_to_reset
+
+class DatabaseResetter(object):
+    """
+    Resets the database of ``alias`` to the state it was in when the resetter was
+    created (e.g. just after syncdb), by only emptying and restoring the tables which
+    have been written to since.
+
+    Writes are tracked through the connection's cursors, so anything written through
+    the raw DB-API connection is missed.
+    """
+    def __init__(self, alias):
+        self.alias = alias
+        self.connection = connections[alias]
+
+        self.models = [m for m in get_models(include_auto_created=True)
+                       if router.allow_syncdb(alias, m)]
+        self.tables = set(self.connection.introspection.django_table_names(only_existing=True))
+        self.sequences = self.connection.introspection.sequence_list()
+
+        # Tables which have to be emptied along with each table, as they reference it
+        self.referencing = {}
+        for model in self.models:
+            for f in model._meta.local_fields:
+                if f.rel:
+                    self.referencing.setdefault(f.rel.to._meta.db_table, set()).add(model._meta.db_table)
+
+        self.written = set()
+        self.schema_changed = False
+
+        self.get_cursor = self.connection.cursor
+        self.snapshot = self.take_snapshot()
+        self.connection.cursor = lambda: TrackingCursor(self.get_cursor(), self)
+
+    def track(self, sql):
+        match = WRITE_RE.match(sql)
+        if match:
+            self.written.add(match.group(1))
+        elif TRUNCATE_RE.match(sql):
+            self.written.update(self.tables)
+        elif SCHEMA_RE.match(sql):
+            self.schema_changed = True
+
+    def take_snapshot(self):
+        """
+        Returns the columns and rows of each table which isn't empty.
+        """
+        qn = self.connection.ops.quote_name
+        snapshot = {}
+        cursor = self.get_cursor()
+        try:
+            for table in self.tables:
+                cursor.execute("SELECT * FROM %s" % (qn(table),))
+                rows = cursor.fetchall()
+                if rows:
+                    snapshot[table] = ([d[0] for d in cursor.description], rows)
+        finally:
+            cursor.close()
+        return snapshot
+
+    def get_tables_to_reset(self):
+        return get_tables_to_reset(self.written, self.tables, self.referencing)
+
+    def reset(self):
+        """
+        Empties and restores the tables which have been written to. Returns False if
+        the database can't be reset this way (e.g. its schema was changed), in which
+        case it needs flushing.
+        """
+        if self.schema_changed:
+            return False
+
+        tables = self.get_tables_to_reset()
+        if not tables:
+            return True
+
+        connection = self.connection
+        qn = connection.ops.quote_name
+        style = no_style()
+
+        sequences = [s for s in self.sequences if s['table'] in tables]
+        statements = connection.ops.sql_flush(style, sorted(tables), sequences)
+
+        cursor = self.get_cursor()
+        try:
+            if get_engine(connection) == 'postgresql':
+                # psycopg2 sends all of the statements in a single round trip
+                cursor.execute('\n'.join(statements))
+            else:
+                for sql in statements:
+                    cursor.execute(sql)
+
+            restored = set()
+            # Rows are restored before the rows which reference them
+            for table in get_restore_order(tables, self.referencing):
+                if table not in self.snapshot:
+                    continue
+                (columns, rows) = self.snapshot[table]
+                cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" % (
+                    qn(table), ', '.join(qn(c) for c in columns), ', '.join(['%s'] * len(columns))), rows)
+                restored.add(table)
+
+            # Sequences were reset by the flush, so move them past the restored rows
+            for sql in connection.ops.sequence_reset_sql(style, [m for m in self.models
+                                                                 if m._meta.db_table in restored]):
+                cursor.execute(sql)
+        finally:
+            cursor.close()
+
+        transaction.commit_unless_managed(using=self.alias)
+        self.written.clear()
+        return True
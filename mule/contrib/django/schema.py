@@ -0,0 +1,63 @@
+"""
+Fingerprints of the schema test databases are built with, which tell whether a kept
+database (see ``mule.contrib.django.database``) can be reused.
+"""
+from __future__ import absolute_import
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models import get_apps, get_models
+
+import glob
+import hashlib
+import os, os.path
+
+def get_database_aliases():
+    """
+    Returns the aliases of the databases which need to be created (i.e. those which
+    aren't mirrors of another).
+    """
+    # Mirrors are replaced by proxies of the database they mirror once set up, so settings
+    # are checked rather than the connections
+    return [alias for alias in connections if not settings.DATABASES[alias].get('TEST_MIRROR')]
+
+def _get_schema_files(app):
+    """
+    Returns the files (other than models) which determine what syncdb creates for
+    ``app``: its South migrations and initial data fixtures.
+    """
+    app_dir = os.path.dirname(app.__file__)
+    paths = glob.glob(os.path.join(app_dir, 'migrations', '*.py'))
+    paths.extend(glob.glob(os.path.join(app_dir, 'fixtures', 'initial_data.*')))
+    return sorted(paths)
+
+def get_schema_fingerprint(alias):
+    """
+    Returns a hash of everything which determines the contents of a freshly built
+    database for ``alias``: the tables and columns of its models, South migrations and
+    initial data fixtures.
+    """
+    connection = connections[alias]
+    fingerprint = hashlib.sha1()
+
+    paths = []
+    for app in get_apps():
+        for model in get_models(app, include_auto_created=True):
+            if not router.allow_syncdb(alias, model):
+                continue
+            opts = model._meta
+            fingerprint.update('table %s\n' % opts.db_table)
+            for f in opts.local_fields:
+                fingerprint.update('column %s %s %s %s %s\n' % (f.column, f.db_type(connection=connection),
+                                                               f.null, f.unique, f.db_index))
+        paths.extend(_get_schema_files(app))
+
+    for fixture_dir in getattr(settings, 'FIXTURE_DIRS', ()):
+        paths.extend(sorted(glob.glob(os.path.join(fixture_dir, 'initial_data.*'))))
+
+    for path in paths:
+        fingerprint.update('file %s\n' % path)
+        with open(path, 'rb') as fp:
+            fingerprint.update(fp.read())
+
+    return fingerprint.hexdigest()
@@ -1,25 +1,37 @@
 from __future__ import absolute_import
 
+from django.db import connections
 from django.db.models import get_app, get_apps
+from django.test import TestCase, TransactionTestCase
 from django.test.simple import DjangoTestSuiteRunner, build_suite
 from django.test._doctest import DocTestCase
 from mule import conf
 from mule.contextmanager import register_context_manager
-from mule.contrib.django.contextmanager import DatabaseContextManager, EnvContextManager
+from mule.contrib.django.contextmanager import DatabaseContextManager, EnvContextManager, \
+                                               drop_templates
+from mule.contrib.django.database import get_template_prefix
 from mule.contrib.django.signals import post_test_setup
 from mule.contrib.django.loader import get_test_by_name
 from mule.suite import MuleTestLoader
 from mule.loader import reorder_suite
+from mule.tasks import execute_bash
+from mule.utils.slotpool import SlotPool, get_pool_path
 
+import multiprocessing
 import unittest
 import unittest2
+import uuid
 
 DEFAULT_RUNNER = 'python manage.py mule --auto-bootstrap --worker --id=$BUILD_ID $TEST'
+DEFAULT_WARM_RUNNER = 'python manage.py mule --auto-bootstrap --worker --serve --id=$BUILD_ID'
+DEFAULT_PREPARE_RUNNER = 'python manage.py mule --auto-bootstrap --prepare-slot=$SLOT --id=$BUILD_ID'
 
 def mule_suite_runner(parent):
     class new(MuleTestLoader, parent):
         def __init__(self, auto_bootstrap=False, db_prefix='test', runner=DEFAULT_RUNNER,
-                     *args, **kwargs):
+                     warm_runner=DEFAULT_WARM_RUNNER, db_template=False, keep_db=False,
+                     fast_reset=False, fixture_cache=False, db_pool=False, prepare_slot=None,
+                     prepare_runner=None, *args, **kwargs):
             MuleTestLoader.__init__(self, *args, **kwargs)
             parent.__init__(self,
                 verbosity=int(kwargs['verbosity']),
@@ -28,18 +40,64 @@ def mule_suite_runner(parent):
             )
             self.auto_bootstrap = auto_bootstrap
 
-            if self.auto_bootstrap:
+            # Reuse test databases between builds for as long as the schema is unchanged
+            self.keep_db = keep_db
+            # Only empty (and restore) the tables which were written to, between jobs and
+            # before each TransactionTestCase test
+            self.fast_reset = fast_reset
+            # Record the statements loading each set of fixtures runs, and replay them
+            self.fixture_cache = fixture_cache
+            # Lease each worker a slot whose databases were prepared ahead of time. Kept
+            # databases are shared between builds, so they're never pooled.
+            self.db_pool = db_pool and not keep_db
+            self.prepare_slot = prepare_slot
+
+            if self.auto_bootstrap or self.keep_db:
                 self.interactive = False
 
             self.db_prefix = db_prefix
+            # Clone each slot's databases from a template built once per build
+            self.db_template = db_template
 
             if not runner and self.workspace:
                 runner = conf.WORKSPACES[self.workspace].get('runner') or DEFAULT_RUNNER
 
             self.base_cmd = runner or DEFAULT_RUNNER
 
+            if not warm_runner and self.workspace:
+                warm_runner = conf.WORKSPACES[self.workspace].get('warm_runner') or DEFAULT_WARM_RUNNER
+
+            self.warm_cmd = warm_runner or DEFAULT_WARM_RUNNER
+
+            if not prepare_runner and self.workspace:
+                prepare_runner = conf.WORKSPACES[self.workspace].get('prepare_runner') or DEFAULT_PREPARE_RUNNER
+
+            self.prepare_cmd = prepare_runner or DEFAULT_PREPARE_RUNNER
+
             if self.failfast:
                 self.base_cmd += ' --failfast'
+                self.warm_cmd += ' --failfast'
+
+            if self.db_template:
+                self.base_cmd += ' --db-template'
+                self.warm_cmd += ' --db-template'
+                self.prepare_cmd += ' --db-template'
+
+            if self.keep_db:
+                self.base_cmd += ' --keep-db'
+                self.warm_cmd += ' --keep-db'
+
+            if self.fast_reset:
+                self.base_cmd += ' --fast-reset'
+                self.warm_cmd += ' --fast-reset'
+
+            if self.fixture_cache:
+                self.base_cmd += ' --fixture-cache'
+                self.warm_cmd += ' --fixture-cache'
+
+            if self.db_pool:
+                self.base_cmd += ' --db-pool'
+                self.warm_cmd += ' --db-pool'
             
         def run_suite(self, suite, **kwargs):
             run_callback = lambda x: post_test_setup.send(sender=type(x), runner=x)
@@ -77,10 +135,72 @@ def mule_suite_runner(parent):
                     continue
                 new_suite.addTest(test)
 
-            return reorder_suite(new_suite, (unittest.TestCase,))
+            # TransactionTestCase's flush the databases, so they're run after the TestCase's
+            # (which roll back) as Django does
+            return reorder_suite(new_suite, (TestCase,))
+
+        def get_job_group(self, cls):
+            # Keeps TransactionTestCase's in jobs of their own, so a TestCase is never
+            # slowed down by (or run after) the flushes they do
+            if issubclass(cls, TransactionTestCase) and not issubclass(cls, TestCase):
+                return 'transaction'
+            return None
+
+        def serve_forked(self):
+            # Connections we inherited are still in use by the parent, so they're
+            # abandoned (rather than closed) and each worker opens its own
+            for alias in connections:
+                connections[alias].connection = None
+
+            return MuleTestLoader.serve_forked(self)
+
+        def prepare_slot_databases(self, build_id, num):
+            (stdout, stderr, returncode, rusage) = execute_bash(
+                name='prepare.sh',
+                script=self.prepare_cmd,
+                workspace=self.workspace,
+                logger=self.logger,
+                BUILD_ID=build_id,
+                SLOT=str(num),
+            )
+            if returncode != 0:
+                raise Exception('Preparing slot %d failed: %s' % (num, stderr))
+
+        def run_distributed_tests(self, test_labels, extra_tests=None, in_process=False, **kwargs):
+            build_id = uuid.uuid4().hex
+
+            pool = None
+            old_build_id = self.build_id
+            if in_process and self.db_pool:
+                pool = SlotPool(self.max_workers or multiprocessing.cpu_count(),
+                                lambda num: self.prepare_slot_databases(build_id, num),
+                                get_pool_path(build_id), logger=self.logger, build_id=build_id,
+                                lock_setting='db')
+                pool.start()
+                # Workers forked from us (with --fork) lease slots with our build id
+                self.build_id = build_id
+
+            try:
+                return MuleTestLoader.run_distributed_tests(self, test_labels, extra_tests,
+                                                            in_process=in_process, build_id=build_id,
+                                                            **kwargs)
+            finally:
+                if pool is not None:
+                    self.build_id = old_build_id
+                    pool.stop()
+                if self.db_template:
+                    # Workers share our database servers, unless their settings say otherwise
+                    drop_templates(get_template_prefix(self.db_prefix, build_id))
 
         def run_tests(self, *args, **kwargs):
             register_context_manager(EnvContextManager)
+
+            if self.prepare_slot is not None:
+                # Only sets up (or cleans) the slot's databases, for a slot pool
+                cm = DatabaseContextManager(build_id=self.build_id, suite=self)
+                cm.__enter__()
+                cm.__exit__(None, None, None)
+                return 0
             
             # Ensure our db setup/teardown manager is registered
             if not (self.distributed or self.multiprocess):
@@ -0,0 +1,147 @@
+"""
+Tracking of the tables which are written to through a cursor, and of what has to be
+emptied and restored to undo those writes (see ``mule.contrib.django.reset``), along
+with the recording and replaying of writes (see ``mule.contrib.django.fixtures``).
+
+Nothing here depends on Django.
+"""
+from __future__ import absolute_import
+
+import glob
+import os, os.path
+import re
+
+# Statements which write to a table, capturing its (possibly quoted) name
+WRITE_RE = re.compile(r'^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|REPLACE\s+INTO)\s+[`"\[]?([^\s`"\],;(]+)', re.I)
+# Statements which may write to any (or every) table
+TRUNCATE_RE = re.compile(r'^\s*TRUNCATE\s', re.I)
+# Statements which change the schema, which emptying tables can't undo
+SCHEMA_RE = re.compile(r'^\s*(?:CREATE|DROP|ALTER)\s', re.I)
+
+class TrackingCursor(object):
+    """
+    Wraps a cursor, reporting the statements run through it to ``tracker`` (e.g. a
+    ``DatabaseResetter``), which has a ``track(sql)`` method.
+    """
+    def __init__(self, cursor, tracker):
+        self.cursor = cursor
+        self.tracker = tracker
+
+    def execute(self, sql, params=()):
+        self.tracker.track(sql)
+        return self.cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.tracker.track(sql)
+        return self.cursor.executemany(sql, param_list)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+class RecordingCursor(object):
+    """
+    Wraps a cursor, recording the writes run through it as a list of (sql, [params, ...])
+    with consecutive runs of the same statement grouped together.
+    """
+    def __init__(self, cursor, writes):
+        self.cursor = cursor
+        self.writes = writes
+
+    def _record(self, sql, param_list):
+        if not WRITE_RE.match(sql):
+            return
+        if self.writes and self.writes[-1][0] == sql:
+            self.writes[-1][1].extend(param_list)
+        else:
+            self.writes.append((sql, list(param_list)))
+
+    def execute(self, sql, params=()):
+        result = self.cursor.execute(sql, params)
+        self._record(sql, [tuple(params)])
+        return result
+
+    def executemany(self, sql, param_list):
+        param_list = [tuple(p) for p in param_list]
+        result = self.cursor.executemany(sql, param_list)
+        self._record(sql, param_list)
+        return result
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def replay_writes(cursor, writes):
+    """
+    Runs the ``writes`` recorded by a ``RecordingCursor`` (one ``executemany`` per
+    statement) and returns the tables they wrote to.
+    """
+    tables = set()
+    for sql, param_list in writes:
+        cursor.executemany(sql, param_list)
+        tables.add(WRITE_RE.match(sql).group(1))
+    return tables
+
+def get_fixture_files(labels, fixture_dirs):
+    """
+    Returns the (path, mtime) of every file in ``fixture_dirs`` which ``loaddata``
+    could load for the fixture ``labels``, so that recordings of loading them can be
+    told apart from those of older versions.
+    """
+    files = set()
+    for label in labels:
+        if os.path.isabs(label):
+            dirs = ['']
+        else:
+            dirs = fixture_dirs
+        for fixture_dir in dirs:
+            for path in glob.glob(os.path.join(fixture_dir, label) + '*'):
+                files.add((path, os.path.getmtime(path)))
+    return tuple(sorted(files))
+
+def get_tables_to_reset(written, tables, referencing):
+    """
+    Returns the tables which have to be emptied to undo writes to ``written``: those
+    of ``tables`` which were written to, along with every table which references them
+    (``referencing`` maps a table to those with foreign keys to it), as emptying a
+    table empties those too.
+    """
+    reset = set()
+    pending = list(set(written) & set(tables))
+    while pending:
+        table = pending.pop()
+        if table in reset:
+            continue
+        reset.add(table)
+        pending.extend(referencing.get(table, ()))
+    return reset
+
+def get_restore_order(tables, referencing):
+    """
+    Returns ``tables`` in the order their rows should be restored in, so that each
+    table comes after those it references (``referencing`` is as for
+    ``get_tables_to_reset``). Tables which reference each other are restored in
+    name order.
+    """
+    references = {}
+    for table, referenced_by in referencing.iteritems():
+        for other in referenced_by:
+            if other != table and other in tables and table in tables:
+                references.setdefault(other, set()).add(table)
+
+    remaining = sorted(tables)
+    ordered = []
+    while remaining:
+        for table in remaining:
+            if not references.get(table, set()).difference(ordered):
+                break
+        else:
+            # A cycle
+            table = remaining[0]
+        remaining.remove(table)
+        ordered.append(table)
+    return ordered
@@ -0,0 +1,307 @@
+from __future__ import absolute_import
+
+from mule import conf
+from mule.runners.text import _TextTestResult
+from mule.runners.xml import build_report, get_report_name, get_report_timings, merge_reports, \
+                             split_reports
+from xml.dom.minidom import parseString
+
+import heapq
+import os, os.path
+import re
+import sys
+import threading
+
+# (title, format, function of a job's rusage) for each resource in the report
+RUSAGE_REPORTS = (
+    ('CPU time', '%.3fs', lambda r: r['utime'] + r['stime']),
+    ('max RSS', '%.1fMB', lambda r: r['maxrss'] / 1024.0),
+    ('block I/O operations', '%d', lambda r: r['inblock'] + r['oublock']),
+    ('context switches', '%d', lambda r: r['nvcsw'] + r['nivcsw']),
+)
+
+class ResultAggregator(object):
+    """
+    Aggregates the results of a distributed build as each job's result arrives.
+
+    Counters are updated, xunit reports are written and failures are printed
+    straight away, so nothing but the counters needs to be kept around until
+    the end of the build.
+    """
+    def __init__(self, xunit=False, xunit_output=None, stream=None, rusage_report_size=None):
+        self.xunit = xunit
+        self.xunit_output = xunit_output
+        self.stream = stream or sys.stdout
+
+        self.failures, self.errors = 0, 0
+        self.skips, self.tests = 0, 0
+
+        self.had_res = False
+
+        # The most expensive jobs for each resource, as a min-heap of (usage, job)
+        if rusage_report_size is None:
+            rusage_report_size = conf.RUSAGE_REPORT_SIZE
+        self.rusage_report_size = rusage_report_size
+        self.rusage = [[] for r in RUSAGE_REPORTS]
+
+        # Reports which have been written during this run (split TestCase's are merged)
+        self.written = set()
+
+        # Results may be reported from multiple threads (e.g. with --multiprocess)
+        self.lock = threading.Lock()
+
+        # Bootstrap our xunit output path
+        if self.xunit and not os.path.exists(self.xunit_output):
+            os.makedirs(self.xunit_output)
+
+    def add(self, r):
+        """
+        Aggregates a single ``run_test`` result, and returns the number of failures
+        and errors it contained.
+        """
+        with self.lock:
+            failures, errors = self.failures, self.errors
+            self._add(r)
+            return (self.failures - failures) + (self.errors - errors)
+
+    def _add(self, r):
+        write = self.stream.write
+
+        if not isinstance(r, dict):
+            # Handles cases when our runners dont return correct output
+            self.had_res = True
+            write(_TextTestResult.separator1 + '\n')
+            write('EXCEPTION: unknown exception\n')
+            if r:
+                write(_TextTestResult.separator1 + '\n')
+                write(str(r).strip() + '\n')
+            self.errors += 1
+            self.tests += 1
+            return
+
+        if r.get('rusage') and self.rusage_report_size:
+            self._add_rusage(r)
+
+        if r.get('timeout') is not None:
+            self._add_timeout(r)
+            return
+
+        if r.get('report') is not None:
+            self._add_report(r)
+            return
+
+        # Runners which don't give us a structured report return XML
+        reports = split_reports(r['stdout'])
+
+        # XXX: stdout (which is our result) is in XML, which sucks life is easier with regexp
+        timings = {}
+        for report in reports:
+            match = re.search(r'errors="(\d+)".*failures="(\d+)".*skips="(\d+)".*tests="(\d+)"', report)
+            if match:
+                self.errors += int(match.group(1))
+                self.failures += int(match.group(2))
+                self.skips += int(match.group(3))
+                self.tests += int(match.group(4))
+            timings.update(get_report_timings(report))
+        if timings:
+            # Lets our timing store tell test time apart from the job's overhead
+            r['timings'] = timings
+
+        if self.xunit:
+            # Since we already get xunit results back, let's just write them to disk
+            if reports:
+                # Batched jobs return a report for each TestCase
+                for content in reports:
+                    self._write_report(r, content)
+            elif r['stderr']:
+                sys.stderr.write(r['stderr'])
+                # Need to track this for the builds
+                self.errors += 1
+                self.tests += 1
+        elif reports:
+            # HACK: Ideally we would let our default text runner represent us here, but that'd require
+            #       reconstructing the original objects which is even more of a hack
+            for report in reports:
+                self._print_report(r, report)
+        elif r['stderr']:
+            self.had_res = True
+            write(_TextTestResult.separator1 + '\n')
+            write('EXCEPTION: %s\n' % r['job'])
+            write(_TextTestResult.separator1 + '\n')
+            write(r['stderr'].strip() + '\n')
+            self.errors += 1
+            self.tests += 1
+
+    def _add_rusage(self, r):
+        for (title, fmt, func), heap in zip(RUSAGE_REPORTS, self.rusage):
+            try:
+                item = (func(r['rusage']), r['job'])
+            except (KeyError, TypeError):
+                # From a worker running an older version
+                return
+            if len(heap) < self.rusage_report_size:
+                heapq.heappush(heap, item)
+            else:
+                heapq.heappushpop(heap, item)
+
+    def _write_rusage_report(self):
+        write = self.stream.write
+
+        for (title, fmt, func), heap in zip(RUSAGE_REPORTS, self.rusage):
+            if not heap:
+                continue
+            write('\nTop jobs by %s:\n' % title)
+            for usage, job in sorted(heap, reverse=True):
+                write('  %12s  %s\n' % (fmt % usage, job))
+
+    def _add_timeout(self, r):
+        # Whatever the job managed to report is incomplete, so the job as a whole is an error
+        self.had_res = True
+        self.errors += 1
+        self.tests += 1
+
+        write = self.stream.write
+        write(_TextTestResult.separator1 + '\n')
+        write('TIMEOUT [%.3fs]: %s\n' % (r['timeout'], r['job']))
+        if r['stderr']:
+            # Includes the stacks the job dumped before it was killed
+            write(_TextTestResult.separator2 + '\n')
+            write(r['stderr'].strip() + '\n')
+
+    def _add_report(self, r):
+        report = r['report']
+
+        self.errors += report['errors']
+        self.failures += report['failures']
+        self.skips += report['skips']
+        self.tests += report['tests']
+
+        timings = {}
+        for testsuite in report['testsuites']:
+            timings[testsuite['name']] = testsuite['time']
+            for test in testsuite['tests']:
+                timings['%s.%s' % (testsuite['name'], test['name'])] = test['time']
+        if timings:
+            # Lets our timing store tell test time apart from the job's overhead
+            r['timings'] = timings
+
+        for testsuite in report['testsuites']:
+            if self.xunit:
+                self._write_report(r, build_report(testsuite))
+            else:
+                self._print_testsuite(r, testsuite)
+
+    def _print_testsuite(self, r, testsuite):
+        write = self.stream.write
+
+        failed = False
+        for test in testsuite['tests']:
+            if test['outcome'] == 'success':
+                continue
+            self.had_res = True
+            failed = failed or test['outcome'] in ('failure', 'error')
+            write(_TextTestResult.separator1 + '\n')
+            write('%s [%.3fs]: %s (%s)\n' % (test['outcome'].upper(), test['time'], test['name'], testsuite['name']))
+            write('(Job was %s)\n' % r['job'])
+            if test['traceback'].strip():
+                write(_TextTestResult.separator2 + '\n')
+                write('%s\n' % test['traceback'].strip())
+
+        if failed and testsuite['stderr']:
+            write(_TextTestResult.separator2 + '\n')
+            write('%s\n' % testsuite['stderr'])
+
+    def _write_report(self, r, content):
+        name = get_report_name(content) or r['job']
+        path = os.path.join(self.xunit_output, name + '.xml')
+        if name in self.written:
+            fp = open(path, 'r')
+            try:
+                content = merge_reports(fp.read(), content)
+            finally:
+                fp.close()
+        self.written.add(name)
+        fp = open(path, 'w')
+        try:
+            fp.write(content)
+        finally:
+            fp.close()
+
+    def _print_report(self, r, report):
+        write = self.stream.write
+
+        try:
+            xml = parseString(report)
+        except Exception, e:
+            self.had_res = True
+            write(_TextTestResult.separator1 + '\n')
+            write('EXCEPTION: %s (%s)\n' % (e, r['job']))
+            write(_TextTestResult.separator1 + '\n')
+            write(report.strip() + '\n')
+            if r['stderr']:
+                write(_TextTestResult.separator1 + '\n')
+                write(r['stderr'].strip() + '\n')
+            self.errors += 1
+            self.tests += 1
+            return
+
+        res_type = None
+        for xml_test in xml.getElementsByTagName('testcase'):
+            for xml_test_res in xml_test.childNodes:
+                if xml_test_res.nodeName not in ('failure', 'skip', 'error'):
+                    continue
+                self.had_res = True
+                res_type = xml_test_res.nodeName
+                desc = '%s (%s)' % (xml_test.getAttribute('name'), xml_test.getAttribute('classname'))
+                write(_TextTestResult.separator1 + '\n')
+                write('%s [%.3fs]: %s\n' % \
+                    (xml_test_res.nodeName.upper(), float(xml_test.getAttribute('time') or '0.0'), desc))
+                write('(Job was %s)\n' % r['job'])
+                error_msg = (''.join(c.wholeText for c in xml_test_res.childNodes if c.nodeType == c.CDATA_SECTION_NODE)).strip()
+                if error_msg:
+                    write(_TextTestResult.separator2 + '\n')
+                    write('%s\n' % error_msg)
+
+        if res_type in ('failure', 'error'):
+            syserr = (''.join(c.wholeText for c in xml.getElementsByTagName('system-err')[0].childNodes if c.nodeType == c.CDATA_SECTION_NODE)).strip()
+            if syserr:
+                write(_TextTestResult.separator2 + '\n')
+                write('%s\n' % syserr)
+
+    def summary(self, total_time):
+        """
+        Writes the summary of the build, and returns the number of failures and errors.
+        """
+        write = self.stream.write
+
+        failures, errors = self.failures, self.errors
+        skips, tests = self.skips, self.tests
+
+        if self.had_res:
+            write(_TextTestResult.separator2 + '\n')
+
+        self._write_rusage_report()
+
+        run = tests - skips
+        write("\nRan %d test%s in %.3fs\n\n" % (run, run != 1 and "s" or "", total_time))
+
+        if errors or failures:
+            write("FAILED (")
+            if failures:
+                write("failures=%d" % failures)
+            if errors:
+                if failures:
+                    write(", ")
+                write("errors=%d" % errors)
+            if skips:
+                if failures or errors:
+                    write(", ")
+                write("skipped=%d" % skips)
+            write(")")
+        else:
+            write("OK")
+            if skips:
+                write(" (skipped=%d)" % skips)
+
+        write('\n\n')
+        return failures + errors
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""A test runner which reports results as a single JSON document, which is what
+workers send back to be aggregated.
+
+The document looks like::
+
+    {
+        "tests": 2, "failures": 1, "errors": 0, "skips": 0,
+        "testsuites": [{
+            "name": "path.to.TestCase", "time": 0.5,
+            "stdout": "...", "stderr": "...",
+            "tests": [{
+                "name": "test_method", "time": 0.25, "outcome": "failure",
+                "type": "AssertionError", "message": "...", "traceback": "..."
+            }, ...]
+        }, ...]
+    }
+"""
+from __future__ import absolute_import
+
+import json
+
+from mule import conf
+from mule.runners.text import _TextTestResult, TextTestRunner, _TestInfo
+from mule.utils.output import truncate_output
+
+OUTCOMES = {
+    _TestInfo.SUCCESS: 'success',
+    _TestInfo.FAILURE: 'failure',
+    _TestInfo.ERROR: 'error',
+    _TestInfo.SKIPPED: 'skip',
+}
+
+def _exc_message(value):
+    "Returns the message of the exception ``value``, whatever it was made from."
+    try:
+        return unicode(value)
+    except UnicodeError:
+        # A message of non-ASCII bytes
+        return str(value).decode('utf-8', 'replace')
+    except Exception:
+        return '<unprintable %s object>' % type(value).__name__
+
+class _JSONTestResult(_TextTestResult):
+    "A test result class that can express test results as a JSON document."
+
+    def get_report(self):
+        "Returns the results of the run, grouped by TestCase."
+        testsuites = []
+        testsuites_by_name = {}
+        
+        for tests in (self.successes, self.failures, self.errors, self.skipped):
+            for test_info in tests:
+                testcase = type(test_info.test_method)
+                
+                # Ignore module name if it is '__main__'
+                module = testcase.__module__ + '.'
+                if module == '__main__.':
+                    module = ''
+                testcase_name = module + testcase.__name__
+
+                if testcase_name not in testsuites_by_name:
+                    testsuite = testsuites_by_name[testcase_name] = {
+                        'name': testcase_name,
+                        'time': 0.0,
+                        'tests': [],
+                        'stdout': [],
+                        'stderr': [],
+                    }
+                    testsuites.append(testsuite)
+                testsuite = testsuites_by_name[testcase_name]
+
+                test = {
+                    'name': test_info.test_method._testMethodName,
+                    'time': test_info.get_elapsed_time(),
+                    'outcome': OUTCOMES[test_info.outcome],
+                }
+                if test_info.outcome != _TestInfo.SUCCESS:
+                    test['type'] = test_info.err[0].__name__
+                    test['message'] = _exc_message(test_info.err[1])
+                    test['traceback'] = test_info.get_error_info()
+
+                testsuite['tests'].append(test)
+                testsuite['time'] += test['time']
+                testsuite['stdout'].append(test_info.test_method.stdout.getvalue())
+                testsuite['stderr'].append(test_info.test_method.stderr.getvalue())
+
+        # The report is never truncated as a whole (it couldn't be parsed), so the output
+        # it carries is bounded here instead
+        for testsuite in testsuites:
+            testsuite['stdout'] = truncate_output('\n'.join(filter(None, testsuite['stdout'])).strip(),
+                                                  conf.STDERR_LIMIT)
+            testsuite['stderr'] = truncate_output('\n'.join(filter(None, testsuite['stderr'])).strip(),
+                                                  conf.STDERR_LIMIT)
+
+        return {
+            'tests': sum(len(t) for t in (self.successes, self.failures, self.errors, self.skipped)),
+            'failures': len(self.failures),
+            'errors': len(self.errors),
+            'skips': len(self.skipped),
+            'testsuites': testsuites,
+        }
+
+class JSONTestRunner(TextTestRunner):
+    """A test runner class that writes its results as JSON to ``output``."""
+    def __init__(self, output=None, **kwargs):
+        super(JSONTestRunner, self).__init__(**kwargs)
+        self.output = output
+
+    def _makeResult(self):
+        """Create the TestResult object which will be used to store
+        information about the executed tests.
+        """
+        return _JSONTestResult(self.stream, self.descriptions, \
+            self.verbosity, self.elapsed_times)
+
+    def run(self, test):
+        "Run the given test case or test suite."
+        result = super(JSONTestRunner, self).run(test)
+
+        self.output.write(json.dumps(result.get_report()))
+        return result
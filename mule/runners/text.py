@@ -26,11 +26,15 @@ class _TestInfo(object):
         self.err = err
         self.stdout = StringIO()
         self.stderr = StringIO()
+        # Set once the test has stopped, as the result's times move on to the next test
+        self.elapsed_time = None
     
     def get_elapsed_time(self):
         """Return the time that shows how long the test method took to
         execute.
         """
+        if self.elapsed_time is not None:
+            return self.elapsed_time
         if getattr(self.test_result, 'stop_time', None):
             return self.test_result.stop_time - self.test_result.start_time
         return 0
@@ -75,6 +79,8 @@ class _TextTestResult(_TextTestResult):
             # Ignore the elapsed times for a more reliable unit testing
             if not self.elapsed_times:
                 self.start_time = self.stop_time = 0
+
+            test_info.elapsed_time = test_info.get_elapsed_time()
             
             if self.showAll:
                 self.stream.writeln('%s (%.3fs)' % \
@@ -41,9 +41,126 @@ if __name__ == '__main__':
 """
 
 import os
+import re
 
 from mule.runners.text import _TextTestResult, TextTestRunner, _TestInfo
 
+def get_report_name(xml_content):
+    "Returns the testsuite name of a XML report."
+    match = re.search(r'<testsuite[^>]*\sname="([^"]+)"', xml_content)
+    if match:
+        return match.group(1)
+
+def split_reports(content):
+    """Splits the output of a job, which contains a XML report for each
+    TestCase that was run, into a list of individual reports.
+    """
+    parts = content.split('<?xml')
+    reports = ['<?xml' + r for r in parts[1:] if r.strip()]
+    if parts[0].strip():
+        # Anything which isn't a report is kept so it can be reported as an error
+        reports.insert(0, parts[0])
+    return reports
+
+def get_report_timings(xml_content):
+    """Returns a dict mapping the testsuite, and each of its test methods
+    (path.to.TestCase.test_method), to the time they took to run.
+    """
+    timings = {}
+    match = re.search(r'<testsuite[^>]*\sname="([^"]+)"[^>]*\stime="([\d.]+)"', xml_content)
+    if match:
+        timings[match.group(1)] = float(match.group(2))
+    for match in re.finditer(r'<testcase classname="([^"]+)" name="([^"]+)" time="([\d.]+)"', xml_content):
+        timings['%s.%s' % (match.group(1), match.group(2))] = float(match.group(3))
+    return timings
+
+def build_report(testsuite):
+    """Builds a XML report from a testsuite of a structured (JSON) result, in
+    the same format which _XMLTestResult generates.
+    """
+    from xml.dom.minidom import Document
+    doc = Document()
+
+    xml_testsuite = doc.createElement('testsuite')
+    doc.appendChild(xml_testsuite)
+
+    tests = testsuite['tests']
+    xml_testsuite.setAttribute('name', testsuite['name'])
+    xml_testsuite.setAttribute('tests', str(len(tests)))
+    xml_testsuite.setAttribute('time', '%.3f' % testsuite['time'])
+    for attr, outcome in (('failures', 'failure'), ('errors', 'error'), ('skips', 'skip')):
+        xml_testsuite.setAttribute(attr, str(len([t for t in tests if t['outcome'] == outcome])))
+
+    for test in tests:
+        testcase = doc.createElement('testcase')
+        xml_testsuite.appendChild(testcase)
+
+        testcase.setAttribute('classname', testsuite['name'])
+        testcase.setAttribute('name', test['name'])
+        testcase.setAttribute('time', '%.3f' % test['time'])
+
+        if test['outcome'] != 'success':
+            failure = doc.createElement(test['outcome'])
+            testcase.appendChild(failure)
+
+            failure.setAttribute('type', test['type'])
+            failure.setAttribute('message', test['message'])
+            failure.appendChild(doc.createCDATASection(test['traceback']))
+
+    for tag, key in (('system-out', 'stdout'), ('system-err', 'stderr')):
+        output = doc.createElement(tag)
+        xml_testsuite.appendChild(output)
+        output.appendChild(doc.createCDATASection(testsuite[key]))
+
+    return doc.toprettyxml(indent='\t', encoding='utf-8')
+
+def _strip_whitespace(node):
+    "Removes the indentation toprettyxml() added so it isn't doubled up."
+    for child in list(node.childNodes):
+        if child.nodeType == child.TEXT_NODE and not child.data.strip():
+            node.removeChild(child)
+        else:
+            _strip_whitespace(child)
+    return node
+
+def merge_reports(xml_content, other_content):
+    """Merges two XML reports of the same testsuite (e.g. a TestCase which
+    was split across multiple jobs) into a single report.
+    """
+    from xml.dom.minidom import parseString
+    doc = _strip_whitespace(parseString(xml_content))
+    other = _strip_whitespace(parseString(other_content))
+
+    testsuite = doc.getElementsByTagName('testsuite')[0]
+    other_testsuite = other.getElementsByTagName('testsuite')[0]
+    
+    for attr in ('tests', 'failures', 'errors', 'skips'):
+        testsuite.setAttribute(attr, str(int(testsuite.getAttribute(attr) or 0) + \
+            int(other_testsuite.getAttribute(attr) or 0)))
+    testsuite.setAttribute('time', '%.3f' % (float(testsuite.getAttribute('time') or 0) + \
+        float(other_testsuite.getAttribute('time') or 0)))
+
+    # testcase's go before the system-out/system-err sections
+    first_output = None
+    for node in testsuite.childNodes:
+        if node.nodeName in ('system-out', 'system-err'):
+            first_output = node
+            break
+    for node in other_testsuite.getElementsByTagName('testcase'):
+        testsuite.insertBefore(doc.importNode(node, True), first_output)
+
+    for tag in ('system-out', 'system-err'):
+        text = '\n'.join(filter(None, (''.join(c.wholeText for c in el.childNodes \
+            if c.nodeType == c.CDATA_SECTION_NODE).strip() for el in \
+            doc.getElementsByTagName(tag) + other.getElementsByTagName(tag))))
+        for el in doc.getElementsByTagName(tag):
+            testsuite.removeChild(el)
+        output = doc.createElement(tag)
+        output.appendChild(doc.createCDATASection(text))
+        testsuite.appendChild(output)
+
+    return doc.toprettyxml(indent='\t', encoding='utf-8')
+
 class _XMLTestResult(_TextTestResult):
     "A test result class that can express test results in a XML report."
 
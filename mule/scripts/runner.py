@@ -2,6 +2,7 @@
 from optparse import OptionParser
 from mule import VERSION
 from mule.base import Mule, MultiProcessMule
+from mule.utils.resources import get_auto_workers
 
 import sys
 
@@ -24,16 +25,25 @@ def main():
                           help='Number of workers to consume. With multi-process this is the number of processes to spawn. With distributed this is the number of Celeryd servers to consume.')
         parser.add_option('--multiprocess', dest='multiprocess', action='store_true',
                           help='Use multi-process on the same machine instead of the Celery distributed system.')
+        parser.add_option('--auto-workers', dest='auto_workers', action='store_true',
+                          help='With multi-process and no --max-workers, run as many processes as there are idle CPUs and memory for.')
+        parser.add_option('--pin', dest='pin', action='store_true',
+                          help='With multi-process, pin each process to its own CPUs.')
         parser.add_option('--workspace', dest='workspace', metavar="WORKSPACE",
                           help='Specifies the workspace for this build.')
 
     (options, args) = parser.parse_args()
     if args[0] == "test":
+        kwargs = {}
+        max_workers = options.max_workers
         if options.multiprocess:
             cls = MultiProcessMule
+            kwargs['pin'] = options.pin
+            if options.auto_workers and not max_workers:
+                max_workers = get_auto_workers()
         else:
             cls = Mule
-        mule = cls(max_workers=options.max_workers, workspace=options.workspace)
+        mule = cls(max_workers=max_workers, workspace=options.workspace, **kwargs)
         jobs = mule.discover_tests(options.basedir)
         print '\n'.join(mule.process(jobs, options.runner))
 
@@ -1,24 +1,30 @@
-# TODO: TransactionTestCase should be ordered last, and they need to completely tear down
-#       all data in all tables and re-run syncdb (initial fixtures) each time.
-#       This same (bad) behavior needs to happen on every TestCase if not connections_support_transactions()
-
 from __future__ import absolute_import
 
 from cStringIO import StringIO
+from mule import conf
 from mule.contextmanager import get_context_managers
-from mule.base import Mule, MultiProcessMule, FailFastInterrupt
+from mule.base import Mule, MultiProcessMule, FailFastInterrupt, get_job_name
 from mule.loader import reorder_suite
 from mule.runners import make_test_runner
+from mule.results import ResultAggregator
+from mule.runners.json import JSONTestRunner
 from mule.runners.xml import XMLTestRunner
-from mule.runners.text import TextTestRunner, _TextTestResult
+from mule.runners.text import TextTestRunner
 from mule.utils import import_string
-from xml.dom.minidom import parseString
+from mule.utils.output import get_output_file, read_output
+from mule.utils.processes import install_stack_dump_handler
+from mule.utils.resources import get_auto_workers
+from mule.utils.rusage import get_self_rusage, rusage_delta
+from mule.utils.timings import TimingStore
+from mule.utils.warm import ForkServer
 
+import json
 import logging
+import multiprocessing
 import os, os.path
-import re
 import sys
 import time
+import traceback
 import uuid
 import unittest
 import unittest2
@@ -30,7 +36,9 @@ class MuleTestLoader(object):
                  multiprocess=False, xunit=False, xunit_output='./xunit/',
                  include='', exclude='', max_workers=None, start_dir=None,
                  loader=defaultTestLoader, base_cmd='unit2 $TEST', 
-                 workspace=None, log_level=logging.DEBUG, *args, **kwargs):
+                 workspace=None, log_level=logging.DEBUG, split_methods=None, batch=False,
+                 serve=False, warm=False, warm_cmd=None, speculative=False, compress=False,
+                 timeout=None, fork=False, auto_workers=False, pin=False, *args, **kwargs):
 
         assert not (distributed and worker and multiprocess), "You cannot combine --distributed, --worker, and --multiprocess"
         
@@ -55,16 +63,44 @@ class MuleTestLoader(object):
         self.loader = loader
         self.logger = logging.getLogger('mule')
         self.logger.setLevel(log_level)
+        if multiprocess and auto_workers and not max_workers:
+            # Size the pool by the CPUs and memory which are actually free
+            self.max_workers = get_auto_workers(logger=self.logger)
         
         self.base_cmd = base_cmd
         self.workspace = workspace
+        # Maximum number of test methods per job (None means whole TestCase's)
+        self.split_methods = split_methods
+        # Pack small TestCase's together to amortize the cost of starting each job
+        self.batch = batch
+        self.timings = TimingStore(conf.TIMINGS_FILE)
+
+        # Workers which stay alive and run jobs sent to them (see ``serve_jobs``)
+        self.serve = serve
+        # Run jobs on warm workers, started with ``warm_cmd``
+        self.warm = warm
+        self.warm_cmd = warm_cmd
+        # Duplicate straggling jobs onto idle workers (distributed only)
+        self.speculative = speculative
+        # Compress results sent through the result backend (distributed only)
+        self.compress = compress
+        # Seconds before a job is killed and reported as an error
+        self.timeout = timeout
+        # Fork warm workers from this process, rather than starting them with ``warm_cmd``
+        self.fork = fork
+        # Pin each local worker to its own CPUs (multiprocess only)
+        self.pin = pin
     
     def run_suite(self, suite, output=None, run_callback=None):
         kwargs = {
             'verbosity': self.verbosity,
             'failfast': self.failfast,
         }
-        if self.worker or self.xunit:
+        if self.worker:
+            # Workers report back a structured result, which is aggregated by the master
+            cls = JSONTestRunner
+            kwargs['output'] = output
+        elif self.xunit:
             cls = XMLTestRunner
             kwargs['output'] = output
         else:
@@ -105,15 +141,132 @@ class MuleTestLoader(object):
 
         return reorder_suite(new_suite, (unittest2.TestCase,))
 
-    def run_distributed_tests(self, test_labels, extra_tests=None, in_process=False, **kwargs):
+    def build_jobs(self, suite):
+        """
+        Returns the jobs to distribute for ``suite``.
+
+        A job is a whole TestCase class, unless ``split_methods`` is set, in which case
+        larger TestCase's are split up into space separated lists of
+        path.to.TestCase.test_method labels, each no longer than ``split_methods``.
+        """
+        tests_by_class = {}
+        classes = []
+        for test in suite._tests:
+            cls = test.__class__
+            if cls not in tests_by_class:
+                tests_by_class[cls] = []
+                classes.append(cls)
+            tests_by_class[cls].append(test)
+
+        jobs = []
+        for cls in classes:
+            tests = tests_by_class[cls]
+            if not self.split_methods or len(tests) <= self.split_methods:
+                jobs.append(cls)
+                continue
+
+            name = get_job_name(cls)
+            labels = ['%s.%s' % (name, t._testMethodName) for t in tests]
+            for i in xrange(0, len(labels), self.split_methods):
+                jobs.append(' '.join(labels[i:i + self.split_methods]))
+
+        if self.batch:
+            groups = dict((get_job_name(cls), self.get_job_group(cls)) for cls in classes)
+            jobs = self.batch_jobs(jobs, groups)
+
+        return jobs
+
+    def get_job_group(self, cls):
+        """
+        Returns the group of the TestCase ``cls``. Only TestCase's in the same group are
+        batched together (e.g. so those which need a slower kind of isolation get jobs
+        of their own).
+        """
+        return None
+
+    def batch_jobs(self, jobs, groups=None):
+        """
+        Packs TestCase's which are quick compared to the (measured) overhead of a job
+        into batches, which are run as a single space separated job.
+
+        Batches are sized so that overhead is at most ``conf.BATCH_OVERHEAD_RATIO`` of
+        a job, while still leaving a few jobs per worker so the build stays balanced.
+        If given, ``groups`` maps each TestCase to its group (see ``get_job_group``).
+
+        TestCase's which haven't been timed yet are never batched, as they may well be
+        slow. They're run on their own until we know how long they take.
+        """
+        overhead = self.timings.overhead
+        if not overhead:
+            self.logger.info('No job overhead has been measured yet, not batching')
+            return jobs
+
+        names = [get_job_name(j) for j in jobs]
+        estimates = {}
+        for name in names:
+            estimate = self.timings.estimate(name)
+            if estimate is not None:
+                estimates[name] = estimate - overhead
+        total = sum(estimates.itervalues())
+        workers = self.max_workers or multiprocessing.cpu_count()
+
+        target = min(overhead / conf.BATCH_OVERHEAD_RATIO, total / (workers * conf.BATCH_JOBS_PER_WORKER))
+
+        # Split TestCase's are never batched back up
+        small = [n for n in names if ' ' not in n and n in estimates and estimates[n] < target]
+        if len(small) < 2:
+            return jobs
+        small_names = set(small)
+
+        groups = groups or {}
+
+        batches = []
+        # First fit decreasing
+        for name in sorted(small, key=lambda n: estimates[n], reverse=True):
+            group = groups.get(name)
+            for batch in batches:
+                if batch[2] == group and batch[0] + estimates[name] <= target:
+                    batch[0] += estimates[name]
+                    batch[1].append(name)
+                    break
+            else:
+                batches.append([estimates[name], [name], group])
+
+        self.logger.info('Batched %d TestCase(s) into %d job(s) (overhead is %.3fs per job)',
+                         len(small), len(batches), overhead)
+
+        return [j for j, n in zip(jobs, names) if n not in small_names] + \
+               [' '.join(b[1]) for b in batches]
+
+    def run_distributed_tests(self, test_labels, extra_tests=None, in_process=False, build_id=None,
+                              **kwargs):
+        mule_kwargs = {}
         if in_process:
             cls = MultiProcessMule
+            mule_kwargs['pin'] = self.pin
         else:
             cls = Mule
-        build_id = uuid.uuid4().hex
-        mule = cls(build_id=build_id, max_workers=self.max_workers, workspace=self.workspace)
-        result = mule.process(test_labels, runner=self.base_cmd,
-                              callback=self.report_result)
+        if not build_id:
+            build_id = uuid.uuid4().hex
+        mule = cls(build_id=build_id, max_workers=self.max_workers, workspace=self.workspace,
+                   timings=self.timings, speculative=self.speculative, compress=self.compress,
+                   timeout=self.timeout, **mule_kwargs)
+        self.aggregator = ResultAggregator(xunit=self.xunit, xunit_output=self.xunit_output)
+        if in_process and self.fork:
+            # Workers share everything we've already imported (e.g. the tests)
+            server = ForkServer(self.serve_forked, prefork=min(mule.max_workers, len(test_labels)))
+            try:
+                result = mule.process(test_labels, runner=None, callback=self.report_result,
+                                      warm=True, spawn=server)
+            finally:
+                server.close()
+        elif in_process and self.warm:
+            assert self.warm_cmd, "--warm requires a runner which supports serving jobs"
+            result = mule.process(test_labels, runner=self.warm_cmd,
+                                  callback=self.report_result, warm=True)
+        else:
+            result = mule.process(test_labels, runner=self.base_cmd,
+                                  callback=self.report_result)
         # result should now be some parseable text
         return result
     
@@ -121,6 +274,9 @@ class MuleTestLoader(object):
         # We need to swap stdout/stderr so that the task only captures what is needed,
         # and everything else goes to our logs
         if self.worker:
+            # Lets us see where we were stuck if the job times out
+            install_stack_dump_handler()
+
             stdout = StringIO()
             sys_stdout = sys.stdout
             sys.stdout = stdout
@@ -142,13 +298,15 @@ class MuleTestLoader(object):
             cms.append(cm)
 
         try:
+            if self.worker and self.serve:
+                return self.serve_jobs(cms)
+
             suite = self.build_suite(test_labels, extra_tests)
 
             start = time.time()
 
             if self.distributed or self.multiprocess:
-                # we can only test whole TestCase's currently
-                jobs = set(t.__class__ for t in suite._tests)
+                jobs = self.build_jobs(suite)
                 result = self.run_distributed_tests(jobs, extra_tests=None, in_process=self.multiprocess, **kwargs)
             else:
                 result = self.run_suite(suite, output=output)
@@ -171,147 +329,87 @@ class MuleTestLoader(object):
         
         return result
 
+    def serve_forked(self):
+        """
+        Runs in each worker forked with ``--multiprocess --fork``, serving jobs over
+        stdin/stdout exactly as ``--worker --serve`` does.
+        """
+        self.distributed = self.multiprocess = False
+        self.worker = self.serve = True
+        return self.run_tests([])
+
+    def serve_jobs(self, context_managers, stdin=None, channel=None):
+        """
+        Runs each job sent over ``stdin`` (one JSON object per line) within the
+        already opened ``context_managers``, and writes the result back to ``channel``.
+
+        This lets a single worker run many jobs while only setting up its environment
+        and databases once. Context managers are reset between jobs.
+        """
+        if stdin is None:
+            stdin = sys.stdin
+        if channel is None:
+            # Anything the tests write directly to stdout must not corrupt our channel
+            channel = os.fdopen(os.dup(sys.__stdout__.fileno()), 'w')
+            os.dup2(sys.__stderr__.fileno(), sys.__stdout__.fileno())
+
+        while True:
+            line = stdin.readline()
+            if not line:
+                break
+            job = json.loads(line)['job']
+
+            self.logger.info('Running job %s', job)
+
+            rusage = get_self_rusage()
+
+            output = StringIO()
+            # Tests can be very noisy, so stderr is spooled to disk and truncated
+            stderr = get_output_file(prefix='stderr')
+            sys_stderr = sys.stderr
+            sys.stderr = stderr
+            try:
+                suite = self.build_suite(job.split())
+                result = self.run_suite(suite, output=output)
+            except Exception, e:
+                stderr.write(traceback.format_exc())
+                retcode = 1
+            else:
+                retcode = int(not result.wasSuccessful())
+            finally:
+                sys.stderr = sys_stderr
+
+            for cm in context_managers:
+                cm.reset()
+
+            try:
+                stderr_value = read_output(stderr, conf.STDERR_LIMIT).strip()
+            finally:
+                stderr.close()
+
+            channel.write(json.dumps({
+                'job': job,
+                'stdout': output.getvalue().strip(),
+                'stderr': stderr_value,
+                'retcode': retcode,
+                'rusage': rusage_delta(rusage, get_self_rusage()),
+            }) + '\n')
+            channel.flush()
+
+        return 0
+
     def report_result(self, result):
-        if result['stdout']:
-            match = re.search(r'errors="(\d+)".*failures="(\d+)".*skips="(\d+)".*tests="(\d+)"', result['stdout'])
-            if match:
-                errors = int(match.group(1))
-                failures = int(match.group(2))
-                skips = int(match.group(3))
-                tests = int(match.group(4))
-        else:
-            errors = 1
-            tests = 1
-            failures = 0
-            skips = 0
-        
-        if self.failfast and (errors or failures):
+        # Results are aggregated (and then discarded) as they arrive
+        failed = self.aggregator.add(result)
+
+        if self.failfast and failed:
             raise FailFastInterrupt(result)
     
     def suite_result(self, suite, result, total_time, **kwargs):
         if self.distributed or self.multiprocess:
-            # Bootstrap our xunit output path
-            if self.xunit and not os.path.exists(self.xunit_output):
-                os.makedirs(self.xunit_output)
-            
-            failures, errors = 0, 0
-            skips, tests = 0, 0
-
-            had_res = False
-            res_type = None
-            
+            # Anything which wasn't already reported as it finished
             for r in result:
-                if isinstance(r, dict):
-                    # XXX: stdout (which is our result) is in XML, which sucks life is easier with regexp
-                    match = re.search(r'errors="(\d+)".*failures="(\d+)".*skips="(\d+)".*tests="(\d+)"', r['stdout'])
-                    if match:
-                        errors += int(match.group(1))
-                        failures += int(match.group(2))
-                        skips += int(match.group(3))
-                        tests += int(match.group(4))
-                else:
-                    # Handles cases when our runners dont return correct output
-                    had_res = True
-                    res_type = 'error'
-                    sys.stdout.write(_TextTestResult.separator1 + '\n')
-                    sys.stdout.write('EXCEPTION: unknown exception\n')
-                    if r:
-                        sys.stdout.write(_TextTestResult.separator1 + '\n')
-                        sys.stdout.write(str(r).strip() + '\n')
-                    errors += 1
-                    tests += 1
-                    continue
-                    
-                if self.xunit:
-                    # Since we already get xunit results back, let's just write them to disk
-                    if r['stdout']:
-                        fp = open(os.path.join(self.xunit_output, r['job'] + '.xml'), 'w')
-                        try:
-                            fp.write(r['stdout'])
-                        finally:
-                            fp.close()
-                    elif r['stderr']:
-                        sys.stderr.write(r['stderr'])
-                        # Need to track this for the builds
-                        errors += 1
-                        tests += 1
-                elif r['stdout']:
-                    # HACK: Ideally we would let our default text runner represent us here, but that'd require
-                    #       reconstructing the original objects which is even more of a hack
-                    try:
-                        xml = parseString(r['stdout'])
-                    except Exception, e:
-                        had_res = True
-                        res_type = 'error'
-                        sys.stdout.write(_TextTestResult.separator1 + '\n')
-                        sys.stdout.write('EXCEPTION: %s (%s)\n' % (e, r['job']))
-                        if r['stdout']:
-                            sys.stdout.write(_TextTestResult.separator1 + '\n')
-                            sys.stdout.write(r['stdout'].strip() + '\n')
-                        if r['stderr']:
-                            sys.stdout.write(_TextTestResult.separator1 + '\n')
-                            sys.stdout.write(r['stdout'].strip() + '\n')
-                        errors += 1
-                        tests += 1
-                        continue
-
-                    for xml_test in xml.getElementsByTagName('testcase'):
-                        for xml_test_res in xml_test.childNodes:
-                            if xml_test_res.nodeName not in ('failure', 'skip', 'error'):
-                                continue
-                            had_res = True
-                            res_type = xml_test.getAttribute('name')
-                            desc = '%s (%s)' % (xml_test.getAttribute('name'), xml_test.getAttribute('classname'))
-                            sys.stdout.write(_TextTestResult.separator1 + '\n')
-                            sys.stdout.write('%s [%.3fs]: %s\n' % \
-                                (xml_test_res.nodeName.upper(), float(xml_test.getAttribute('time') or '0.0'), desc))
-                            sys.stdout.write('(Job was %s)\n' % r['job'])
-                            error_msg = (''.join(c.wholeText for c in xml_test_res.childNodes if c.nodeType == c.CDATA_SECTION_NODE)).strip()
-                            if error_msg:
-                                sys.stdout.write(_TextTestResult.separator2 + '\n')
-                                sys.stdout.write('%s\n' % error_msg)
-
-                    if res_type in ('failure', 'error'):
-                        syserr = (''.join(c.wholeText for c in xml.getElementsByTagName('system-err')[0].childNodes if c.nodeType == c.CDATA_SECTION_NODE)).strip()
-                        if syserr:
-                            sys.stdout.write(_TextTestResult.separator2 + '\n')
-                            sys.stdout.write('%s\n' % r['stderr'].strip())
-                        # if r['stderr']:
-                        #     sys.stdout.write(_TextTestResult.separator2 + '\n')
-                        #     sys.stdout.write('%s\n' % r['stderr'].strip())
-                elif r['stderr']:
-                    had_res = True
-                    sys.stdout.write(_TextTestResult.separator1 + '\n')
-                    sys.stdout.write('EXCEPTION: %s\n' % r['job'])
-                    sys.stdout.write(_TextTestResult.separator1 + '\n')
-                    sys.stdout.write(r['stderr'].strip() + '\n')
-                    errors += 1
-                    tests += 1
-
-            if had_res:
-                sys.stdout.write(_TextTestResult.separator2 + '\n')
-
-            run = tests - skips
-            sys.stdout.write("\nRan %d test%s in %.3fs\n\n" % (run, run != 1 and "s" or "", total_time))
-            
-            if errors or failures:
-                sys.stdout.write("FAILED (")
-                if failures:
-                    sys.stdout.write("failures=%d" % failures)
-                if errors:
-                    if failures:
-                        sys.stdout.write(", ")
-                    sys.stdout.write("errors=%d" % errors)
-                if skips:
-                    if failures or errors:
-                        sys.stdout.write(", ")
-                    sys.stdout.write("skipped=%d" % skips)
-                sys.stdout.write(")")
-            else:
-                sys.stdout.write("OK")
-                if skips:
-                    sys.stdout.write(" (skipped=%d)" % skips)
+                self.aggregator.add(r)
 
-            sys.stdout.write('\n\n')
-            return failures + errors
+            return self.aggregator.summary(total_time)
         return super(MuleTestLoader, self).suite_result(suite, result, **kwargs)
\ No newline at end of file
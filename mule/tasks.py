@@ -1,16 +1,42 @@
 from celery.task import task
 from celery.worker.control import Panel
 from mule import conf
+from mule.utils.processes import register_process, unregister_process, kill_build, kill_job, \
+                                 kill_process_group, dump_process_group, mark_build_finished, \
+                                 is_build_finished, remove_build_files
+from mule.utils.output import get_output_file, read_output, truncate_output
+from mule.utils.resources import pin_command, pin_process
+from mule.utils.rusage import Popen
+from mule.utils.warm import WarmProcess, WarmProcessError
+from xml.dom.minidom import parseString
 
+import base64
+import json
 import os
-import subprocess
-import shlex
+import re
+import select
 import tempfile
 import time
 import traceback
+import zlib
 
 __all__ = ('mule_setup', 'mule_teardown', 'run_test')
 
+# Warm workers, keyed by (build_id, id(worker))
+_warm_processes = {}
+
+# Copies of the environment for each work path, so it isn't rebuilt for every job
+_envs = {}
+
+# Variables which can be substituted in simple commands (see ``get_simple_command``)
+SIMPLE_VARIABLES = ('TEST', 'BUILD_ID', 'WORKSPACE')
+
+_simple_variable_re = re.compile(r'\$(?:\{(%(names)s)\}|(%(names)s)(?!\w))' % {
+    'names': '|'.join(SIMPLE_VARIABLES),
+})
+
+_simple_word_re = re.compile(r'^(?:[\w./:@%%+,=-]|%s)+$' % _simple_variable_re.pattern)
+
 def join_queue(cset, name, **kwargs):
     queue = cset.add_consumer_from_dict(queue=name, **kwargs)
     # XXX: There's currently a bug in Celery 2.2.5 which doesn't declare the queue automatically
@@ -20,49 +46,537 @@ def join_queue(cset, name, **kwargs):
     # start consuming from default
     cset.consume()
 
-def execute_bash(name, script, workspace=None, logger=None, **env_kwargs):
-    (h, script_path) = tempfile.mkstemp(prefix=name)
-    
-    if logger:
-        logger.info('Executing %s in %s', name, script_path)
-
+def get_work_path(workspace=None):
     if workspace:
         assert conf.ROOT
-        work_path = os.path.join(conf.ROOT, 'workspaces', workspace)
-    else:
-        work_path = os.getcwd()
+        return os.path.join(conf.ROOT, 'workspaces', workspace)
+    return os.getcwd()
 
-    with open(script_path, 'w') as fp:
-        fp.write(unicode(script).encode('utf-8'))
+def get_timeout(workspace=None, timeout=None):
+    """
+    Returns the number of seconds a job may run for, or None if there is no limit.
+    """
+    if timeout is not None:
+        return timeout
+    if workspace:
+        timeout = conf.WORKSPACES.get(workspace, {}).get('timeout')
+        if timeout is not None:
+            return timeout
+    return conf.JOB_TIMEOUT
 
-    cmd = '/bin/bash %s' % script_path.encode('utf-8')
+def get_env(work_path, **env_kwargs):
+    """
+    Returns the environment for a script run in ``work_path``.
+
+    The worker's own environment is only copied the first time each work path
+    is seen, so changes to ``os.environ`` after that are not picked up.
+    """
+    base_env = _envs.get(work_path)
+    if base_env is None:
+        base_env = _envs[work_path] = dict(os.environ, WORKSPACE=work_path)
 
     # Setup our environment variables
-    env = os.environ.copy()
+    env = base_env.copy()
     for k, v in env_kwargs.iteritems():
         env[unicode(k).encode('utf-8')] = unicode(v).encode('utf-8')
-    env['WORKSPACE'] = work_path
-    
-    start = time.time()
-    
+    return env
+
+def find_executable(name, env):
+    if '/' in name:
+        return os.access(name, os.X_OK) and name or None
+    for path in env.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(path, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+def get_simple_command(script, env):
+    """
+    Returns the arguments to run ``script`` with if it's a simple command (e.g.
+    ``unit2 $TEST``) which can be exec'd directly, rather than through bash.
+
+    Simple commands are a single line of plain words, which may contain the
+    ``SIMPLE_VARIABLES``. These are substituted from ``env`` and split on
+    whitespace like bash would (so ``$TEST`` can give several arguments).
+    Anything else (quoting, pipes, redirects, globs, other variables, builtins
+    etc) returns None, and should be left to bash.
+    """
+    words = script.split()
+    if not words or '\n' in script.strip() or not all(_simple_word_re.match(w) for w in words):
+        return None
+
+    def expand(match):
+        return env.get(match.group(1) or match.group(2), '')
+
+    args = []
+    for word in words:
+        if _simple_variable_re.search(word):
+            args.extend(_simple_variable_re.sub(expand, word).split())
+        else:
+            args.append(word)
+
+    # Variable assignments and builtins need a shell
+    if not args or '=' in args[0] or find_executable(args[0], env) is None:
+        return None
+    return args
+
+def parse_report(stdout):
+    """
+    Returns the structured (JSON) report a runner wrote to stdout, if it
+    wrote one (e.g. ``mule --worker``).
+    """
+    if not stdout.startswith('{'):
+        return None
+    try:
+        report = json.loads(stdout)
+    except ValueError:
+        return None
+    if not isinstance(report, dict) or 'testsuites' not in report:
+        return None
+    return report
+
+def is_report(stdout):
+    """
+    Returns whether ``stdout`` is a runner's JSON (see ``parse_report``) or XML report.
+    """
+    if parse_report(stdout) is not None:
+        return True
+    if not stdout.startswith('<'):
+        return False
     try:
-        proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                env=env, cwd=work_path)
-        (stdout, stderr) = map(lambda x: x.strip(), proc.communicate())
+        parseString(stdout)
+    except Exception:
+        return False
+    return True
+
+def make_result(build_id, job, start, stop, script_result, timeout=None):
+    """
+    ``script_result`` is (stdout, stderr, returncode[, rusage]).
+
+    ``timeout`` is the limit the job exceeded, if it was killed for taking too long.
+    """
+    result = {
+        "timeStarted": start,
+        "timeFinished": stop,
+        "build_id": build_id,
+        "job": job,
+        "stdout": script_result[0],
+        "stderr": script_result[1],
+        "retcode": script_result[2],
+    }
+
+    report = parse_report(script_result[0])
+    if report is not None:
+        result['report'] = report
+        # The report replaces the raw output
+        result['stdout'] = ''
+
+    if len(script_result) > 3 and script_result[3] is not None:
+        result['rusage'] = script_result[3]
+
+    if timeout is not None:
+        result['timeout'] = timeout
+
+    return result
+
+def compress_result(result, threshold=None):
+    """
+    Compresses the (potentially large) payload of a result, so less needs to be
+    sent through the result backend. Only values larger than ``threshold`` bytes
+    are compressed, and their keys are listed in ``result['compressed']``.
+    """
+    if threshold is None:
+        threshold = conf.COMPRESS_THRESHOLD
+
+    compressed = []
+    for key in ('stdout', 'stderr', 'report'):
+        value = result.get(key)
+        if value is None:
+            continue
+        if key == 'report':
+            value = json.dumps(value)
+        if len(value) < threshold:
+            continue
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        # base64 as not every result serializer can handle binary strings
+        result[key] = base64.b64encode(zlib.compress(value, conf.COMPRESS_LEVEL))
+        compressed.append(key)
+
+    if compressed:
+        result['compressed'] = compressed
+    return result
+
+def decompress_result(result):
+    """
+    Reverses ``compress_result``. Output is returned as the bytes the job wrote, just as
+    it is when it wasn't compressed.
+    """
+    if not isinstance(result, dict):
+        return result
+
+    for key in result.pop('compressed', ()):
+        value = zlib.decompress(base64.b64decode(result[key]))
+        if key == 'report':
+            value = json.loads(value)
+        result[key] = value
+    return result
+
+class ScriptProcess(object):
+    """
+    A running script (see ``execute_bash``), which can be waited on without blocking.
+
+    Simple commands (see ``get_simple_command``) are exec'd directly, saving the
+    cost of writing a script and starting bash for every job.
+
+    If ``cancellable`` is set, the script is killed straight away if its build
+    has already finished (e.g. was cancelled while we were starting it), or if it
+    was revoked by ``key`` (see ``kill_job``).
+
+    If ``cpus`` is given, the script (and everything it starts) only runs on those CPUs.
+    """
+    def __init__(self, name, script, workspace=None, logger=None, cancellable=False, cpus=None,
+                 key=None, **env_kwargs):
+        self.name = name
+        self.logger = logger
+        self.proc = None
+        self.script_path = None
+
+        work_path = get_work_path(workspace)
+
+        env = get_env(work_path, **env_kwargs)
+
+        script = unicode(script).encode('utf-8')
+
+        args = get_simple_command(script, env)
+        if args:
+            if logger:
+                logger.info('Executing %s as %s', name, ' '.join(args))
+        else:
+            (h, self.script_path) = tempfile.mkstemp(prefix=name)
+            with os.fdopen(h, 'w') as fp:
+                fp.write(script)
+            args = ['/bin/bash', self.script_path]
+            if logger:
+                logger.info('Executing %s in %s', name, self.script_path)
+
+        if cpus:
+            args = pin_command(args, cpus)
+
+        self.build_id = env_kwargs.get('BUILD_ID')
+
+        self.start = time.time()
+
+        # Output goes to disk so it never has to be held in memory as a whole
+        self.stdout = get_output_file(prefix='stdout')
+        self.stderr = get_output_file(prefix='stderr')
+        try:
+            # Each script runs in its own process group so the whole group can be killed
+            # if the build is cancelled
+            self.proc = Popen(args, stdout=self.stdout, stderr=self.stderr,
+                              env=env, cwd=work_path, preexec_fn=os.setsid)
+            if self.build_id:
+                cancelled = register_process(self.build_id, self.proc.pid, key)
+                # The job may have been cancelled before it could see our process
+                if cancellable and cancelled:
+                    kill_process_group(self.proc.pid, leader=self.proc)
+        except:
+            self.close()
+            raise
+
+    @property
+    def returncode(self):
+        return self.proc.returncode
+
+    @property
+    def rusage(self):
+        return self.proc.rusage
+
+    def wait(self, timeout=None):
+        """
+        Waits up to ``timeout`` seconds for the script to exit, and returns its
+        returncode (None if it is still running).
+        """
+        return self.proc.wait(timeout)
+
+    def kill(self, dump=False):
+        """
+        Kills the script's process group, first asking it to dump its stacks if
+        ``dump`` is set (e.g. as it has hung).
+        """
+        if dump:
+            dump_process_group(self.proc.pid)
+        kill_process_group(self.proc.pid, leader=self.proc)
+        self.proc.wait()
+
+    def read_output(self):
+        """
+        Returns the (bounded) stdout and stderr of the script.
+
+        A report (see ``is_report``) up to ``REPORT_LIMIT`` bytes isn't truncated, as it
+        couldn't be parsed any more. Runners bound the output they include in it instead.
+        """
+        stderr = read_output(self.stderr, conf.STDERR_LIMIT).strip()
+        if self.proc.status_lost:
+            stderr = (stderr + '\n\nThe script was reaped by another process, so its exit '
+                      'status is unknown.').strip()
+
+        self.stdout.flush()
+        self.stdout.seek(0, os.SEEK_END)
+        size = self.stdout.tell()
+        self.stdout.seek(0)
+        if conf.STDOUT_LIMIT is not None and size > conf.STDOUT_LIMIT and \
+           (conf.REPORT_LIMIT is None or size <= conf.REPORT_LIMIT) and \
+           self.stdout.read(1) in ('{', '<'):
+            self.stdout.seek(0)
+            stdout = self.stdout.read().strip()
+            if not is_report(stdout):
+                stdout = truncate_output(stdout, conf.STDOUT_LIMIT)
+            return (stdout, stderr)
+
+        return (read_output(self.stdout, conf.STDOUT_LIMIT).strip(), stderr)
+
+    def close(self):
+        if self.build_id and self.proc:
+            unregister_process(self.build_id, self.proc.pid)
+        self.stdout.close()
+        self.stderr.close()
+        if self.script_path:
+            os.remove(self.script_path)
+            self.script_path = None
+
+        if self.logger:
+            self.logger.info('Script execution completed in %.3fs', time.time() - self.start)
+
+def execute_bash(name, script, workspace=None, logger=None, **env_kwargs):
+    """
+    Runs ``script`` with bash, returning (stdout, stderr, returncode, rusage), where
+    ``rusage`` is the resources used by the script (see ``mule.utils.rusage``).
+    """
+    try:
+        proc = ScriptProcess(name, script, workspace=workspace, logger=logger, **env_kwargs)
     except KeyboardInterrupt:
         # Ensure we propagate up the exception
         raise
     except Exception, e:
-        (stdout, stderr, returncode) =  ('', 'Error running command [%s]: %s' % (cmd, traceback.format_exc()), 1)
-    else:
-        returncode = proc.returncode
-    
-    stop = time.time()
-    
-    if logger:
-        logger.info('Script execution completed in %.3fs', stop - start)
-    
-    return (stdout, stderr, returncode)
+        return ('', 'Error running command [%s]: %s' % (script, traceback.format_exc()), 1, None)
+
+    try:
+        proc.wait()
+        (stdout, stderr) = proc.read_output()
+    finally:
+        proc.close()
+
+    return (stdout, stderr, proc.returncode, proc.rusage)
+
+class LocalJob(object):
+    """
+    Runs ``job`` on this machine, with ``runner`` (see ``run_test``).
+
+    Jobs can be run to completion (``run``), or many can be run at once by a
+    ``mule.utils.supervisor.Supervisor``.
+
+    If ``slot_cpus`` (the CPUs of each slot, see ``get_slot_cpus``) is given, the
+    job is pinned to the CPUs of the slot it's started in.
+
+    If given, ``key`` (e.g. the job's task id) lets the job be killed on its own
+    with ``kill_job``.
+    """
+    deadline = None
+
+    def __init__(self, build_id, runner, job, workspace=None, timeout=None, logger=None,
+                 slot_cpus=None, key=None):
+        self.build_id = build_id
+        self.runner = runner
+        self.job = job
+        self.workspace = workspace
+        self.timeout = get_timeout(workspace, timeout)
+        self.logger = logger
+        self.slot_cpus = slot_cpus
+        self.key = key
+        self.proc = None
+
+    def start(self, slot=None):
+        self.started = time.time()
+
+        if is_build_finished(self.build_id):
+            # The build was torn down (e.g. cancelled) after we received this job
+            self.script_result = ('', 'Build %s has finished, skipping job' % (self.build_id,), 1)
+            return
+
+        try:
+            self.proc = ScriptProcess(
+                name='test.sh',
+                script=self.runner,
+                workspace=self.workspace,
+                logger=self.logger,
+                cancellable=True,
+                cpus=self.slot_cpus[slot] if self.slot_cpus and slot is not None else None,
+                key=self.key,
+                BUILD_ID=self.build_id,
+                TEST=self.job,
+            )
+        except KeyboardInterrupt:
+            raise
+        except Exception, e:
+            self.script_result = ('', 'Error running command [%s]: %s' % (self.runner, traceback.format_exc()), 1)
+        else:
+            if self.timeout:
+                self.deadline = self.started + self.timeout
+
+    def fileno(self):
+        return None
+
+    def _finish(self, timed_out=None):
+        try:
+            (stdout, stderr) = self.proc.read_output()
+        finally:
+            self.proc.close()
+        if timed_out is not None:
+            stderr = ('%s\nJob timed out after %ss' % (stderr, timed_out)).strip()
+            return (stdout, stderr, 1, self.proc.rusage)
+        return (stdout, stderr, self.proc.returncode, self.proc.rusage)
+
+    def poll(self):
+        if self.proc is not None:
+            if self.proc.wait(0) is None:
+                return None
+            self.script_result = self._finish()
+        return make_result(self.build_id, self.job, self.started, time.time(), self.script_result)
+
+    def expire(self):
+        self.proc.kill(dump=True)
+        return make_result(self.build_id, self.job, self.started, time.time(),
+                           self._finish(timed_out=self.timeout), self.timeout)
+
+    def cancel(self):
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.kill()
+        return self.poll()
+
+    def run(self):
+        self.start()
+        if self.proc is not None and self.proc.wait(self.timeout) is None:
+            return self.expire()
+        return self.poll()
+
+class WarmPool(object):
+    """
+    The warm workers of a build, which are reused for each job (see ``WarmJob``).
+
+    Workers are started with ``runner``, or by ``spawn`` if given (e.g. a ``ForkServer``).
+
+    Idle workers are kept per slot, so if ``slot_cpus`` is given each worker stays
+    pinned to the CPUs of the slot it was started for.
+    """
+    def __init__(self, build_id, runner=None, workspace=None, spawn=None, slot_cpus=None):
+        self.build_id = build_id
+        self.runner = runner
+        self.workspace = workspace
+        self.spawn = spawn
+        self.slot_cpus = slot_cpus
+        self.idle = {}
+
+    def get(self, slot=None):
+        idle = self.idle.setdefault(slot, [])
+        while idle:
+            proc = idle.pop()
+            if proc.is_alive():
+                return proc
+            self.discard(proc)
+
+        cpus = None
+        if self.slot_cpus and slot is not None:
+            cpus = self.slot_cpus[slot]
+
+        if self.spawn is not None:
+            proc = self.spawn()
+            if cpus:
+                pin_process(proc.proc.pid, cpus)
+        else:
+            work_path = get_work_path(self.workspace)
+            args = ['/bin/bash', '-c', unicode(self.runner).encode('utf-8')]
+            if cpus:
+                args = pin_command(args, cpus)
+            proc = WarmProcess(args, env=get_env(work_path, BUILD_ID=self.build_id, TEST=''),
+                               cwd=work_path)
+        # So they can be shut down (see ``close_warm_processes``)
+        _warm_processes[(self.build_id, id(proc))] = proc
+        return proc
+
+    def release(self, proc, slot=None):
+        self.idle.setdefault(slot, []).append(proc)
+
+    def discard(self, proc):
+        _warm_processes.pop((self.build_id, id(proc)), None)
+
+class WarmJob(object):
+    """
+    Runs ``job`` on a warm worker from ``pool``, in the same way as ``LocalJob``.
+    """
+    deadline = None
+
+    def __init__(self, build_id, job, pool, workspace=None, timeout=None):
+        self.build_id = build_id
+        self.job = job
+        self.pool = pool
+        self.timeout = get_timeout(workspace, timeout)
+        self.slot = None
+        self.proc = None
+
+    def start(self, slot=None):
+        self.started = time.time()
+        self.slot = slot
+        try:
+            self.proc = self.pool.get(slot)
+            self.proc.send(self.job)
+        except WarmProcessError, e:
+            # The next job will start a new worker
+            if self.proc is not None:
+                self.pool.discard(self.proc)
+                self.proc = None
+            self.script_result = ('', str(e), 1)
+        else:
+            if self.timeout:
+                self.deadline = self.started + self.timeout
+
+    def fileno(self):
+        if self.proc is None:
+            return None
+        return self.proc.fileno()
+
+    def poll(self):
+        if self.proc is not None:
+            try:
+                response = self.proc.receive()
+            except WarmProcessError, e:
+                self.pool.discard(self.proc)
+                self.script_result = ('', str(e), 1)
+            else:
+                self.pool.release(self.proc, self.slot)
+                self.script_result = (response['stdout'], response['stderr'], response['retcode'],
+                                      response.get('rusage'))
+            self.proc = None
+        return make_result(self.build_id, self.job, self.started, time.time(), self.script_result)
+
+    def expire(self):
+        e = self.proc.expire(self.timeout)
+        self.pool.discard(self.proc)
+        self.proc = None
+        return make_result(self.build_id, self.job, self.started, time.time(), ('', str(e), 1), self.timeout)
+
+    def cancel(self):
+        if self.proc is not None:
+            self.proc.close(kill=True)
+        # As the worker has exited, this reports the error
+        return self.poll()
+
+    def run(self):
+        self.start()
+        if self.proc is not None and self.timeout and \
+                not select.select([self.fileno()], [], [], self.timeout)[0]:
+            return self.expire()
+        return self.poll()
 
 @Panel.register
 def mule_setup(panel, build_id, workspace=None, script=None):
@@ -139,6 +653,12 @@ def mule_teardown(panel, build_id, workspace=None, script=None):
     channel.queue_purge(queue=queue_name)
     # stop consuming from queue
     cset.cancel_by_queue(queue_name)
+    # skip any jobs which were already prefetched, and kill those still running
+    mark_build_finished(build_id)
+    num_killed = kill_build(build_id)
+    if num_killed:
+        panel.logger.info("Killed %d running job(s)", num_killed)
+    remove_build_files(build_id)
     
     script_result = ('', '', 0)
     
@@ -168,36 +688,53 @@ def mule_teardown(panel, build_id, workspace=None, script=None):
         "retcode": script_result[2],
     }
 
+@Panel.register
+def mule_kill_job(panel, build_id, task_id):
+    """
+    Kills the job running ``task_id`` for ``build_id``, e.g. the copy of a job which
+    was re-run speculatively that didn't finish first. Revoking the task only stops
+    its Celery pool process, not the runner it started.
+    """
+    num_killed = kill_job(build_id, task_id)
+    if num_killed:
+        panel.logger.info("Killed %d running job(s) for task %s", num_killed, task_id)
+
+    return {
+        "status": "ok",
+        "build_id": build_id,
+        "killed": num_killed,
+    }
+
 
 @task(ignore_result=False)
-def run_test(build_id, runner, job, callback=None, workspace=None):
+def run_test(build_id, runner, job, callback=None, workspace=None, compress=False, timeout=None):
     """
     Spawns a test runner and reports the result.
-    """
-    start = time.time()
 
-    script_result = execute_bash(
-        name='test.sh',
-        script=runner,
-        workspace=workspace,
-        logger=run_test.get_logger(),
-        BUILD_ID=build_id,
-        TEST=job,
-    )
+    If ``compress`` is set, the result's payload is compressed (see ``compress_result``).
 
-    stop = time.time()
-
-    result = {
-        "timeStarted": start,
-        "timeFinished": stop,
-        "build_id": build_id,
-        "job": job,
-        "stdout": script_result[0],
-        "stderr": script_result[1],
-        "retcode": script_result[2],
-    }
+    If the runner takes longer than ``timeout`` seconds (which defaults to the workspace's
+    or ``JOB_TIMEOUT``) it is killed and the result is marked with ``timeout``.
+    """
+    result = LocalJob(build_id, runner, job, workspace=workspace, timeout=timeout,
+                      logger=run_test.get_logger(), key=run_test.request.id).run()
 
     if callback:
         callback(result)
 
-    return result
\ No newline at end of file
+    if compress:
+        result = compress_result(result)
+
+    return result
+
+def close_warm_processes(build_id, kill=False):
+    """
+    Shuts down all warm workers which were started for ``build_id``. If ``kill``
+    is set they are killed, rather than left to finish their current job.
+    """
+    for key in _warm_processes.keys():
+        if key[0] != build_id:
+            continue
+        proc = _warm_processes.pop(key, None)
+        if proc is not None:
+            proc.close(kill=kill)
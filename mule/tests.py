@@ -1,9 +1,38 @@
+import glob
+import json
 import os.path
-from unittest2 import TestCase
+import shutil
+import sqlite3
+from cStringIO import StringIO
+import sys
+import tempfile
+import time
+from unittest2 import TestCase, defaultTestLoader as loader
 from dingus import Dingus
-from mule.base import Mule
-from mule import conf
-from mule.tasks import run_test, mule_setup, mule_teardown
+from mule.base import Mule, MultiProcessMule, FailFastInterrupt
+from mule.contrib.django.database import database_exists, lock_database, read_fingerprint, \
+                                         write_fingerprint
+from mule.contrib.django.registry import get_registry_path, import_registered
+from mule.contrib.django.writes import WRITE_RE, RecordingCursor, TrackingCursor, get_fixture_files, \
+                                       get_restore_order, get_tables_to_reset, replay_writes
+from mule import base as mule_base, conf
+from mule.loader import reorder_suite
+from mule.results import ResultAggregator
+from mule.runners.json import JSONTestRunner
+from mule.runners.xml import merge_reports
+from mule.suite import MuleTestLoader
+from mule.tasks import run_test, close_warm_processes, WarmJob, WarmPool, mule_setup, mule_teardown, \
+                       make_result, compress_result, decompress_result, get_simple_command, \
+                       ScriptProcess, execute_bash
+from mule.utils.locking import LOCK_DIR, acquire_lock, get_setting_lock, lock_for_setting, \
+                               release_lock, release_setting_lock
+from mule.utils.output import get_output_file, read_output, truncate_output
+from mule.utils.processes import mark_build_finished, kill_build, kill_job, register_process, \
+                                 remove_build_files
+from mule.utils import resources
+from mule.utils.resources import parse_cpu_list, get_slot_cpus, get_auto_workers, pin_command
+from mule.utils.slotpool import SlotPool, lease_slot
+from mule.utils.timings import TimingStore
 
 def dingus_calls_to_dict(obj):
     # remap dingus calls into a useable dict
@@ -38,6 +67,61 @@ class TestRunnerTestCase(TestCase):
     #     self.assertEquals(result['stdout'], 'tests.TestRunnerTestCase')
     #     self.assertGreater(result['timeFinished'], result['timeStarted'])
 
+class FakeAsyncResult(object):
+    def __init__(self, result, polls=0):
+        self.result = result
+        self.task_id = id(self)
+        # number of times we're polled before being ready
+        self.polls = polls
+
+    def ready(self):
+        self.polls -= 1
+        return self.polls < 0
+
+class IterResultsTestCase(TestCase):
+    def setUp(self):
+        self.old_conf = conf.RESULT_POLL_INTERVAL, conf.PROVISION_INTERVAL
+        conf.RESULT_POLL_INTERVAL, conf.PROVISION_INTERVAL = 0, 0
+
+    def tearDown(self):
+        conf.RESULT_POLL_INTERVAL, conf.PROVISION_INTERVAL = self.old_conf
+
+    def test_provisions_while_running(self):
+        mule = Mule(max_workers=3)
+        mule.provision_workers = lambda limit, exclude: ['host%d' % (len(exclude) + 1)]
+        taskset_result = Dingus(results=[FakeAsyncResult('slow', 2), FakeAsyncResult('fast'), FakeAsyncResult('slower', 3)])
+        workers = ['host1']
+        self.assertEquals(list(mule.iter_results(taskset_result, workers)), ['fast', 'slow', 'slower'])
+        self.assertEquals(workers, ['host1', 'host2'])
+
+    def test_speculative(self):
+        mule = Mule(max_workers=2, speculative=True, timings=TimingStore())
+        mule.timings.record('a.Slow', 0)
+        duplicate = FakeAsyncResult('slow (duplicate)')
+        dispatched = []
+        def dispatch(job, runner):
+            dispatched.append(job)
+            return duplicate
+        mule.dispatch = dispatch
+        old_conf, old_revoke, old_broadcast = conf.SPECULATIVE_MIN_TIME, mule_base.revoke, mule_base.broadcast
+        conf.SPECULATIVE_MIN_TIME = 0
+        mule_base.revoke = Dingus('revoke')
+        mule_base.broadcast = Dingus('broadcast')
+        try:
+            original = FakeAsyncResult('slow', 10)
+            taskset_result = Dingus(results=[original, FakeAsyncResult('fast')])
+            results = list(mule.iter_results(taskset_result, ['host1', 'host2'], ['a.Slow', 'a.Fast'], 'runner'))
+            self.assertTrue(mule_base.revoke.calls('()', original.task_id).once())
+            # The losing copy's runner is killed too
+            (args, kwargs) = mule_base.broadcast.calls('()').one()[1:3]
+            self.assertEquals(args, ('mule_kill_job',))
+            self.assertEquals(kwargs['arguments'], {'build_id': mule.build_id, 'task_id': original.task_id})
+        finally:
+            conf.SPECULATIVE_MIN_TIME, mule_base.revoke, mule_base.broadcast = old_conf, old_revoke, old_broadcast
+        # The duplicate finished first, and we only get one result for the job
+        self.assertEquals(results, ['fast', 'slow (duplicate)'])
+        self.assertEquals(dispatched, ['a.Slow'])
+
 class RunTestTestCase(TestCase):
     def test_subprocess(self):
         result = run_test('build_id', 'echo $TEST', 'job')
@@ -71,6 +155,589 @@ class RunTestTestCase(TestCase):
         self.assertEquals(result['stdout'], 'job')
         self.assertGreater(result['timeFinished'], result['timeStarted'])
 
+class CompressResultTestCase(TestCase):
+    def test_compress(self):
+        result = run_test('build_id', 'head -c 10000 /dev/zero | tr "\\0" x', 'job', compress=True)
+        self.assertEquals(result['compressed'], ['stdout'])
+        self.assertLess(len(result['stdout']), 10000)
+        result = decompress_result(result)
+        self.assertFalse('compressed' in result)
+        self.assertEquals(result['stdout'], 'x' * 10000)
+
+        result = run_test('build_id', 'echo $TEST', 'job', compress=True)
+        self.assertFalse('compressed' in result)
+        self.assertEquals(result['stdout'], 'job')
+
+    def test_non_ascii(self):
+        # Whether or not output was large enough to be compressed, it's the same bytes
+        output = '\xc3\xa9t\xc3\xa9 ' * 1000
+        result = decompress_result(compress_result({'stdout': output, 'stderr': output[:6]}))
+        self.assertEquals(type(result['stdout']), str)
+        self.assertEquals(result['stdout'], output)
+        self.assertEquals(result['stderr'], output[:6])
+
+class JobTimeoutTestCase(TestCase):
+    def setUp(self):
+        self.dump_wait = conf.TIMEOUT_DUMP_WAIT
+        conf.TIMEOUT_DUMP_WAIT = 0.2
+
+    def tearDown(self):
+        conf.TIMEOUT_DUMP_WAIT = self.dump_wait
+
+    def test_timeout(self):
+        runner = '%s -c "from mule.utils.processes import install_stack_dump_handler; ' \
+                 'install_stack_dump_handler(); import time; time.sleep(30)"' % sys.executable
+        start = time.time()
+        result = run_test('build_id', runner, 'job', timeout=0.5)
+        self.assertLess(time.time() - start, 10)
+        self.assertEquals(result['timeout'], 0.5)
+        self.assertEquals(result['retcode'], 1)
+        self.assertTrue('Thread MainThread' in result['stderr'])
+        self.assertTrue('Job timed out after 0.5s' in result['stderr'])
+
+        stream = StringIO()
+        aggregator = ResultAggregator(stream=stream)
+        self.assertEquals(aggregator.add(result), 1)
+        self.assertTrue('TIMEOUT [0.500s]: job' in stream.getvalue())
+
+    def test_no_timeout(self):
+        result = run_test('build_id', 'echo $TEST', 'job', timeout=5)
+        self.assertFalse('timeout' in result)
+        self.assertEquals(result['stdout'], 'job')
+
+class ReapTestCase(TestCase):
+    def test_reaped_elsewhere(self):
+        proc = ScriptProcess('test.sh', 'true')
+        try:
+            # e.g. by a SIGCHLD handler, or a library waiting on every child
+            os.waitpid(proc.proc.pid, 0)
+            self.assertEquals(proc.wait(), -1)
+            self.assertEquals(proc.rusage, None)
+            self.assertTrue('exit status is unknown' in proc.read_output()[1])
+        finally:
+            proc.close()
+
+        proc = ScriptProcess('test.sh', 'true')
+        try:
+            self.assertEquals(proc.wait(), 0)
+            self.assertFalse(proc.proc.status_lost)
+            self.assertEquals(proc.read_output(), ('', ''))
+        finally:
+            proc.close()
+
+class SimpleCommandTestCase(TestCase):
+    env = {'TEST': 'a.B a.C', 'BUILD_ID': 'build', 'PATH': os.environ['PATH']}
+
+    def test_simple(self):
+        self.assertEquals(get_simple_command('echo $TEST', self.env), ['echo', 'a.B', 'a.C'])
+        self.assertEquals(get_simple_command('echo --id=${BUILD_ID} $TEST', self.env),
+                          ['echo', '--id=build', 'a.B', 'a.C'])
+        self.assertEquals(get_simple_command('echo $WORKSPACE', self.env), ['echo'])
+
+    def test_needs_shell(self):
+        for script in ('echo $TEST | cat', 'echo "$TEST"', 'echo $TESTS', 'echo $HOME', 'cd foo',
+                       'FOO=bar echo', 'echo *', 'echo 1\necho 2', 'echo $TEST > out'):
+            self.assertEquals(get_simple_command(script, self.env), None, script)
+
+    def test_run_test(self):
+        result = run_test('build_id', 'echo $TEST', 'a.B a.C')
+        self.assertEquals(result['stdout'], 'a.B a.C')
+        result = run_test('build_id', 'echo $TEST | tr a-z A-Z', 'a.B')
+        self.assertEquals(result['stdout'], 'A.B')
+
+class OutputCaptureTestCase(TestCase):
+    def setUp(self):
+        self.stderr_limit = conf.STDERR_LIMIT
+        conf.STDERR_LIMIT = 100
+
+    def tearDown(self):
+        conf.STDERR_LIMIT = self.stderr_limit
+
+    def test_read_output(self):
+        fp = get_output_file()
+        fp.write('a' * 100 + 'b' * 1000 + 'c' * 100)
+        self.assertEquals(read_output(fp, 200, 0.5), 'a' * 100 + '\n\n... [1000 bytes truncated] ...\n\n' + 'c' * 100)
+        self.assertEquals(len(read_output(fp)), 1200)
+        self.assertEquals(truncate_output('a' * 100 + 'b' * 1000 + 'c' * 100, 200, 0.5), read_output(fp, 200, 0.5))
+        self.assertEquals(truncate_output('abc', 200), 'abc')
+
+    def test_report_not_truncated(self):
+        stdout_limit = conf.STDOUT_LIMIT
+        conf.STDOUT_LIMIT = 100
+        try:
+            report = '{"testsuites": [], "padding": "%s"}' % ('x' * 1000,)
+            result = run_test('build_id', "echo '%s'" % report, 'job')
+        finally:
+            conf.STDOUT_LIMIT = stdout_limit
+        self.assertEquals(result['report']['padding'], 'x' * 1000)
+
+    def test_not_a_report_truncated(self):
+        stdout_limit, report_limit = conf.STDOUT_LIMIT, conf.REPORT_LIMIT
+        conf.STDOUT_LIMIT = 100
+        try:
+            # Output which only looks like a report
+            result = run_test('build_id', "echo '{\"log\": \"%s\"}'; echo '<p>%s</p>'" % ('x' * 1000, 'y' * 1000), 'job')
+            self.assertTrue('bytes truncated' in result['stdout'])
+            self.assertFalse('report' in result)
+
+            # Reports are only kept whole up to a limit of their own
+            conf.REPORT_LIMIT = 500
+            report = '{"testsuites": [], "padding": "%s"}' % ('x' * 1000,)
+            result = run_test('build_id', "echo '%s'" % report, 'job')
+            self.assertTrue('bytes truncated' in result['stdout'])
+            self.assertFalse('report' in result)
+        finally:
+            conf.STDOUT_LIMIT, conf.REPORT_LIMIT = stdout_limit, report_limit
+
+    def test_truncates(self):
+        result = run_test('build_id', 'echo start >&2; head -c 1000000 /dev/zero | tr "\\0" x >&2; echo end >&2; echo $TEST', 'job')
+        self.assertEquals(result['stdout'], 'job')
+        self.assertTrue(result['stderr'].startswith('start\n'))
+        self.assertTrue(result['stderr'].endswith('xxend'))
+        self.assertTrue('bytes truncated' in result['stderr'])
+        self.assertLess(len(result['stderr']), 200)
+
+class WarmJobTestCase(TestCase):
+    def setUp(self):
+        # A minimal warm worker which echos each job back
+        (h, self.script) = tempfile.mkstemp()
+        with os.fdopen(h, 'w') as fp:
+            fp.write('\n'.join([
+                'import json, os, sys',
+                'for line in iter(sys.stdin.readline, ""):',
+                '    job = json.loads(line)["job"]',
+                '    sys.stdout.write(json.dumps({"stdout": job, "stderr": str(os.getpid()), "retcode": 0}) + "\\n")',
+                '    sys.stdout.flush()',
+            ]))
+        self.runner = '%s %s' % (sys.executable, self.script)
+
+    def tearDown(self):
+        close_warm_processes('build_id')
+        os.remove(self.script)
+
+    def test_reuses_process(self):
+        pool = WarmPool('build_id', self.runner)
+        result = WarmJob('build_id', 'job1', pool).run()
+        self.assertEquals(result['job'], 'job1')
+        self.assertEquals(result['stdout'], 'job1')
+        self.assertEquals(result['retcode'], 0)
+        self.assertGreater(result['timeFinished'], result['timeStarted'])
+
+        # the same process handled the second job
+        self.assertEquals(WarmJob('build_id', 'job2', pool).run()['stderr'], result['stderr'])
+
+    def test_dead_process(self):
+        result = WarmJob('build_id', 'job', WarmPool('build_id', 'exit 1')).run()
+        self.assertEquals(result['stdout'], '')
+        self.assertEquals(result['retcode'], 1)
+        self.assertTrue('exited with status 1' in result['stderr'])
+
+class SupervisorTestCase(TestCase):
+    def test_concurrency(self):
+        jobs = ['job%d' % i for i in xrange(16)]
+        mule = MultiProcessMule(max_workers=8, timings=TimingStore())
+        start = time.time()
+        results = mule.process(jobs, runner='sleep 0.5; echo $TEST')
+        self.assertLess(time.time() - start, 1.9)
+        self.assertEquals(sorted(r['stdout'] for r in results), sorted(jobs))
+
+    def test_timeout(self):
+        mule = MultiProcessMule(max_workers=2, timings=TimingStore(), timeout=0.5)
+        results = mule.process(['slow', 'fast'], runner='if [ "$TEST" = "slow" ]; then sleep 30; fi; echo $TEST')
+        results = dict((r['job'], r) for r in results)
+        self.assertEquals(results['fast']['stdout'], 'fast')
+        self.assertFalse('timeout' in results['fast'])
+        self.assertEquals(results['slow']['timeout'], 0.5)
+
+class ResourcesTestCase(TestCase):
+    def test_parse_cpu_list(self):
+        self.assertEquals(parse_cpu_list('0-3,8,10-11\n'), [0, 1, 2, 3, 8, 10, 11])
+
+    def test_slot_cpus(self):
+        self.assertEquals(get_slot_cpus(2, cpus=[0, 1, 2, 3, 4]), [[0, 1], [2, 3]])
+        self.assertEquals(get_slot_cpus(3, cpus=[0, 1]), [[0], [1], [0]])
+
+    def test_auto_workers(self):
+        self.assertTrue(get_auto_workers() >= 1)
+        # No more workers than fit in memory, but always at least one
+        self.assertEquals(get_auto_workers(memory_per_worker=1024 ** 5), 1)
+
+    def test_pin(self):
+        mule = MultiProcessMule(max_workers=2, timings=TimingStore(), pin=True)
+        results = mule.process(['job1', 'job2', 'job3'],
+                               runner="awk '/^Cpus_allowed_list/ { print $2 }' /proc/self/status")
+        slots = [','.join(str(c) for c in cpus) for cpus in get_slot_cpus(2)]
+        for r in results:
+            self.assertEquals(r['retcode'], 0, r['stderr'])
+            self.assertTrue(r['stdout'] in slots, r['stdout'])
+
+    def test_pin_without_taskset(self):
+        old_path = os.environ['PATH']
+        os.environ['PATH'] = tempfile.mkdtemp()
+        resources._has_taskset = None
+        try:
+            # Runs unpinned rather than failing to exec
+            self.assertEquals(pin_command(['true'], [0]), ['true'])
+        finally:
+            os.rmdir(os.environ['PATH'])
+            os.environ['PATH'] = old_path
+            resources._has_taskset = None
+
+class FailFastTestCase(TestCase):
+    def test_cancels_running_jobs(self):
+        results = []
+        def callback(result):
+            results.append(result)
+            if result['retcode']:
+                raise FailFastInterrupt(result)
+
+        mule = MultiProcessMule(max_workers=2, timings=TimingStore())
+        start = time.time()
+        mule.process(['slow1', 'fail', 'slow2', 'slow3'],
+                     runner='if [ "$TEST" = "fail" ]; then exit 1; fi; sleep 30',
+                     callback=callback)
+        self.assertLess(time.time() - start, 10)
+        # slow2 and slow3 were never started
+        self.assertEquals(sorted(r['job'] for r in results), ['fail', 'slow1'])
+
+    def test_cancelled_while_starting(self):
+        # As if the build was cancelled just before the process was registered
+        build_id = 'cancelled_%d' % os.getpid()
+        mark_build_finished(build_id)
+        start = time.time()
+        proc = ScriptProcess('test.sh', 'sleep 30', cancellable=True, BUILD_ID=build_id)
+        try:
+            self.assertNotEquals(proc.wait(10), None)
+        finally:
+            proc.close()
+        self.assertLess(time.time() - start, 10)
+
+class KillJobTestCase(TestCase):
+    def test_kill_job(self):
+        build_id = 'kill_job_%d' % os.getpid()
+        procs = [ScriptProcess('test.sh', 'sleep 30', cancellable=True, key=key, BUILD_ID=build_id)
+                 for key in ('task1', 'task2')]
+        try:
+            self.assertEquals(kill_job(build_id, 'task1'), 1)
+            self.assertNotEquals(procs[0].wait(10), None)
+            self.assertEquals(procs[1].wait(0), None)
+
+            # The job is killed if it starts after it was revoked
+            proc = ScriptProcess('test.sh', 'sleep 30', cancellable=True, key='task1', BUILD_ID=build_id)
+            procs.append(proc)
+            self.assertNotEquals(proc.wait(10), None)
+        finally:
+            kill_build(build_id)
+            for proc in procs:
+                proc.wait()
+                proc.close()
+
+    def test_kill_build_removes_registrations(self):
+        build_id = 'kill_build_%d' % os.getpid()
+        # A process which exited without unregistering
+        register_process(build_id, 2 ** 22 + 1)
+        kill_build(build_id)
+        self.assertEquals(glob.glob(os.path.join(LOCK_DIR, 'mule:job_%s_*' % build_id)), [])
+
+class ForkSampleTestCase(TestCase):
+    def test_one(self):
+        pass
+
+    def test_two(self):
+        pass
+
+class ForkServerTestCase(TestCase):
+    def test_fork(self):
+        class ForkTestLoader(MuleTestLoader):
+            verbosity = 0
+            failfast = False
+
+            def build_suite(self, test_labels, extra_tests=None):
+                return reorder_suite(loader.loadTestsFromNames(test_labels), (TestCase,))
+
+        runner = ForkTestLoader(multiprocess=True, fork=True, max_workers=2)
+        runner.timings = TimingStore()
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            failures = runner.run_tests(['mule.tests.ForkSampleTestCase', 'mule.tests.RunTestTestCase'])
+            output = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEquals(failures, 0, output)
+        self.assertTrue('Ran 4 tests' in output, output)
+
+class LockingTestCase(TestCase):
+    def test_release_keeps_lock(self):
+        path = tempfile.mktemp(prefix='mule')
+        acquire_lock(path, blocking=True)
+        release_lock(path, remove=False)
+        self.assertTrue(os.path.exists(path))
+        acquire_lock(path)
+        release_lock(path)
+        self.assertFalse(os.path.exists(path))
+
+    def test_remove_build_files(self):
+        build_id = 'remove_build_files_%d' % os.getpid()
+        lock = lock_for_setting('db_template', build_id)
+        acquire_lock(lock, blocking=True)
+        release_lock(lock, remove=False)
+        remove_build_files(build_id)
+        self.assertFalse(os.path.exists(lock))
+
+class RegistryTestCase(TestCase):
+    def setUp(self):
+        self.build_id = 'registry_%d' % os.getpid()
+        self.path = get_registry_path(self.build_id)
+        self.imported_all = []
+
+    def tearDown(self):
+        remove_build_files(self.build_id)
+
+    def import_registered(self, modules=('json',)):
+        import_registered(self.path, lambda: self.imported_all.append(True), lambda: list(modules))
+
+    def read_registry(self):
+        with open(self.path, 'r') as fp:
+            return json.load(fp)
+
+    def test_registry(self):
+        self.import_registered()
+        self.assertEquals(len(self.imported_all), 1)
+        self.assertEquals(self.read_registry(), ['json'])
+
+        # Later workers only import what was recorded
+        self.import_registered()
+        self.assertEquals(len(self.imported_all), 1)
+
+        remove_build_files(self.build_id)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_fallback(self):
+        # Modules which have gone away
+        self.import_registered(['mule.does_not_exist'])
+        self.import_registered()
+        self.assertEquals(len(self.imported_all), 2)
+        self.assertEquals(self.read_registry(), ['json'])
+
+        # A corrupt registry
+        with open(self.path, 'w') as fp:
+            fp.write('[')
+        self.import_registered()
+        self.assertEquals(len(self.imported_all), 3)
+        self.assertEquals(self.read_registry(), ['json'])
+
+class SlotPoolTestCase(TestCase):
+    def test_lease(self):
+        path = tempfile.mktemp(prefix='mule')
+        pool = SlotPool(2, lambda num: None, path)
+        pool.start()
+        try:
+            leases = [lease_slot(path, timeout=5), lease_slot(path, timeout=5)]
+            self.assertEquals(sorted(l.slot for l in leases), [0, 1])
+            # Every slot is in use
+            self.assertEquals(lease_slot(path, timeout=0.5), None)
+
+            # Released (or orphaned) slots are prepared again and leased to the next worker
+            leases[0].release()
+            lease = lease_slot(path, timeout=5)
+            self.assertEquals(lease.slot, leases[0].slot)
+            lease.release()
+            leases[1].release()
+        finally:
+            pool.stop()
+        self.assertFalse(os.path.exists(path))
+        self.assertEquals(lease_slot(path), None)
+
+    def test_stop_kills_prepare(self):
+        path = tempfile.mktemp(prefix='mule')
+        build_id = 'slot_pool_%d' % os.getpid()
+        prepare = lambda num: execute_bash('prepare.sh', 'sleep 30', BUILD_ID=build_id)
+        pool = SlotPool(1, prepare, path, build_id=build_id)
+        pool.start()
+        try:
+            for i in xrange(100):
+                pgids = glob.glob(os.path.join(LOCK_DIR, 'mule:job_%s_*' % build_id))
+                if pgids:
+                    break
+                time.sleep(0.05)
+            self.assertEquals(len(pgids), 1)
+        finally:
+            pool.stop()
+        pgid = int(pgids[0].rsplit('_', 1)[1])
+        # Reaped by init once killed, so it may take a moment to disappear
+        for i in xrange(100):
+            try:
+                os.killpg(pgid, 0)
+            except OSError:
+                break
+            time.sleep(0.05)
+        else:
+            self.fail('The prepare script is still running')
+
+    def test_lock_setting(self):
+        path = tempfile.mktemp(prefix='mule')
+        build_id = 'slot_pool_locks_%d' % os.getpid()
+        pool = SlotPool(2, lambda num: None, path, build_id=build_id, lock_setting='db')
+        pool.start()
+        try:
+            # Workers which can't lease a slot are numbered after the pool's
+            num = get_setting_lock('db', build_id)
+            self.assertEquals(num, 2)
+            release_setting_lock('db', build_id, num)
+        finally:
+            pool.stop()
+        self.assertFalse(glob.glob(os.path.join(LOCK_DIR, 'mule:db_%s_*' % build_id)))
+
+class WritesTestCase(TestCase):
+    referencing = {'auth_user': set(['profile', 'auth_user_groups']), 'profile': set(['photo'])}
+
+    def test_write_re(self):
+        for sql, table in (('INSERT INTO "auth_user" ("id") VALUES (%s)', 'auth_user'),
+                           ('insert into `auth_user` (`id`) values (%s)', 'auth_user'),
+                           ('  UPDATE auth_user SET name = %s', 'auth_user'),
+                           ('DELETE FROM [auth_user] WHERE id = %s', 'auth_user'),
+                           ('REPLACE INTO auth_user(id) VALUES (%s)', 'auth_user')):
+            self.assertEquals(WRITE_RE.match(sql).group(1), table, sql)
+        for sql in ('SELECT * FROM auth_user', 'CREATE TABLE auth_user (id integer)'):
+            self.assertEquals(WRITE_RE.match(sql), None, sql)
+
+    def test_tables_to_reset(self):
+        tables = set(['auth_user', 'auth_user_groups', 'profile', 'photo', 'site'])
+        # Emptying a table empties those which reference it (and so on)
+        self.assertEquals(get_tables_to_reset(['auth_user', 'not_a_model'], tables, self.referencing),
+                          set(['auth_user', 'auth_user_groups', 'profile', 'photo']))
+        self.assertEquals(get_tables_to_reset(['photo'], tables, self.referencing), set(['photo']))
+
+    def test_restore_order(self):
+        self.assertEquals(get_restore_order(set(['photo', 'profile', 'auth_user', 'site']), self.referencing),
+                          ['auth_user', 'profile', 'photo', 'site'])
+        # Tables which reference each other can't all come first
+        self.assertEquals(get_restore_order(set(['b', 'a']), {'a': set(['b']), 'b': set(['a'])}), ['a', 'b'])
+
+    def test_tracking_cursor(self):
+        tracked = []
+        class Tracker(object):
+            track = tracked.append
+        cursor = TrackingCursor(sqlite3.connect(':memory:').cursor(), Tracker())
+        cursor.execute('CREATE TABLE foo (id integer)')
+        cursor.executemany('INSERT INTO foo (id) VALUES (?)', [(1,), (2,)])
+        cursor.execute('SELECT id FROM foo ORDER BY id')
+        self.assertEquals(list(cursor), [(1,), (2,)])
+        self.assertEquals(len(tracked), 3)
+
+    def test_replay(self):
+        writes = []
+        cursor = RecordingCursor(sqlite3.connect(':memory:').cursor(), writes)
+        cursor.execute('CREATE TABLE foo (id integer, name text)')
+        cursor.execute('INSERT INTO foo (id, name) VALUES (?, ?)', [1, 'a'])
+        cursor.execute('INSERT INTO foo (id, name) VALUES (?, ?)', [2, 'b'])
+        cursor.executemany('UPDATE foo SET name = ? WHERE id = ?', [('c', 2)])
+        # Consecutive runs of the same statement are batched, reads and schema changes aren't recorded
+        self.assertEquals(len(writes), 2)
+
+        other = sqlite3.connect(':memory:').cursor()
+        other.execute('CREATE TABLE foo (id integer, name text)')
+        self.assertEquals(replay_writes(other, writes), set(['foo']))
+        other.execute('SELECT id, name FROM foo ORDER BY id')
+        self.assertEquals(other.fetchall(), [(1, u'a'), (2, u'c')])
+
+    def test_fixture_files(self):
+        fixture_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(fixture_dir, 'users.json')
+            with open(path, 'w') as fp:
+                fp.write('[]')
+            files = get_fixture_files(['users'], [fixture_dir])
+            self.assertEquals([f[0] for f in files], [path])
+            self.assertEquals(get_fixture_files(['other'], [fixture_dir]), ())
+
+            # An edited fixture is loaded (and recorded) afresh
+            os.utime(path, (files[0][1] + 10, files[0][1] + 10))
+            self.assertNotEquals(get_fixture_files(['users'], [fixture_dir]), files)
+        finally:
+            shutil.rmtree(fixture_dir)
+
+class SQLiteCursor(object):
+    """
+    Converts format style parameters to SQLite's, as Django's cursor does.
+    """
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        return self.cursor.execute(sql.replace('%s', '?'), params)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+class SQLiteConnection(object):
+    """
+    The parts of a Django connection to a SQLite database which provisioning uses.
+    """
+    def __init__(self, name):
+        self.settings_dict = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': name, 'TEST_NAME': name}
+        self.connection = sqlite3.connect(name)
+        self.ops = Dingus(quote_name=lambda name: '"%s"' % name)
+        self.introspection = Dingus(table_names=self.table_names)
+
+    def table_names(self):
+        cursor = self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+        return [row[0] for row in cursor.fetchall()]
+
+    def cursor(self):
+        return SQLiteCursor(self.connection.cursor())
+
+    def _commit(self):
+        self.connection.commit()
+
+class DatabaseTestCase(TestCase):
+    def setUp(self):
+        self.path = tempfile.mktemp(prefix='mule', suffix='.db')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_database_exists(self):
+        connection = Dingus(settings_dict={'ENGINE': 'django.db.backends.sqlite3'})
+        self.assertFalse(database_exists(connection, self.path))
+        open(self.path, 'w').close()
+        self.assertTrue(database_exists(connection, self.path))
+
+    def test_lock_database(self):
+        connection = Dingus(settings_dict={'ENGINE': 'django.db.backends.sqlite3'})
+        build_id = 'lock_database_%d' % os.getpid()
+        unlock = lock_database(connection, self.path, build_id)
+        try:
+            # Locks are per process, so another one checks whether it's held
+            pid = os.fork()
+            if not pid:
+                try:
+                    lock_database(connection, self.path, build_id)
+                finally:
+                    os._exit(1)
+            time.sleep(0.5)
+            self.assertEquals(os.waitpid(pid, os.WNOHANG), (0, 0))
+        finally:
+            unlock()
+        self.assertEquals(os.waitpid(pid, 0)[1] >> 8, 1)
+
+        # The lock file is kept for waiters, until the build is over
+        locks = glob.glob(os.path.join(LOCK_DIR, 'mule:db_setup_%s_*' % build_id))
+        self.assertEquals(len(locks), 1)
+        remove_build_files(build_id)
+        self.assertFalse(os.path.exists(locks[0]))
+
+    def test_fingerprint(self):
+        connection = SQLiteConnection(self.path)
+        self.assertEquals(read_fingerprint(connection), None)
+        write_fingerprint(connection, 'abc')
+        self.assertEquals(read_fingerprint(connection), 'abc')
+        # Replaced rather than added to
+        write_fingerprint(connection, 'def')
+        self.assertEquals(read_fingerprint(SQLiteConnection(self.path)), 'def')
+
 class PanelTestCase(TestCase):
     def test_provision(self):
         panel = Dingus('Panel')
@@ -135,4 +802,147 @@ class PanelTestCase(TestCase):
         self.assertTrue(len(calls['add_consumer_from_dict']), 1)
         call = calls['add_consumer_from_dict'][0]
         self.assertTrue('queue' in call[1])
-        self.assertEquals(call[1]['queue'], conf.DEFAULT_QUEUE)
\ No newline at end of file
+        self.assertEquals(call[1]['queue'], conf.DEFAULT_QUEUE)
+
+class TimingStoreTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'timings.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sort_jobs(self):
+        timings = TimingStore(self.path)
+        timings.record('a.Fast', 1)
+        timings.record('a.Slow', 10)
+        # unknown jobs are assumed to be average
+        self.assertEquals(timings.sort_jobs(['a.Fast', 'a.New', 'a.Slow']), ['a.Slow', 'a.New', 'a.Fast'])
+
+    def test_persistence(self):
+        timings = TimingStore(self.path)
+        timings.record_result({'job': 'a.B a.C', 'timeStarted': 10, 'timeFinished': 14})
+        timings.save()
+
+        timings = TimingStore(self.path)
+        self.assertEquals(timings.get('a.B'), 2.0)
+        self.assertEquals(timings.estimate('a.B a.C'), 4.0)
+        self.assertEquals(timings.estimate('a.D'), None)
+
+class BuildJobsTestCase(TestCase):
+    def test_split_methods(self):
+        loader = MuleTestLoader(split_methods=2)
+        suite = loader.loader.loadTestsFromTestCase(PanelTestCase)
+        suite.addTests(loader.loader.loadTestsFromTestCase(RunTestTestCase))
+        suite.addTests(loader.loader.loadTestsFromTestCase(TimingStoreTestCase))
+        jobs = loader.build_jobs(loader.loader.suiteClass(list(suite)))
+        self.assertEquals(jobs, [PanelTestCase, RunTestTestCase, TimingStoreTestCase])
+
+        loader.split_methods = 1
+        jobs = loader.build_jobs(loader.loader.suiteClass(list(suite)))
+        self.assertEquals(len(jobs), 6)
+        self.assertEquals(jobs[0], 'mule.tests.PanelTestCase.test_provision')
+
+    def test_batch(self):
+        loader = MuleTestLoader(batch=True, max_workers=1)
+        loader.timings = TimingStore()
+        jobs = ['a.Slow', 'a.Fast1', 'a.Fast2', 'a.Fast3']
+        # Nothing is batched until we know how much overhead there is
+        self.assertEquals(loader.batch_jobs(jobs), jobs)
+
+        loader.timings.record_result({'job': 'a.Slow a.Fast1 a.Fast2 a.Fast3', 'timeStarted': 0, 'timeFinished': 83,
+                                      'timings': {'a.Slow': 80, 'a.Fast1': 0.5, 'a.Fast2': 0.5, 'a.Fast3': 1}})
+        self.assertEquals(loader.timings.overhead, 1.0)
+        self.assertEquals(loader.batch_jobs(jobs), ['a.Slow', 'a.Fast3 a.Fast1 a.Fast2'])
+
+        # TestCase's in different groups are never batched together
+        groups = {'a.Fast1': 'transaction', 'a.Fast2': 'transaction'}
+        self.assertEquals(loader.batch_jobs(jobs, groups), ['a.Slow', 'a.Fast3', 'a.Fast1 a.Fast2'])
+
+        # TestCase's we have no timings for are run on their own
+        new = ['a.New%d' % i for i in xrange(40)]
+        self.assertEquals(loader.batch_jobs(jobs + new), ['a.Slow'] + new + ['a.Fast3 a.Fast1 a.Fast2'])
+
+    def test_merge_reports(self):
+        report = '<?xml version="1.0" ?><testsuite errors="%d" failures="0" name="a.B" skips="0" tests="1" time="1.000">' \
+                 '<testcase classname="a.B" name="%s" time="1.000"/><system-out><![CDATA[]]></system-out>' \
+                 '<system-err><![CDATA[]]></system-err></testsuite>'
+        merged = merge_reports(report % (0, 'test_foo'), report % (1, 'test_bar'))
+        self.assertTrue('errors="1"' in merged)
+        self.assertTrue('tests="2"' in merged)
+        self.assertTrue('time="2.000"' in merged)
+        self.assertTrue('name="test_foo"' in merged)
+        self.assertTrue('name="test_bar"' in merged)
+
+class ResultAggregatorTestCase(TestCase):
+    report = '<?xml version="1.0" ?><testsuite errors="0" failures="%d" name="a.%s" skips="0" tests="2" time="1.000">' \
+             '<testcase classname="a.%s" name="test_foo" time="1.000"/><system-out><![CDATA[]]></system-out>' \
+             '<system-err><![CDATA[]]></system-err></testsuite>'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_streaming(self):
+        stream = StringIO()
+        aggregator = ResultAggregator(xunit=True, xunit_output=self.tmpdir, stream=stream)
+        result = {'job': 'a.B a.C', 'stdout': (self.report % (0, 'B', 'B')) + (self.report % (1, 'C', 'C')), 'stderr': ''}
+        self.assertEquals(aggregator.add(result), 1)
+        self.assertEquals(result['timings'], {'a.B': 1.0, 'a.B.test_foo': 1.0, 'a.C': 1.0, 'a.C.test_foo': 1.0})
+        self.assertEquals(sorted(os.listdir(self.tmpdir)), ['a.B.xml', 'a.C.xml'])
+
+        self.assertEquals(aggregator.add({'job': 'a.D', 'stdout': '', 'stderr': 'ImportError'}), 1)
+        self.assertEquals(aggregator.add('Traceback'), 1)
+
+        self.assertEquals(aggregator.summary(1.0), 3)
+        self.assertTrue('Ran 6 tests' in stream.getvalue())
+        self.assertTrue('FAILED (failures=1, errors=2)' in stream.getvalue())
+
+    def test_rusage_report(self):
+        result = run_test('build_id', 'echo $TEST', 'a.B')
+        self.assertEquals(sorted(result['rusage']),
+                          ['inblock', 'maxrss', 'nivcsw', 'nvcsw', 'oublock', 'stime', 'utime'])
+
+        stream = StringIO()
+        aggregator = ResultAggregator(stream=stream, rusage_report_size=1)
+        aggregator.add(result)
+        result = dict(result, job='a.C', rusage=dict(result['rusage'], utime=result['rusage']['utime'] + 10))
+        aggregator.add(result)
+        aggregator.summary(1.0)
+        self.assertTrue('Top jobs by CPU time:\n' in stream.getvalue())
+        self.assertTrue('s  a.C\n' in stream.getvalue())
+        self.assertFalse('s  a.B\n' in stream.getvalue())
+
+    def test_structured_report(self):
+        class SampleTestCase(TestCase):
+            def test_pass(self):
+                pass
+            def test_fail(self):
+                self.fail('broken')
+            def test_unicode(self):
+                raise ValueError(u'caf\xe9')
+
+        output = StringIO()
+        JSONTestRunner(output=output, stream=StringIO(), verbosity=0).run(
+            loader.loadTestsFromTestCase(SampleTestCase))
+        result = make_result('build_id', 'mule.tests.SampleTestCase', 0, 1, (output.getvalue(), '', 1))
+        self.assertEquals(result['stdout'], '')
+        self.assertEquals(result['report']['tests'], 3)
+        self.assertEquals(result['report']['failures'], 1)
+        self.assertEquals(result['report']['errors'], 1)
+        self.assertEquals(result['report']['testsuites'][0]['tests'][-1]['message'], u'caf\xe9')
+
+        stream = StringIO()
+        aggregator = ResultAggregator(xunit=True, xunit_output=self.tmpdir, stream=stream)
+        self.assertEquals(aggregator.add(result), 2)
+        self.assertTrue('mule.tests.SampleTestCase.test_fail' in result['timings'])
+        fp = open(os.path.join(self.tmpdir, 'mule.tests.SampleTestCase.xml'))
+        try:
+            xml = fp.read()
+        finally:
+            fp.close()
+        self.assertTrue('failures="1"' in xml)
+        self.assertTrue('broken' in xml)
+        self.assertTrue('caf\xc3\xa9' in xml)
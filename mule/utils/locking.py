@@ -5,19 +5,25 @@ LOCK_DIR = '/var/tmp'
 
 locks = {}
 
-def acquire_lock(lock):
+def acquire_lock(lock, blocking=False):
     fd = open(lock, 'w')
-    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB) # NB = non-blocking (raise IOError instead)
+    if blocking:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+    else:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB) # NB = non-blocking (raise IOError instead)
     fd.write(str(os.getpid()))
     locks[lock] = fd
 
-def release_lock(lock):
+def release_lock(lock, remove=True):
     fd = locks.pop(lock)
     if not fd:
         return
     fcntl.lockf(fd, fcntl.LOCK_UN)
     fd.close()
-    os.remove(lock)
+    # Locks which are blocked on are kept, as a waiter would otherwise be left holding
+    # a removed file while the next process locks a new one
+    if remove:
+        os.remove(lock)
     fd = None
     
 def get_setting_lock(setting, build_id, max_locks=None):
@@ -0,0 +1,61 @@
+"""
+Bounded capture of the output of jobs.
+
+Output is written straight to (unlinked) temporary files rather than pipes, so no
+matter how much a job prints, only the head and tail which are kept are ever read
+into memory.
+"""
+from __future__ import absolute_import
+
+from mule import conf
+
+import os
+import tempfile
+
+def get_output_file(prefix='mule'):
+    return tempfile.TemporaryFile(prefix=prefix)
+
+def _join(head, dropped, tail):
+    return '%s\n\n... [%d bytes truncated] ...\n\n%s' % (head, dropped, tail)
+
+def truncate_output(data, limit=None, head_ratio=None):
+    """
+    Returns ``data``, keeping only its head and tail (as ``read_output`` does) if it's
+    longer than ``limit``.
+    """
+    if head_ratio is None:
+        head_ratio = conf.OUTPUT_HEAD_RATIO
+
+    if limit is None or len(data) <= limit:
+        return data
+
+    head_size = int(limit * head_ratio)
+    tail_size = limit - head_size
+    return _join(data[:head_size], len(data) - head_size - tail_size,
+                 data[len(data) - tail_size:])
+
+def read_output(fp, limit=None, head_ratio=None):
+    """
+    Returns what was written to ``fp``. If there are more than ``limit`` bytes only
+    the start (``head_ratio`` of the limit) and end are kept, with a marker
+    showing how much was dropped in between.
+    """
+    if head_ratio is None:
+        head_ratio = conf.OUTPUT_HEAD_RATIO
+
+    fp.flush()
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    fp.seek(0)
+
+    if limit is None or size <= limit:
+        return fp.read()
+
+    head_size = int(limit * head_ratio)
+    tail_size = limit - head_size
+
+    head = fp.read(head_size)
+    fp.seek(size - tail_size)
+    tail = fp.read(tail_size)
+
+    return _join(head, size - head_size - tail_size, tail)
@@ -0,0 +1,212 @@
+"""
+Tracks the process groups of running jobs so that a build can be cancelled
+immediately (e.g. with --failfast), rather than waiting for each job to finish.
+
+Process groups are recorded on disk as they may be started by a different process
+than the one cancelling the build (e.g. a Celery pool process vs. the worker).
+"""
+from __future__ import absolute_import
+
+from mule import conf
+from mule.utils.locking import LOCK_DIR
+
+import errno
+import glob
+import os, os.path
+import signal
+import sys
+import threading
+import time
+import traceback
+
+# Sent to a hung job before it is killed, so runners can tell us where they're stuck
+DUMP_SIGNAL = signal.SIGUSR1
+
+# Files in LOCK_DIR which are only used while a build is running (``%s`` is its id)
+BUILD_FILES = (
+    # Locks taken while building the build's template databases
+    'mule:db_template_%s_*',
+    # Locks taken while setting up each slot's databases (other than Postgres')
+    'mule:db_setup_%s_*',
+    # The modules its workers import to set up databases
+    'mule:setup_modules_%s.json',
+)
+
+def _job_path(build_id, pgid):
+    return os.path.join(LOCK_DIR, 'mule:job_%s_%s' % (build_id, pgid))
+
+def _finished_path(build_id):
+    return os.path.join(LOCK_DIR, 'mule:finished_%s' % (build_id,))
+
+def _revoked_path(build_id, key):
+    return os.path.join(LOCK_DIR, 'mule:revoked_%s_%s' % (build_id, key))
+
+def register_process(build_id, pgid, key=None):
+    """
+    Records the process group ``pgid`` as running a job of ``build_id`` (identified
+    by ``key``, e.g. its task id, if given), and returns whether the job has already
+    been cancelled, as its build has finished or it was revoked (see ``kill_job``).
+
+    A job cancelled between its process starting and it being registered won't
+    have been killed, so a cancelled job must kill itself.
+    """
+    with open(_job_path(build_id, pgid), 'w') as fp:
+        fp.write(key or '')
+    if key and os.path.exists(_revoked_path(build_id, key)):
+        return True
+    return is_build_finished(build_id)
+
+def unregister_process(build_id, pgid):
+    try:
+        os.remove(_job_path(build_id, pgid))
+    except OSError:
+        pass
+
+def _signal_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except OSError, e:
+        if e.errno != errno.ESRCH:
+            raise
+        return False
+    return True
+
+def kill_process_group(pgid, grace=None, leader=None):
+    """
+    Terminates a process group, giving it ``grace`` seconds to exit before it is killed.
+
+    If the group's ``leader`` is our child (a ``Popen``) it's reaped as soon as it
+    exits, as until then its zombie keeps the group alive.
+    """
+    if grace is None:
+        grace = conf.KILL_GRACE
+
+    if not _signal_group(pgid, signal.SIGTERM):
+        return
+
+    deadline = time.time() + grace
+    while time.time() < deadline:
+        if leader is not None:
+            leader.poll()
+        if not _signal_group(pgid, 0):
+            return
+        time.sleep(0.05)
+    _signal_group(pgid, signal.SIGKILL)
+
+def dump_stacks(signum=None, frame=None, stream=None):
+    """
+    Writes the stack of every thread in this process to ``stream`` (stderr by default).
+    """
+    stream = stream or sys.__stderr__
+    names = dict((t.ident, t.name) for t in threading.enumerate())
+    for ident, stack in sys._current_frames().items():
+        stream.write('\nThread %s (%s), most recent call last:\n' % (names.get(ident, 'unknown'), ident))
+        stream.write(''.join(traceback.format_stack(stack)))
+    stream.flush()
+
+def install_stack_dump_handler():
+    """
+    Dumps this process's stacks to stderr when it receives ``DUMP_SIGNAL`` (e.g. as
+    its job is timing out).
+    """
+    signal.signal(DUMP_SIGNAL, dump_stacks)
+
+def dump_process_group(pgid, wait=None):
+    """
+    Asks each process in a (hung) process group to dump its stacks, and gives them
+    ``wait`` seconds to do so.
+
+    Processes which have no handler for ``DUMP_SIGNAL`` will exit.
+    """
+    if wait is None:
+        wait = conf.TIMEOUT_DUMP_WAIT
+
+    if _signal_group(pgid, DUMP_SIGNAL):
+        time.sleep(wait)
+
+def _get_job_pgids(build_id):
+    prefix = _job_path(build_id, '')
+    return [int(p[len(prefix):]) for p in glob.glob(prefix + '*')]
+
+def kill_job(build_id, key):
+    """
+    Kills the process group of the job of ``build_id`` registered with ``key`` (e.g.
+    the losing copy of a job which was re-run speculatively), or stops it from
+    starting if it hasn't yet. Returns the number of process groups killed.
+    """
+    open(_revoked_path(build_id, key), 'w').close()
+
+    num_killed = 0
+    for pgid in _get_job_pgids(build_id):
+        try:
+            with open(_job_path(build_id, pgid)) as fp:
+                if fp.read() != key:
+                    continue
+        except IOError:
+            # It has just finished
+            continue
+        kill_process_group(pgid)
+        unregister_process(build_id, pgid)
+        num_killed += 1
+    return num_killed
+
+def kill_build(build_id):
+    """
+    Kills the process groups of all running jobs (on this machine) for ``build_id``.
+    """
+    pgids = _get_job_pgids(build_id)
+    num_killed = len(pgids)
+
+    for pgid in pgids:
+        _signal_group(pgid, signal.SIGTERM)
+
+    deadline = time.time() + conf.KILL_GRACE
+    while pgids and time.time() < deadline:
+        pgids = [p for p in pgids if _signal_group(p, 0)]
+        time.sleep(0.05)
+
+    for pgid in pgids:
+        _signal_group(pgid, signal.SIGKILL)
+
+    # Registrations left behind by processes which never unregistered (e.g. their
+    # Celery pool process was terminated)
+    for pgid in _get_job_pgids(build_id):
+        unregister_process(build_id, pgid)
+    for path in glob.glob(_revoked_path(build_id, '*')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    return num_killed
+
+def mark_build_finished(build_id):
+    """
+    Records that ``build_id`` is over, so any of its jobs which were already
+    delivered to a worker (e.g. prefetched) are skipped instead of run.
+    """
+    open(_finished_path(build_id), 'w').close()
+
+    # Clean up after old builds
+    cutoff = time.time() - 86400
+    for path in glob.glob(_finished_path('*')):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+def is_build_finished(build_id):
+    return os.path.exists(_finished_path(build_id))
+
+def remove_build_files(build_id):
+    """
+    Removes the files (see ``BUILD_FILES``) which were left behind by ``build_id``,
+    once it's over.
+    """
+    for pattern in BUILD_FILES:
+        for path in glob.glob(os.path.join(LOCK_DIR, pattern % (build_id,))):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,183 @@
+"""
+Sizing and placement of local (``--multiprocess``) workers, based on the resources
+this machine actually has available to us rather than its number of CPUs.
+"""
+from __future__ import absolute_import
+
+from mule import conf
+
+import logging
+import math
+import multiprocessing
+import os, os.path
+import subprocess
+
+# Whether ``taskset`` is installed, once we've looked (see ``has_taskset``)
+_has_taskset = None
+
+def _read(path):
+    try:
+        with open(path, 'r') as fp:
+            return fp.read().strip()
+    except (IOError, OSError):
+        return None
+
+def parse_cpu_list(value):
+    """
+    Parses a list of CPUs in the format used by the kernel (e.g. ``0-3,8,10-11``).
+    """
+    cpus = []
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            (start, end) = part.split('-', 1)
+            cpus.extend(xrange(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+def get_allowed_cpus():
+    """
+    Returns the CPUs we're allowed to run on (e.g. restricted by a cpuset or ``taskset``).
+    """
+    status = _read('/proc/self/status') or ''
+    for line in status.splitlines():
+        if line.startswith('Cpus_allowed_list:'):
+            try:
+                return parse_cpu_list(line.split(':', 1)[1])
+            except ValueError:
+                break
+    return range(multiprocessing.cpu_count())
+
+def get_cpu_quota():
+    """
+    Returns the number of CPUs worth of time our cgroup is allowed to use, or None
+    if there is no quota.
+    """
+    # cgroup v2
+    value = _read('/sys/fs/cgroup/cpu.max')
+    if value:
+        (quota, period) = (value.split() + ['100000'])[:2]
+        if quota == 'max':
+            return None
+        return float(quota) / float(period)
+
+    # cgroup v1
+    quota = _read('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and int(quota) > 0:
+        return float(quota) / float(period)
+    return None
+
+def get_available_memory():
+    """
+    Returns the number of bytes of memory available to us (taking our cgroup's limit
+    into account), or None if it can't be determined.
+    """
+    available = None
+    meminfo = _read('/proc/meminfo') or ''
+    for line in meminfo.splitlines():
+        if line.startswith('MemAvailable:'):
+            available = int(line.split()[1]) * 1024
+            break
+
+    for limit_path, usage_path in (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+                                    '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        limit, usage = _read(limit_path), _read(usage_path)
+        if not limit or not limit.isdigit() or not usage or not usage.isdigit():
+            continue
+        cgroup_available = max(0, int(limit) - int(usage))
+        # Unlimited cgroups report a huge limit rather than none
+        if available is None or cgroup_available < available:
+            available = cgroup_available
+        break
+
+    return available
+
+def get_auto_workers(memory_per_worker=None, logger=None):
+    """
+    Returns how many local workers we should run: no more than the CPUs which are
+    allowed by our affinity and cgroup quota and aren't already busy (by the load
+    average), or than fit in the available memory.
+    """
+    if memory_per_worker is None:
+        memory_per_worker = conf.WORKER_MEMORY
+
+    cpus = len(get_allowed_cpus())
+
+    quota = get_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, int(math.ceil(quota)))
+
+    try:
+        load = os.getloadavg()[0]
+    except OSError:
+        load = 0.0
+    idle = int(cpus - load)
+
+    workers = min(cpus, idle)
+
+    memory = get_available_memory()
+    if memory is not None and memory_per_worker:
+        workers = min(workers, memory // memory_per_worker)
+
+    workers = max(1, int(workers))
+
+    if logger:
+        logger.info('Using %d worker(s) (cpus=%d, quota=%s, load=%.2f, memory=%s)',
+                    workers, cpus, quota, load, memory)
+
+    return workers
+
+def get_slot_cpus(num_slots, cpus=None):
+    """
+    Splits ``cpus`` (by default, those we're allowed to run on) into a dedicated,
+    contiguous set for each of ``num_slots`` slots. If there are more slots than CPUs,
+    slots have to share.
+    """
+    if cpus is None:
+        cpus = get_allowed_cpus()
+    if num_slots <= len(cpus):
+        size = len(cpus) // num_slots
+        return [cpus[i * size:(i + 1) * size] for i in xrange(num_slots)]
+    return [[cpus[i % len(cpus)]] for i in xrange(num_slots)]
+
+def format_cpu_list(cpus):
+    return ','.join(str(c) for c in cpus)
+
+def has_taskset():
+    """
+    Returns whether ``taskset`` (which pins processes to CPUs) is installed, warning
+    the first time if it isn't.
+    """
+    global _has_taskset
+    if _has_taskset is None:
+        paths = os.environ.get('PATH', os.defpath).split(os.pathsep)
+        _has_taskset = any(os.access(os.path.join(p, 'taskset'), os.X_OK) for p in paths)
+        if not _has_taskset:
+            logging.getLogger('mule').warning('taskset is not installed, workers will not be pinned to CPUs')
+    return _has_taskset
+
+def pin_command(args, cpus):
+    """
+    Returns ``args`` prefixed so the command (and everything it starts) only runs on ``cpus``.
+    Without ``taskset`` the command is run unpinned.
+    """
+    if not has_taskset():
+        return list(args)
+    return ['taskset', '-c', format_cpu_list(cpus)] + list(args)
+
+def pin_process(pid, cpus):
+    """
+    Restricts all threads of an already running process to ``cpus``.
+    """
+    if not has_taskset():
+        return
+    with open(os.devnull, 'w') as devnull:
+        returncode = subprocess.call(['taskset', '-a', '-p', '-c', format_cpu_list(cpus), str(pid)],
+                                     stdout=devnull, stderr=devnull)
+    if returncode:
+        logging.getLogger('mule').warning('Unable to pin process %s to CPUs %s', pid, format_cpu_list(cpus))
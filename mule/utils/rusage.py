@@ -0,0 +1,94 @@
+"""
+Resource usage accounting for jobs, so we can tell which are CPU bound, memory
+hogs or I/O heavy.
+"""
+from __future__ import absolute_import
+
+import errno
+import os
+import resource
+import subprocess
+import time
+
+# Fields of ``struct rusage`` which are reported for each job. Times are in seconds
+# and maxrss is in kilobytes (on Linux).
+RUSAGE_FIELDS = ('utime', 'stime', 'maxrss', 'inblock', 'oublock', 'nvcsw', 'nivcsw')
+
+def rusage_to_dict(rusage):
+    return dict((f, getattr(rusage, 'ru_%s' % f)) for f in RUSAGE_FIELDS)
+
+def rusage_delta(before, after):
+    """
+    Returns the resources used between two ``rusage_to_dict`` snapshots. As maxrss
+    is a high water mark rather than a counter, the later value is kept.
+    """
+    delta = dict((f, after[f] - before[f]) for f in RUSAGE_FIELDS)
+    delta['maxrss'] = after['maxrss']
+    return delta
+
+def get_self_rusage():
+    """
+    Returns the resources used by this process and its (reaped) children.
+    """
+    usage = rusage_to_dict(resource.getrusage(resource.RUSAGE_SELF))
+    children = rusage_to_dict(resource.getrusage(resource.RUSAGE_CHILDREN))
+    for f in RUSAGE_FIELDS:
+        if f == 'maxrss':
+            usage[f] = max(usage[f], children[f])
+        else:
+            usage[f] += children[f]
+    return usage
+
+class Popen(subprocess.Popen):
+    """
+    A ``subprocess.Popen`` which reaps its child with ``wait4`` and keeps its
+    resource usage (as ``rusage``).
+
+    ``getrusage(RUSAGE_CHILDREN)`` can't be used as it would include the children
+    of other threads.
+
+    If the child is reaped by someone else, how it exited is lost: it's given a
+    returncode of -1 (so it never looks like it succeeded) and ``status_lost`` is set.
+    """
+    rusage = None
+    status_lost = False
+
+    def _reap(self, options=0):
+        try:
+            (pid, status, rusage) = os.wait4(self.pid, options)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                return
+            if e.errno != errno.ECHILD:
+                raise
+            # Someone else reaped it, we can't know how it exited
+            self.status_lost = True
+            self.returncode = -1
+            return
+        if pid == self.pid:
+            self.rusage = rusage_to_dict(rusage)
+            self._handle_exitstatus(status)
+
+    def poll(self):
+        return self.wait(0)
+
+    def wait(self, timeout=None):
+        """
+        Waits for the child to exit, and returns its returncode. If ``timeout`` is
+        given and the child is still running after that many seconds, returns None.
+        """
+        if timeout is None:
+            while self.returncode is None:
+                self._reap()
+            return self.returncode
+
+        deadline = time.time() + timeout
+        delay = 0.001
+        while self.returncode is None:
+            self._reap(os.WNOHANG)
+            remaining = deadline - time.time()
+            if self.returncode is not None or remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+        return self.returncode
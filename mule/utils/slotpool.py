@@ -0,0 +1,237 @@
+"""
+A pool of slots (e.g. a worker's set of test databases) which are prepared ahead of
+time, and leased to local workers over a UNIX socket.
+
+A slot stays leased for as long as the connection it was leased over is open, so the
+slot of a worker which dies is reclaimed as soon as the kernel closes its socket.
+Slots which come back are prepared again (e.g. their databases are reset) in the
+background, before they're leased to anyone else.
+"""
+from __future__ import absolute_import
+
+from mule.utils.locking import LOCK_DIR, acquire_lock, lock_for_setting
+from mule.utils.processes import kill_build
+
+import errno
+import fcntl
+import json
+import logging
+import multiprocessing
+import os, os.path
+import socket
+import threading
+
+DIRTY, PREPARING, READY, LEASED, BROKEN = 'dirty', 'preparing', 'ready', 'leased', 'broken'
+
+def get_pool_path(build_id):
+    return os.path.join(LOCK_DIR, 'mule:slot_pool_%s.sock' % (build_id,))
+
+def _set_cloexec(sock):
+    # Subprocesses (e.g. started by a test) mustn't keep a lease alive
+    flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+    fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+def _read_line(sock):
+    data = ''
+    while not data.endswith('\n'):
+        chunk = sock.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+class SlotPool(object):
+    """
+    Keeps ``size`` slots (numbered from 0) ready, calling ``prepare(num)`` (from a
+    thread of its own for each slot) whenever a slot needs preparing. A slot which
+    fails to be prepared is never leased.
+
+    If ``prepare`` runs scripts as jobs of ``build_id`` (see ``mule.utils.processes``),
+    any which are still running are killed when the pool is stopped.
+
+    If ``lock_setting`` is given, the pool holds the ``build_id`` locks of that setting
+    for each of its slots (see ``mule.utils.locking.get_setting_lock``), so workers which
+    number their slots with those locks instead (e.g. as they couldn't lease one) never
+    get a slot the pool leases to someone else.
+    """
+    def __init__(self, size, prepare, path, logger=None, build_id=None, lock_setting=None):
+        self.size = size
+        self.build_id = build_id
+        self.lock_setting = lock_setting
+        self.locked = multiprocessing.Event()
+        self.prepare = prepare
+        self.path = path
+        self.logger = logger or logging.getLogger('mule')
+        self.states = [DIRTY] * size
+        self.condition = threading.Condition()
+        self.sock = None
+        self.process = None
+
+    def _set_state(self, num, state):
+        with self.condition:
+            self.states[num] = state
+            self.condition.notify_all()
+
+    def _refill(self, num):
+        while True:
+            with self.condition:
+                while self.states[num] != DIRTY:
+                    self.condition.wait()
+                self.states[num] = PREPARING
+
+            try:
+                self.prepare(num)
+            except Exception:
+                self.logger.exception('Unable to prepare slot %d', num)
+                self._set_state(num, BROKEN)
+            else:
+                self._set_state(num, READY)
+
+    def _lease(self):
+        with self.condition:
+            while True:
+                if READY in self.states:
+                    num = self.states.index(READY)
+                    self.states[num] = LEASED
+                    return num
+                if all(s == BROKEN for s in self.states):
+                    return None
+                self.condition.wait()
+
+    def _serve_client(self, conn):
+        try:
+            pid = _read_line(conn).strip()
+            num = self._lease()
+            if num is None:
+                conn.sendall(json.dumps({'slot': None}) + '\n')
+                return
+
+            self.logger.info('Leased slot %d to process %s', num, pid)
+            try:
+                conn.sendall(json.dumps({'slot': num}) + '\n')
+                # Wait for the worker to release the slot (or die)
+                while conn.recv(4096):
+                    pass
+            except socket.error:
+                pass
+            finally:
+                self.logger.info('Slot %d was released by process %s', num, pid)
+                self._set_state(num, DIRTY)
+        finally:
+            conn.close()
+
+    def bind(self):
+        if os.path.exists(self.path):
+            # Left behind by a pool which was killed
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _set_cloexec(self.sock)
+        self.sock.bind(self.path)
+        self.sock.listen(128)
+
+    def serve(self):
+        """
+        Prepares every slot, and leases them to whoever connects until the process exits.
+        """
+        if self.sock is None:
+            self.bind()
+
+        if self.lock_setting is not None:
+            # Held until the process exits
+            for num in xrange(self.size):
+                acquire_lock(lock_for_setting(self.lock_setting, self.build_id, num), blocking=True)
+        self.locked.set()
+
+        for num in xrange(self.size):
+            thread = threading.Thread(target=self._refill, args=(num,))
+            thread.daemon = True
+            thread.start()
+
+        while True:
+            try:
+                (conn, addr) = self.sock.accept()
+            except socket.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            _set_cloexec(conn)
+            thread = threading.Thread(target=self._serve_client, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def start(self):
+        """
+        Serves the pool from a process of its own, so that workers which are forked from
+        this one later (e.g. by a ``ForkServer``) don't hold on to other workers' leases.
+        """
+        self.bind()
+        self.process = multiprocessing.Process(target=self.serve)
+        self.process.daemon = True
+        self.process.start()
+        # Only the pool's process accepts connections
+        self.sock.close()
+        self.sock = None
+        # Locks are held by a process, so the pool's can only be taken from its own
+        while self.process.is_alive() and not self.locked.wait(0.1):
+            pass
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+            # Scripts run in sessions of their own, so they outlive the pool's process
+            if self.build_id:
+                kill_build(self.build_id)
+            if self.lock_setting is not None:
+                for num in xrange(self.size):
+                    try:
+                        os.remove(lock_for_setting(self.lock_setting, self.build_id, num))
+                    except OSError:
+                        pass
+        self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class SlotLease(object):
+    def __init__(self, sock, slot):
+        self.sock = sock
+        self.slot = slot
+
+    def release(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+def lease_slot(path, timeout=None):
+    """
+    Leases a slot from the ``SlotPool`` listening at ``path``, waiting up to ``timeout``
+    seconds for one to be ready. Returns a ``SlotLease``, or None if there is no pool
+    (or none of its slots could be prepared).
+    """
+    if not os.path.exists(path):
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    _set_cloexec(sock)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall('%d\n' % os.getpid())
+        response = _read_line(sock)
+        slot = json.loads(response).get('slot') if response else None
+    except (socket.error, ValueError):
+        sock.close()
+        return None
+
+    if slot is None:
+        sock.close()
+        return None
+
+    sock.settimeout(None)
+    return SlotLease(sock, slot)
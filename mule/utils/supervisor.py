@@ -0,0 +1,141 @@
+"""
+Runs many jobs concurrently from a single thread.
+
+Rather than blocking a thread per job, the supervisor starts up to ``max_jobs``
+at once and sleeps in ``select`` until one of their pipes is readable, a child
+exits (``SIGCHLD``) or a job's deadline passes.
+
+A job is any object with the following interface:
+
+- ``start(slot)`` starts the job in ``slot`` (0 to ``max_jobs - 1``), which no other
+  running job is using.
+- ``fileno()`` returns a file descriptor which becomes readable once the job has
+  finished, or None if it's finished when its child exits.
+- ``poll()`` returns the job's result, or None if it's still running.
+- ``deadline`` is the time by which the job must finish, or None.
+- ``expire()`` kills the job (as it missed its deadline) and returns its result.
+- ``cancel()`` kills the job and returns its result.
+"""
+from __future__ import absolute_import
+
+from collections import deque
+
+import errno
+import fcntl
+import os
+import select
+import signal
+import time
+
+class Supervisor(object):
+    def __init__(self, max_jobs, poll_interval=0.1):
+        self.max_jobs = max_jobs
+        # How often children are checked on when SIGCHLD can't be used (e.g. we aren't
+        # running in the main thread)
+        self.poll_interval = poll_interval
+        self.running = []
+        # Results which are yet to be yielded
+        self.finished = deque()
+
+    def _install_sigchld(self):
+        (r, w) = os.pipe()
+        for fd in (r, w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        try:
+            old_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        except ValueError:
+            # Signals can only be handled in the main thread
+            os.close(r)
+            os.close(w)
+            return None
+        # Don't interrupt blocking calls (e.g. reading a result), the wakeup fd is enough
+        signal.siginterrupt(signal.SIGCHLD, False)
+        old_wakeup_fd = signal.set_wakeup_fd(w)
+        return (r, w, old_handler, old_wakeup_fd)
+
+    def _uninstall_sigchld(self, state):
+        (r, w, old_handler, old_wakeup_fd) = state
+        signal.set_wakeup_fd(old_wakeup_fd)
+        signal.signal(signal.SIGCHLD, old_handler)
+        os.close(r)
+        os.close(w)
+
+    def run(self, jobs):
+        """
+        Runs ``jobs``, yielding each one's result as it finishes.
+        """
+        pending = deque(jobs)
+        running = self.running = []
+        finished = self.finished = deque()
+        free_slots = range(self.max_jobs - 1, -1, -1)
+        slots = {}
+
+        sigchld = self._install_sigchld()
+        try:
+            readable = set()
+            while pending or running:
+                while pending and len(running) < self.max_jobs:
+                    job = pending.popleft()
+                    slots[job] = free_slots.pop()
+                    job.start(slots[job])
+                    running.append(job)
+
+                now = time.time()
+                for job in running[:]:
+                    if job.deadline is not None and now >= job.deadline:
+                        result = job.expire()
+                    elif job.fileno() is None or job.fileno() in readable:
+                        result = job.poll()
+                    else:
+                        continue
+                    if result is not None:
+                        running.remove(job)
+                        free_slots.append(slots.pop(job))
+                        finished.append(result)
+
+                if finished:
+                    while finished:
+                        yield finished.popleft()
+                    # Start the next jobs before waiting on anything
+                    readable = set()
+                    continue
+
+                fds = [job.fileno() for job in running if job.fileno() is not None]
+
+                timeout = None
+                deadlines = [job.deadline for job in running if job.deadline is not None]
+                if deadlines:
+                    timeout = max(0, min(deadlines) - time.time())
+                if sigchld is None and len(fds) < len(running):
+                    timeout = min(timeout, self.poll_interval) if timeout is not None else self.poll_interval
+                if sigchld is not None:
+                    fds.append(sigchld[0])
+
+                try:
+                    readable = set(select.select(fds, [], [], timeout)[0])
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    readable = set()
+
+                if sigchld is not None and sigchld[0] in readable:
+                    try:
+                        while os.read(sigchld[0], 4096):
+                            pass
+                    except OSError, e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+        finally:
+            if sigchld is not None:
+                self._uninstall_sigchld(sigchld)
+
+    def cancel(self):
+        """
+        Kills all running jobs, and returns their results (along with any results
+        which weren't yielded yet).
+        """
+        results = list(self.finished)
+        self.finished.clear()
+        while self.running:
+            results.append(self.running.pop(0).cancel())
+        return results
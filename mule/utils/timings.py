@@ -0,0 +1,134 @@
+from __future__ import absolute_import
+
+import json
+import os, os.path
+import tempfile
+
+# Key under which the per-job overhead (process startup, bootstrapping, etc) is stored
+OVERHEAD = '__overhead__'
+
+class TimingStore(object):
+    """
+    Persists how long each test label has historically taken so that the
+    dispatcher can send the longest jobs first (LPT ordering).
+
+    A job is a string of one or more whitespace separated labels (the same
+    value which is substituted for ``$TEST``), e.g. ``path.to.TestCase``.
+    """
+    def __init__(self, path=None, weight=0.5):
+        self.path = path
+        # weight given to the newest sample in the moving average
+        self.weight = weight
+        self.timings = {}
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as fp:
+                timings = json.load(fp)
+        except (IOError, ValueError):
+            # A corrupt store should never break a build
+            return
+        if isinstance(timings, dict):
+            self.timings = timings
+
+    def save(self):
+        if not self.path:
+            return
+
+        dirname = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        # Write to a temporary file first so concurrent builds never see a partial store
+        (h, tmp_path) = tempfile.mkstemp(prefix='timings', dir=dirname)
+        with os.fdopen(h, 'w') as fp:
+            json.dump(self.timings, fp)
+        os.rename(tmp_path, self.path)
+
+    def get(self, label, default=None):
+        return self.timings.get(label, default)
+
+    @property
+    def overhead(self):
+        """
+        The average time a job spends outside of its tests (e.g. starting
+        the runner and bootstrapping the environment), if known.
+        """
+        return self.timings.get(OVERHEAD)
+
+    def estimate(self, job, default=None):
+        """
+        Returns the expected duration of ``job``, or ``default`` if none of
+        its labels have been seen before.
+        """
+        total, known = 0.0, False
+        for label in job.split():
+            duration = self.timings.get(label)
+            if duration is None:
+                continue
+            total += duration
+            known = True
+        if not known:
+            return default
+        return total + (self.overhead or 0.0)
+
+    def _update(self, label, duration):
+        previous = self.timings.get(label)
+        if previous is None:
+            self.timings[label] = duration
+        else:
+            self.timings[label] = previous + self.weight * (duration - previous)
+
+    def record(self, job, duration):
+        labels = job.split()
+        if not labels or duration < 0:
+            return
+        # Without finer grained data we assume each label took an equal share
+        duration = max(0.0, float(duration) - (self.overhead or 0.0)) / len(labels)
+        for label in labels:
+            self._update(label, duration)
+
+    def record_result(self, result):
+        """
+        Records the duration of a ``run_test`` result.
+
+        If the result has a ``timings`` dict (label => seconds spent running
+        tests) it is used to record each label and the job's overhead
+        precisely, otherwise the wall-clock time is split evenly.
+        """
+        if not isinstance(result, dict):
+            return
+        try:
+            duration = result['timeFinished'] - result['timeStarted']
+        except (KeyError, TypeError):
+            return
+
+        timings = result.get('timings')
+        if not timings:
+            self.record(result['job'], duration)
+            return
+
+        labels = result['job'].split()
+        for label in labels:
+            if label in timings:
+                self._update(label, float(timings[label]))
+        # We can only tell how much time was overhead if every label reported back
+        if all(label in timings for label in labels):
+            self._update(OVERHEAD, max(0.0, duration - sum(float(timings[l]) for l in labels)))
+
+    def sort_jobs(self, jobs):
+        """
+        Returns ``jobs`` ordered longest first. Jobs we have no history for
+        are assumed to take the average time of the ones we do know about.
+        """
+        jobs = list(jobs)
+        known = filter(None, (self.estimate(j) for j in jobs))
+        if known:
+            default = sum(known) / len(known)
+        else:
+            default = 0.0
+        # sorted() is stable, so without history the original order is kept
+        return sorted(jobs, key=lambda j: self.estimate(j, default), reverse=True)
@@ -0,0 +1,227 @@
+from __future__ import absolute_import
+
+from mule.utils.processes import kill_process_group, dump_process_group
+
+import json
+import os
+import select
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+# The parent's ends of the pipes to forked workers, which must not leak into their
+# siblings (or they would never see EOF on their stdin)
+_parent_fds = set()
+
+class WarmProcessError(Exception):
+    pass
+
+class WarmProcessTimeout(WarmProcessError):
+    pass
+
+class WarmProcess(object):
+    """
+    A long running runner (e.g. ``mule --worker --serve``) which jobs are sent to
+    over its stdin, and which replies over its stdout, one JSON object per line.
+    """
+    def __init__(self, args, env=None, cwd=None):
+        # stderr is only needed for diagnostics, so it goes to disk rather than a pipe
+        # which we would otherwise need to keep draining
+        self.stderr = tempfile.TemporaryFile(prefix='warm')
+        self.proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=self.stderr, env=env, cwd=cwd, close_fds=True,
+                                     preexec_fn=os.setsid)
+
+    def is_alive(self):
+        return self.proc.poll() is None
+
+    def get_stderr(self, limit=8192):
+        try:
+            self.stderr.seek(0, os.SEEK_END)
+            size = self.stderr.tell()
+            self.stderr.seek(max(0, size - limit))
+            return self.stderr.read().strip()
+        except ValueError:
+            # We were closed (e.g. killed) from another thread
+            return ''
+
+    def fileno(self):
+        # Readable once the runner has responded
+        return self.proc.stdout.fileno()
+
+    def _exited(self):
+        stderr = self.get_stderr()
+        self.close()
+        return WarmProcessError('Warm worker exited with status %s:\n%s' % (
+            self.proc.returncode, stderr))
+
+    def send(self, job):
+        """
+        Sends ``job`` to the runner, without waiting for its response.
+        """
+        try:
+            self.proc.stdin.write(json.dumps({'job': job}) + '\n')
+            self.proc.stdin.flush()
+        except IOError, e:
+            raise self._exited()
+
+    def receive(self):
+        """
+        Returns the response to the job which was sent to the runner, waiting for it
+        if needed.
+        """
+        try:
+            line = self.proc.stdout.readline()
+        except IOError, e:
+            line = None
+
+        if not line:
+            raise self._exited()
+
+        return json.loads(line)
+
+    def expire(self, timeout):
+        """
+        Kills the runner (after asking it to dump its stacks) as its job took longer
+        than ``timeout`` seconds, and returns the ``WarmProcessTimeout`` to report.
+        """
+        dump_process_group(self.proc.pid)
+        stderr = self.get_stderr()
+        self.close(kill=True)
+        return WarmProcessTimeout('Job timed out after %ss:\n%s' % (timeout, stderr))
+
+    def run(self, job, timeout=None):
+        """
+        Runs ``job`` and returns the response from the runner.
+
+        If the runner doesn't respond within ``timeout`` seconds it is killed, and
+        ``WarmProcessTimeout`` is raised.
+        """
+        self.send(job)
+        if timeout and not select.select([self.fileno()], [], [], timeout)[0]:
+            raise self.expire(timeout)
+        return self.receive()
+
+    def close(self, kill=False):
+        if self.is_alive():
+            if kill:
+                kill_process_group(self.proc.pid, leader=self.proc)
+            # The runner exits once there are no more jobs to read
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+            self.proc.wait()
+        self.stderr.close()
+
+class ForkedChild(object):
+    """
+    The parts of ``subprocess.Popen`` used by ``WarmProcess``, for a child which is
+    forked from this process and runs ``target`` instead of exec'ing a command.
+    """
+    def __init__(self, target, stderr):
+        (stdin_r, stdin_w) = os.pipe()
+        (stdout_r, stdout_w) = os.pipe()
+
+        self.returncode = None
+        self.pid = os.fork()
+        if not self.pid:
+            os.close(stdin_w)
+            os.close(stdout_r)
+            self._run_child(target, stdin_r, stdout_w, stderr.fileno())
+
+        os.close(stdin_r)
+        os.close(stdout_w)
+        self.stdin = os.fdopen(stdin_w, 'w')
+        self.stdout = os.fdopen(stdout_r, 'r')
+        self._fds = (stdin_w, stdout_r, stderr.fileno())
+        _parent_fds.update(self._fds)
+
+    def _run_child(self, target, stdin, stdout, stderr):
+        code = 1
+        try:
+            try:
+                os.setsid()
+                # We may have been forked from within a ``Supervisor``
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                for fd in _parent_fds:
+                    try:
+                        os.close(fd)
+                    except OSError:
+                        pass
+                os.dup2(stdin, 0)
+                os.dup2(stdout, 1)
+                os.dup2(stderr, 2)
+                for fd in (stdin, stdout, stderr):
+                    if fd > 2:
+                        os.close(fd)
+                code = target() or 0
+            except SystemExit, e:
+                code = e.code
+            except:
+                traceback.print_exc()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            # Never return into (or run the exit handlers of) the parent's code
+            os._exit(code if isinstance(code, int) else 1)
+
+    def _handle_status(self, status):
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+        _parent_fds.difference_update(self._fds)
+
+    def poll(self):
+        if self.returncode is None:
+            (pid, status) = os.waitpid(self.pid, os.WNOHANG)
+            if pid == self.pid:
+                self._handle_status(status)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            (pid, status) = os.waitpid(self.pid, 0)
+            self._handle_status(status)
+        return self.returncode
+
+class ForkedProcess(WarmProcess):
+    """
+    A warm worker which is forked from this process rather than started from scratch,
+    so it shares everything which was already imported (copy-on-write). ``target`` is
+    run in the child, and must serve jobs over stdin/stdout like ``WarmProcess`` expects.
+    """
+    def __init__(self, target):
+        self.stderr = tempfile.TemporaryFile(prefix='warm')
+        self.proc = ForkedChild(target, self.stderr)
+
+class ForkServer(object):
+    """
+    Creates ``ForkedProcess``'s which run ``target``, for use as the ``spawn`` of a
+    ``WarmPool``.
+
+    Forking a process which is running other threads is risky (a lock one of them
+    holds stays locked in the child), so ``prefork`` workers are forked straight
+    away, before there are any. Further workers (e.g. replacing those which timed
+    out) are forked on demand.
+    """
+    def __init__(self, target, prefork=0):
+        self.target = target
+        self.lock = threading.Lock()
+        self.ready = [ForkedProcess(target) for i in xrange(prefork)]
+
+    def __call__(self):
+        with self.lock:
+            if self.ready:
+                return self.ready.pop()
+        return ForkedProcess(self.target)
+
+    def close(self):
+        with self.lock:
+            while self.ready:
+                self.ready.pop().close()